@@ -0,0 +1,323 @@
+"""Мікробенчмарки гарячих шляхів бота.
+
+Вимірює те, через що проходить кожне оновлення: ProtectionMiddleware з 10k-1M користувачів,
+escape_html на довгих списках товарів, рендер замовлення, клавіатури, FSM поверх Redis
+і пошук замовлення в accept_order. Бенчмарки з Redis потребують локального інстансу
+(--redis-url) і пропускаються, якщо він недоступний; вони пишуть у ключі з префіксом bench:.
+
+    python bench.py --save bench_baseline.json
+    python bench.py --compare bench_baseline.json --threshold 0.15
+
+У режимі --compare результати порівнюються з базовими; повільніші за поріг позначаються,
+і скрипт завершується з кодом 1.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:BENCH-token-not-used-for-any-requests-00")
+
+from aiogram import types
+from aiogram.fsm.storage.base import StorageKey
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+import bot
+
+# ==================== ВИМІРЮВАННЯ ====================
+def measure(fn, number: int, repeat: int) -> list:
+    """Час однієї операції (сек) для кожного з repeat прогонів по number викликів"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - started) / number)
+    return timings
+
+async def measure_async(fn, number: int, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            await fn()
+        timings.append((time.perf_counter() - started) / number)
+    return timings
+
+def summary(timings: list, number: int) -> dict:
+    return {
+        "best_us": min(timings) * 1e6,
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "number": number,
+        "repeat": len(timings),
+    }
+
+# ==================== ДАНІ ====================
+def sample_items(count: int) -> list:
+    return [f"Товар {n}: <b>пакет</b> & коробка > 2 кг, {'дуже ' * (n % 5)}обережно" for n in range(count)]
+
+def sample_order(items: int = 30) -> bot.Order:
+    return bot.Order(
+        id=123456,
+        user_id=987654321,
+        created_at=time.time(),
+        name="Олена",
+        phone="+380991234567",
+        items=[bot.escape_html(item) for item in sample_items(items)],
+        photos=[f"AgACAgIAAxkBAAI-bench-{n}" for n in range(5)],
+        delivery_type="Одержувач",
+        delivery_address="вулиця Хрещатик, 1, Київ",
+        delivery_lat=50.4501,
+        delivery_lon=30.5234,
+        delivery_time="Якнайшвидше ⚡",
+        payment=bot.PAYMENT_CASH,
+        change_from="💲 500",
+        promo_code="SPRING",
+    )
+
+def sample_message(user_id: int) -> types.Message:
+    return types.Message.model_validate({
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": "Пакет з продуктами",
+    })
+
+def sample_zones() -> bot.ZoneIndex:
+    """Сітка 10x10 зон-многокутників по 64 вершини навколо Києва"""
+    features = []
+    for row in range(10):
+        for column in range(10):
+            lat, lon = 50.3 + row * 0.04 + 0.02, 30.3 + column * 0.05 + 0.025
+            ring = [
+                [lon + 0.026 * math.cos(2 * math.pi * n / 64), lat + 0.021 * math.sin(2 * math.pi * n / 64)]
+                for n in range(64)
+            ]
+            features.append({
+                "type": "Feature",
+                "properties": {"name": f"Зона {row}-{column}", "fee": 60, "fee_per_km": 12},
+                "geometry": {"type": "Polygon", "coordinates": [ring + ring[:1]]},
+            })
+    return bot.ZoneIndex.from_geojson({"type": "FeatureCollection", "features": features})
+
+class RotatingSender:
+    """Повідомлення, відправник якого щоразу береться з популяції: middleware читає лише from_user.id,
+    а будувати мільйон об'єктів Message заради цього не варто"""
+
+    def __init__(self, message: types.Message, population: int):
+        self.message = message
+        self.population = population
+
+    def __getattr__(self, name):
+        if name == "from_user":
+            return SimpleNamespace(id=random.randrange(1, self.population + 1))
+        return getattr(self.message, name)
+
+# ==================== БЕНЧМАРКИ ====================
+def cpu_benchmarks(number: int, repeat: int) -> dict:
+    results = {}
+    long_text = "\n".join(sample_items(200))
+    results["escape_html[200 items]"] = summary(measure(lambda: bot.escape_html(long_text), number, repeat), number)
+
+    order = sample_order()
+    data = {
+        "name": order.name, "phone": order.phone, "item_text": "\n".join(order.items) + "\n",
+        "item_photos": order.photos, "delivery_type": order.delivery_type,
+        "delivery_address": order.delivery_address, "delivery_lat": order.delivery_lat,
+        "delivery_lon": order.delivery_lon, "delivery_time": order.delivery_time,
+        "payment": order.payment, "change_from": order.change_from,
+    }
+    results["Order.from_state[30 items]"] = summary(measure(lambda: bot.Order.from_state(data, 1), number, repeat), number)
+    results["render_order[review]"] = summary(
+        measure(lambda: bot.render_order(order, bot.ORDER_VIEW_REVIEW), number, repeat), number
+    )
+    results["render_order[admin]"] = summary(
+        measure(lambda: bot.render_order(order, bot.ORDER_VIEW_ADMIN), number, repeat), number
+    )
+
+    zones = sample_zones()
+    points = [(50.3 + random.random() * 0.4, 30.3 + random.random() * 0.5) for _ in range(1000)]
+    point = iter(points * (number * repeat // len(points) + 1))
+    results["zones:lookup[100 zones]"] = summary(
+        measure(lambda: zones.lookup(*next(point)), number, repeat), number
+    )
+    results["zones:lookup_many[1000 points]"] = summary(
+        measure(lambda: zones.lookup_many(points), max(number // 100, 1), repeat), max(number // 100, 1)
+    )
+
+    items = order.items[:20]
+    users = list(range(1000, 1000 + bot.BLACKLIST_PAGE_SIZE))
+    keyboards = {
+        "review_kb": bot.review_kb,
+        "payment_kb": bot.payment_kb,
+        "admin_main_kb": lambda: bot.admin_main_kb(True),
+        "delivery_time_kb": bot.delivery_time_kb,
+        "new_order_kb": bot.new_order_kb,
+        "admin_accept_kb": lambda: bot.admin_accept_kb("123456"),
+        "get_items_edit_kb[20]": lambda: bot.get_items_edit_kb(items),
+        "admin_blacklist_kb[20]": lambda: bot.admin_blacklist_kb(users, page=1, pages=3),
+    }
+    for name, build in keyboards.items():
+        results[f"keyboard:{name}"] = summary(measure(build, number, repeat), number)
+    return results
+
+async def redis_benchmarks(redis: Redis, number: int, repeat: int, populations: list) -> dict:
+    results = {}
+
+    # ProtectionMiddleware: випадкові користувачі з популяції; ліміти підняті, щоб усі проходили
+    bot.RATE_LIMIT = bot.MAX_MESSAGES_PER_MIN = 10 ** 9
+    bot.blacklist = bot.BlacklistStore(redis, key="bench:blacklist")
+    bot.pause_switch = bot.PauseSwitch(redis, key="bench:paused")
+    bot.live_stats = bot.LiveStats(redis, prefix="bench:stats")
+    middleware = bot.ProtectionMiddleware(redis)
+
+    async def handler(event, data):
+        return None
+
+    message = sample_message(1)
+    for population in populations:
+        event = RotatingSender(message, population)
+
+        async def call():
+            await middleware(handler, event, {})
+
+        results[f"ProtectionMiddleware[{population} users]"] = summary(
+            await measure_async(call, number, repeat), number
+        )
+
+    # FSM: один цикл оновлення - прочитати стан і дані, змінити, записати одним зверненням
+    storage = bot.CompactRedisStorage(redis, prefix="bench:fsm", stats_prefix="bench:stats")
+    key = StorageKey(bot_id=1, chat_id=42, user_id=42)
+    await storage.write(key, state=bot.OrderForm.item.state, data={"name": "Олена", "item_text": "", "item_photos": []})
+
+    async def fsm_cycle():
+        context = bot.BufferedFSMContext(storage, key)
+        await context.get_state()
+        data = await context.get_data()
+        await context.update_data(item_text=data["item_text"][-2000:] + "Пакет з продуктами\n")
+        await context.flush()
+
+    results["fsm:update_cycle"] = summary(await measure_async(fsm_cycle, number, repeat), number)
+    results["fsm:get_data"] = summary(await measure_async(lambda: storage.get_data(key), number, repeat), number)
+
+    # accept_order: номер з callback_data і пошук замовлення за ключем
+    store = bot.OrderStore(redis, prefix="bench:order", stream="bench:orders:events")
+    order = await store.create(sample_order())
+    callback_data = f"accept_order_{order.id}"
+
+    async def accept_lookup():
+        order_id = callback_data.split("_")[-1]
+        await store.get(int(order_id))
+
+    results["accept_order:lookup"] = summary(await measure_async(accept_lookup, number, repeat), number)
+    return results
+
+async def cleanup(redis: Redis):
+    async for key in redis.scan_iter(match="bench:*", count=1000):
+        await redis.delete(key)
+
+async def run(args) -> dict:
+    results = cpu_benchmarks(args.number, args.repeat)
+
+    redis = Redis.from_url(args.redis_url)
+    try:
+        await redis.ping()
+    except (RedisError, OSError) as e:
+        print(f"Redis недоступний ({e}), бенчмарки з Redis пропущено", file=sys.stderr)
+    else:
+        try:
+            results.update(await redis_benchmarks(redis, args.redis_number, args.repeat, args.users))
+        finally:
+            await cleanup(redis)
+    finally:
+        await redis.aclose() if hasattr(redis, "aclose") else await redis.close()
+    return results
+
+# ==================== ЗВІТ ====================
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Список (назва, було, стало, зміна) для бенчмарків, що сповільнилися більше ніж на threshold"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result["best_us"] / before["best_us"] - 1
+        if change > threshold:
+            regressions.append((name, before["best_us"], result["best_us"], change))
+    return regressions
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'бенчмарк':<40}{'best, мкс':>12}{'mean, мкс':>12}{'зміна':>10}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline:
+            change = f"{(result['best_us'] / baseline[name]['best_us'] - 1) * 100:+.1f}%"
+        print(f"{name:<40}{result['best_us']:>12.2f}{result['mean_us']:>12.2f}{change:>10}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Мікробенчмарки гарячих шляхів бота")
+    parser.add_argument("--number", type=int, default=2000, help="викликів на прогін для CPU-бенчмарків")
+    parser.add_argument("--redis-number", type=int, default=500, help="викликів на прогін для бенчмарків з Redis")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--users", type=lambda value: [int(n) for n in value.split(",")],
+                        default=[10_000, 100_000, 1_000_000], help="розміри популяції для ProtectionMiddleware")
+    parser.add_argument("--redis-url", default=os.getenv("BENCH_REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--only", help="залишити у звіті лише бенчмарки, що містять цей рядок")
+    parser.add_argument("--save", help="зберегти результати як базові")
+    parser.add_argument("--compare", help="порівняти з базовими результатами")
+    parser.add_argument("--threshold", type=float, default=0.10, help="допустиме сповільнення, частка")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    if args.only:
+        results = {name: result for name, result in results.items() if args.only in name}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"meta": metadata(), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nБазові результати збережено в {args.save}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️ Сповільнення понад {args.threshold * 100:.0f}%:")
+            for name, before, after, change in regressions:
+                print(f"  {name}: {before:.2f} → {after:.2f} мкс ({change * 100:+.1f}%)")
+            return 1
+        print(f"\nСповільнень понад {args.threshold * 100:.0f}% немає")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,38 @@
+import time
+PROCESS_STARTED = time.perf_counter()  # Відлік холодного старту - до важких імпортів
+
 import asyncio
+import json
 import logging
 import os
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery
-from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.client.default import DefaultBotProperties
-
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-import time
+import zlib
+import sys
 import random
 import signal
+import socket
+import hashlib
+import hmac
+import heapq
+import math
+import itertools
+import contextlib
+import contextvars
 import aiohttp
+import msgpack
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
 from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
+    InputMediaPhoto
 )
-from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, DEFAULT_DESTINY
+from aiogram.dispatcher.flags import get_flag
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
@@ -28,10 +40,17 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.methods import GetChatMember
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram import methods
 from aiohttp import web
 from dotenv import load_dotenv
+# PROMETHEUS_MULTIPROC_DIR має бути в оточенні процесу до цього імпорту (не в .env)
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
 
 # Завантаження змінних середовища
 load_dotenv()
@@ -48,6 +67,69 @@ ADMIN_ID = int(os.getenv('ADMIN_ID', 8154128217))
 CHANNEL_ID = os.getenv('CHANNEL_ID', "@pulsedelivery")
 GEOCODING_API_KEY = os.getenv('GEOCODING_API_KEY')
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+NOMINATIM_URL = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Власний Bot API сервер (або фейковий для loadtest.py)
+
+# Спільний HTTP-клієнт для зовнішніх API
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 5))
+
+# Кеш зворотного геокодування
+GEOCODE_PRECISION = int(os.getenv('GEOCODE_PRECISION', 8))  # Геохеш з 8 символів - клітинка ~38x19 м
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 7 * 24 * 60 * 60))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', 60 * 60))
+GEOCODE_LOCAL_CACHE_SIZE = int(os.getenv('GEOCODE_LOCAL_CACHE_SIZE', 2048))
+GEOCODE_RATE = float(os.getenv('GEOCODE_RATE', 1))  # Запитів до Nominatim на секунду на всі репліки
+GEOCODE_WAIT_BUDGET = float(os.getenv('GEOCODE_WAIT_BUDGET', 2))  # Скільки обробник чекає на адресу, сек
+GEOCODE_QUEUE_LIMIT = float(os.getenv('GEOCODE_QUEUE_LIMIT', 60))  # Максимальна черга до Nominatim, сек
+
+# Зони доставки
+ZONES_FILE = os.getenv('ZONES_FILE')  # GeoJSON з полігонами зон; без нього доставляємо будь-куди і без тарифу
+ZONES_GRID_STEP = float(os.getenv('ZONES_GRID_STEP', 0.01))  # Градусів; клітинка індексу ~1.1 x 0.7 км
+ZONES_CHECK_INTERVAL = float(os.getenv('ZONES_CHECK_INTERVAL', 30))  # Сек між перевірками зміни файлу у фоні
+
+# Промокоди
+PROMO_REFRESH_INTERVAL = float(os.getenv('PROMO_REFRESH_INTERVAL', 60))  # Сек; за стільки інші процеси побачать новий код
+PROMO_BLOOM_ERROR_RATE = float(os.getenv('PROMO_BLOOM_ERROR_RATE', 0.001))  # Частка неіснуючих кодів, що дійдуть до Redis
+
+# Фонова обробка замовлень (Redis Streams)
+ORDER_WORKERS = int(os.getenv('ORDER_WORKERS', 4))
+ORDER_CLAIM_IDLE = int(os.getenv('ORDER_CLAIM_IDLE', 60))  # Через скільки секунд забирати завислі події
+ORDER_MAX_DELIVERIES = int(os.getenv('ORDER_MAX_DELIVERIES', 5))
+ORDER_STREAM_MAXLEN = int(os.getenv('ORDER_STREAM_MAXLEN', 100000))
+
+# Диспетчеризація замовлень кур'єрам
+COURIER_RADIUS_KM = float(os.getenv('COURIER_RADIUS_KM', 3))  # Радіус першої хвилі; кожна наступна ширша на стільки ж
+COURIER_WAVE_SIZE = int(os.getenv('COURIER_WAVE_SIZE', 3))  # Найближчих кур'єрів у хвилі
+COURIER_WAVES = int(os.getenv('COURIER_WAVES', 3))  # Після останньої хвилі замовлення йде адміну
+COURIER_OFFER_TIMEOUT = int(os.getenv('COURIER_OFFER_TIMEOUT', 45))  # Сек на прийняття до наступної хвилі
+COURIER_LOCATION_TTL = int(os.getenv('COURIER_LOCATION_TTL', 15 * 60))  # Старіші координати кур'єра не враховуємо
+DISPATCH_POLL_INTERVAL = float(os.getenv('DISPATCH_POLL_INTERVAL', 1))
+
+# Сховище станів FSM
+FSM_KEY_PREFIX = os.getenv('FSM_KEY_PREFIX', 'pulse:fsm')
+FSM_SESSION_TTL = int(os.getenv('FSM_SESSION_TTL', 24 * 60 * 60))  # Незавершене замовлення живе добу
+FSM_CAPTCHA_TTL = int(os.getenv('FSM_CAPTCHA_TTL', 15 * 60))
+FSM_COMPRESS_THRESHOLD = int(os.getenv('FSM_COMPRESS_THRESHOLD', 1024))  # Байт; більші дані стискаються
+
+# Лічильники для статусу бота
+STATS_PREFIX = os.getenv('STATS_PREFIX', 'pulse:stats')
+STATS_RETENTION_DAYS = int(os.getenv('STATS_RETENTION_DAYS', 8))  # Скільки зберігати денні/годинні лічильники
+
+# Обробка вхідних оновлень у режимі вебхуку
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 16))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1024))  # Сумарно на всі воркери
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', 1))  # Після цього - 503 і повтор від Telegram
+WEBHOOK_STALL_TIMEOUT = float(os.getenv('WEBHOOK_STALL_TIMEOUT', 10))  # Сек; довше оновлення не тримає чергу воркера
+
+# Кілька процесів-обробників на одному порту (SO_REUSEPORT)
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+RESPAWN_BACKOFF_MAX = float(os.getenv('RESPAWN_BACKOFF_MAX', 30))  # Сек; пауза перед перезапуском подвоюється до цієї межі
+RESPAWN_MAX_CRASHES = int(os.getenv('RESPAWN_MAX_CRASHES', 5))  # Стільки падінь за RESPAWN_CRASH_WINDOW - і супервізор виходить
+RESPAWN_CRASH_WINDOW = float(os.getenv('RESPAWN_CRASH_WINDOW', 60))  # Сек
+LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', 15))  # Сек; лідер керує вебхуком і сповіщеннями
 
 # Налаштування вебхуку для Render.com
 WEB_SERVER_HOST = os.getenv('WEB_SERVER_HOST', '0.0.0.0')
@@ -56,13 +138,38 @@ WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
 BASE_WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
-BLACKLIST = []
-RATE_LIMIT = 10
-RATE_PERIOD = 60
-MAX_MESSAGES_PER_MIN = 40
+BLACKLIST_AUTO_BAN_TTL = int(os.getenv('BLACKLIST_AUTO_BAN_TTL', 24 * 60 * 60))  # Тимчасове блокування, сек
+BLACKLIST_CACHE_TTL = float(os.getenv('BLACKLIST_CACHE_TTL', 5))  # Локальний кеш перевірок, сек
+PAUSE_CACHE_TTL = float(os.getenv('PAUSE_CACHE_TTL', 2))  # Сек; так швидко пауза доходить до всіх процесів
+BLACKLIST_PAGE_SIZE = 20
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 24 * 60 * 60))  # Кеш підписки, сек
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', 60))  # Кеш "не підписаний", сек
+RATE_LIMIT = int(os.getenv('RATE_LIMIT', 10))
+RATE_PERIOD = int(os.getenv('RATE_PERIOD', 60))
+MAX_MESSAGES_PER_MIN = int(os.getenv('MAX_MESSAGES_PER_MIN', 40))
+
+# Ліміти Telegram на вихідні повідомлення
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 30))  # Повідомлень на секунду на весь бот
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', 1))  # Повідомлень на секунду в особистий чат
+TG_CHAT_BURST = int(os.getenv('TG_CHAT_BURST', 3))
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', 20 / 60))  # Повідомлень на секунду в групу
+TG_SEND_RETRIES = int(os.getenv('TG_SEND_RETRIES', 3))  # Повтори після TelegramRetryAfter
+
+# Профілювання оновлень
+PROFILE_SLOW_THRESHOLD = float(os.getenv('PROFILE_SLOW_THRESHOLD', 1.0))  # Сек; повільніші оновлення зберігаються завжди
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0.01))  # Частка решти оновлень для вибірки
+PROFILE_BUFFER_SIZE = int(os.getenv('PROFILE_BUFFER_SIZE', 200))
 
-# Глобальна змінна для керування станом бота
-BOT_RUNNING = True
+# Холодний старт і перевірки /healthz, /readyz
+COLD_START_BUDGET = float(os.getenv('COLD_START_BUDGET', 5))  # Сек від запуску процесу до готовності
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', 2))  # Сек на перевірку Redis і Bot API
+READINESS_CACHE_TTL = float(os.getenv('READINESS_CACHE_TTL', 5))  # Сек; частіше залежності не смикаємо
+
+# Завершення роботи: скільки чекати на незавершені оновлення й відправки (менше за kill_timeout у fly.toml)
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 25))
+
+DRAINING = False  # Процес завершується: нові оновлення не приймаємо, доробляємо почате
+SUPERVISOR_PID = None  # У процесі-обробнику під run_supervisor - pid супервізора
 
 # ==================== ЛОГУВАННЯ ====================
 logging.basicConfig(
@@ -75,10 +182,471 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== МЕТРИКИ ====================
+# Prometheus-метрики віддає /metrics на окремому внутрішньому порту METRICS_PORT (0 - вимкнено),
+# який не публікується назовні разом з вебхуком. При WEB_CONCURRENCY > 1 задайте
+# PROMETHEUS_MULTIPROC_DIR, щоб /metrics будь-якого процесу показував суму по всіх.
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9091))
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+UPDATES_TOTAL = Counter("bot_updates_total", "Вхідні оновлення за типом", ["update_type"])
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Оновлення в обробці", multiprocess_mode="livesum")
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Тривалість обробників", ["router", "handler", "outcome"]
+)
+FSM_TRANSITIONS = Counter("bot_fsm_transitions_total", "Переходи між станами FSM", ["from_state", "to_state"])
+API_DURATION = Histogram("bot_api_request_duration_seconds", "Тривалість запитів до Bot API", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Помилки Bot API за кодом", ["method", "code"])
+REDIS_DURATION = Histogram(
+    "bot_redis_command_duration_seconds", "Тривалість звернень до Redis", ["command"], buckets=FAST_BUCKETS
+)
+WEBHOOK_QUEUE_DEPTH = Gauge("bot_webhook_queue_depth", "Оновлення в черзі вебхуку", multiprocess_mode="livesum")
+WEBHOOK_QUEUE_AGE = Gauge(
+    "bot_webhook_queue_oldest_seconds", "Скільки чекає найстаріше оновлення в черзі вебхуку", multiprocess_mode="livemax"
+)
+WEBHOOK_REJECTED = Counter("bot_webhook_rejected_total", "Оновлення, повернуті Telegram з 503", ["reason"])
+WEBHOOK_DETACHED = Counter(
+    "bot_webhook_detached_total", "Оновлення, що обробляли довше за WEBHOOK_STALL_TIMEOUT і звільнили чергу"
+)
+PROMO_CHECKS = Counter("bot_promo_checks_total", "Перевірки промокодів за результатом", ["result"])
+GEOCODE_LOOKUPS = Counter("bot_geocode_cache_lookups_total", "Звернення до кешу геокодування", ["result"])
+DISPATCH_ASSIGNMENT = Histogram(
+    "bot_dispatch_time_to_assignment_seconds", "Від створення замовлення до призначення", ["source"],
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+)
+DISPATCH_OFFERS = Counter("bot_dispatch_offers_total", "Пропозиції замовлень кур'єрам")
+DISPATCH_ESCALATIONS = Counter("bot_dispatch_escalations_total", "Замовлення, передані адміну після всіх хвиль")
+STARTUP_PHASE = Gauge(
+    "bot_startup_phase_seconds", "Тривалість фаз старту процесу", ["phase"], multiprocess_mode="max"
+)
+COLD_START = Gauge(
+    "bot_cold_start_seconds", "Час від запуску процесу до прийому з'єднань і до готовності", ["milestone"],
+    multiprocess_mode="max"
+)
+COLD_START_BUDGET_GAUGE = Gauge(
+    "bot_cold_start_budget_seconds", "Бюджет холодного старту (COLD_START_BUDGET)", multiprocess_mode="max"
+)
+COLD_START_BUDGET_GAUGE.set(COLD_START_BUDGET)
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            elapsed = time.perf_counter() - started
+            REDIS_DURATION.labels("PIPELINE").observe(elapsed)
+            record_span("redis:PIPELINE", elapsed)
+
+class InstrumentedRedis(Redis):
+    """Клієнт Redis, що вимірює кожну команду (скрипти - як EVALSHA) і кожен pipeline цілком"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - started
+            command = str(args[0]).upper()
+            REDIS_DURATION.labels(command).observe(elapsed)
+            record_span(f"redis:{command}", elapsed)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+API_ERROR_CODES = {
+    "TelegramBadRequest": "400",
+    "TelegramUnauthorizedError": "401",
+    "TelegramForbiddenError": "403",
+    "TelegramNotFound": "404",
+    "TelegramConflictError": "409",
+    "TelegramEntityTooLarge": "413",
+    "TelegramRetryAfter": "429",
+    "TelegramServerError": "5xx",
+    "TelegramNetworkError": "network",
+}
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Тривалість кожної спроби запиту до Bot API та коди помилок"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.labels(name, API_ERROR_CODES.get(type(e).__name__, type(e).__name__)).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            API_DURATION.labels(name).observe(elapsed)
+            record_span(f"api:{name}", elapsed)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Зовнішній middleware на dp.update: рахує оновлення за типом і ті, що зараз в обробці"""
+
+    def __init__(self):
+        self.in_flight = 0
+
+    async def __call__(self, handler, event: types.Update, data):
+        UPDATES_TOTAL.labels(getattr(event, "event_type", None) or "unknown").inc()
+        self.in_flight += 1
+        UPDATES_IN_FLIGHT.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            UPDATES_IN_FLIGHT.dec()
+
+update_metrics = UpdateMetricsMiddleware()
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутрішній middleware: тривалість обробника разом зі збереженням стану FSM"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        router = data.get("event_router")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        trace = current_trace.get()
+        if trace is not None:
+            trace.handler = name
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            HANDLER_DURATION.labels(
+                router.name if router is not None else "unknown", name, outcome
+            ).observe(time.perf_counter() - started)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        body = generate_latest(registry)
+    else:
+        body = generate_latest()
+    return web.Response(body=body, headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+# ==================== ПРОФІЛЮВАННЯ ====================
+@dataclass
+class Trace:
+    """Розбивка одного оновлення: сумарний час і кількість очікувань за назвою (api:*, redis:*, geocode, ...)"""
+    update_type: str
+    user_id: int
+    started_at: float = field(default_factory=time.time)
+    handler: str = "—"
+    duration: float = 0.0
+    state_before: str = None
+    state_after: str = None
+    spans: dict = field(default_factory=dict)
+
+    def add(self, name: str, elapsed: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, elapsed]
+        else:
+            span[0] += 1
+            span[1] += elapsed
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def record_span(name: str, elapsed: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, elapsed)
+
+@contextlib.contextmanager
+def trace_span(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+class UpdateProfiler:
+    """Кільцеві буфери трас: усі оновлення, довші за PROFILE_SLOW_THRESHOLD, і випадкова вибірка решти"""
+
+    def __init__(self, threshold: float = PROFILE_SLOW_THRESHOLD, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 size: int = PROFILE_BUFFER_SIZE):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.slow = deque(maxlen=size)
+        self.sampled = deque(maxlen=size)
+
+    def keep(self, trace: Trace):
+        """Куди зберегти трасу: slow, sampled або нікуди (None)"""
+        if trace.duration >= self.threshold:
+            return self.slow
+        if random.random() < self.sample_rate:
+            return self.sampled
+        return None
+
+    def slowest(self, n: int) -> list:
+        return heapq.nlargest(n, itertools.chain(self.slow, self.sampled), key=lambda trace: trace.duration)
+
+profiler = UpdateProfiler()
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Зовнішній middleware для повідомлень і callback-запитів: вимірює оновлення та збирає розбивку очікувань"""
+
+    def __init__(self, profiler: UpdateProfiler):
+        self.profiler = profiler
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        trace = Trace(
+            update_type=type(event).__name__,
+            user_id=user.id if user else 0,
+            state_before=data.get("raw_state")
+        )
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            trace.duration = time.perf_counter() - started
+            current_trace.reset(token)
+            buffer = self.profiler.keep(trace)
+            if buffer is not None:
+                state = data.get("state")
+                if state is not None:
+                    with contextlib.suppress(Exception):
+                        trace.state_after = await state.get_state()
+                buffer.append(trace)
+                if buffer is self.profiler.slow:
+                    logger.warning(
+                        f"Повільне оновлення: {trace.handler} {trace.duration * 1000:.0f} мс (user {trace.user_id})"
+                    )
+
+# ==================== СХОВИЩЕ FSM ====================
+UNSET = object()
+
+# Запис сесії одним зверненням. KEYS[1] - хеш сесії (поля s - стан, d - дані, v - версія даних).
+# ARGV[1]/ARGV[3] - операція над станом/даними: k - не змінювати, s - записати ARGV[2]/ARGV[4], d - видалити.
+# ARGV[5] - новий TTL у мс (0 - залишити поточний), ARGV[6] - TTL для сесії без терміну.
+# Повертає попередній стан. ARGV[7] - префікс лічильників: сесія переноситься між sorted set {prefix}:state:{стан}
+# (score - момент закінчення сесії), тож кількість активних сесій у стані - це ZCOUNT від "зараз".
+# ARGV[8] - очікувана версія даних ('' - не перевіряти): якщо дані вже змінив хтось інший, нічого не пише і повертає -1.
+FSM_WRITE_SCRIPT = """
+local key = KEYS[1]
+if ARGV[8] ~= '' and ARGV[3] ~= 'k' and (redis.call('HGET', key, 'v') or '0') ~= ARGV[8] then
+    return -1
+end
+local old_state = redis.call('HGET', key, 's')
+if ARGV[1] == 's' then
+    redis.call('HSET', key, 's', ARGV[2])
+elseif ARGV[1] == 'd' then
+    redis.call('HDEL', key, 's')
+end
+if ARGV[3] == 's' then
+    redis.call('HSET', key, 'd', ARGV[4])
+elseif ARGV[3] == 'd' then
+    redis.call('HDEL', key, 'd')
+end
+if ARGV[3] ~= 'k' then
+    redis.call('HINCRBY', key, 'v', 1)
+end
+if tonumber(ARGV[5]) > 0 then
+    redis.call('PEXPIRE', key, ARGV[5])
+elseif redis.call('PTTL', key) == -1 then
+    redis.call('PEXPIRE', key, ARGV[6])
+end
+
+local new_state = redis.call('HGET', key, 's')
+if old_state and old_state ~= new_state then
+    redis.call('ZREM', ARGV[7] .. ':state:' .. old_state, key)
+end
+if new_state then
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local counter = ARGV[7] .. ':state:' .. new_state
+    redis.call('ZADD', counter, now + redis.call('PTTL', key), key)
+    redis.call('ZREMRANGEBYSCORE', counter, '-inf', now)
+end
+return old_state
+"""
+
+class CompactRedisStorage(BaseStorage):
+    """Сховище FSM: одна хеш-сесія на користувача, дані в msgpack (zlib понад поріг),
+    TTL залежить від стану і продовжується з кожним записом, тож покинуті замовлення зникають самі.
+    Спільне з'єднання (owns_redis=False) сховище не закриває - це робить on_shutdown."""
+
+    RAW = b"\x00"
+    COMPRESSED = b"\x01"
+
+    def __init__(self, redis: Redis, prefix: str = FSM_KEY_PREFIX, default_ttl: int = FSM_SESSION_TTL,
+                 compress_threshold: int = FSM_COMPRESS_THRESHOLD, stats_prefix: str = STATS_PREFIX,
+                 owns_redis: bool = False):
+        self.redis = redis
+        self.owns_redis = owns_redis
+        self.prefix = prefix
+        self.stats_prefix = stats_prefix
+        self.default_ttl = default_ttl
+        self.compress_threshold = compress_threshold
+        self.state_ttls = {}  # назва стану -> TTL у секундах
+        self.write_session = redis.register_script(FSM_WRITE_SCRIPT)
+
+    def build_key(self, key: StorageKey) -> str:
+        parts = [self.prefix, str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        thread_id = getattr(key, "thread_id", None)
+        if thread_id:
+            parts.append(str(thread_id))
+        business_connection_id = getattr(key, "business_connection_id", None)
+        if business_connection_id:
+            parts.append(business_connection_id)
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    def ttl_for(self, state) -> int:
+        return self.state_ttls.get(state, self.default_ttl)
+
+    def dumps(self, data: dict) -> bytes:
+        payload = msgpack.packb(data, use_bin_type=True)
+        if len(payload) > self.compress_threshold:
+            return self.COMPRESSED + zlib.compress(payload)
+        return self.RAW + payload
+
+    def loads(self, blob: bytes) -> dict:
+        payload = blob[1:]
+        if blob[:1] == self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        return msgpack.unpackb(payload, raw=False)
+
+    async def write(self, key: StorageKey, state=UNSET, data: dict = None, ttl_state=UNSET,
+                    version: str = None) -> bool:
+        """Записує стан і/або дані. TTL визначає новий стан, а якщо стан не змінюється - ttl_state.
+        З version дані записуються, лише якщо їхня версія не змінилася з моменту читання; інакше - False"""
+        if state is UNSET:
+            state_op, state_value = "k", ""
+        elif state is None:
+            state_op, state_value = "d", ""
+        else:
+            state_op, state_value = "s", state.state if isinstance(state, State) else state
+
+        if data is None:
+            data_op, data_value = "k", ""
+        elif data:
+            data_op, data_value = "s", self.dumps(dict(data))
+        else:
+            data_op, data_value = "d", ""
+
+        ttl = 0
+        if state_op == "s":
+            ttl = self.ttl_for(state_value)
+        elif ttl_state is not UNSET:
+            ttl = self.ttl_for(ttl_state)
+
+        old_state = await self.write_session(
+            keys=[self.build_key(key)],
+            args=[state_op, state_value, data_op, data_value, ttl * 1000, self.default_ttl * 1000, self.stats_prefix,
+                  version or ""]
+        )
+        if old_state == -1:
+            return False
+        if state_op != "k":
+            old_state = old_state.decode() if old_state else "none"
+            if old_state != (state_value or "none"):
+                FSM_TRANSITIONS.labels(old_state, state_value or "none").inc()
+        return True
+
+    async def merge_data(self, key: StorageKey, changes: dict, removed=(), expect: dict = None,
+                         state=UNSET, ttl_state=UNSET, attempts: int = 5) -> bool:
+        """Змінює лише вказані поля даних поверх свіжої копії (порівняння версії, повтор при конфлікті).
+        expect - поля, що мають зберігати ці значення; якщо ні - нічого не пише і повертає False"""
+        for _ in range(attempts):
+            data, version = await self.get_data_versioned(key)
+            if expect and any(data.get(name) != value for name, value in expect.items()):
+                return False
+            data.update(changes)
+            for name in removed:
+                data.pop(name, None)
+            if await self.write(key, state=state, data=data, ttl_state=ttl_state, version=version):
+                return True
+        logger.warning(f"Сесія {self.build_key(key)} змінюється надто часто, записуємо без перевірки версії")
+        data = await self.get_data(key)
+        data.update(changes)
+        for name in removed:
+            data.pop(name, None)
+        return await self.write(key, state=state, data=data, ttl_state=ttl_state)
+
+    async def set_state(self, key: StorageKey, state=None):
+        await self.write(key, state=state)
+
+    async def get_state(self, key: StorageKey):
+        value = await self.redis.hget(self.build_key(key), "s")
+        return value.decode() if value is not None else None
+
+    async def set_data(self, key: StorageKey, data: dict):
+        await self.write(key, data=data)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        blob = await self.redis.hget(self.build_key(key), "d")
+        return self.loads(blob) if blob else {}
+
+    async def get_data_versioned(self, key: StorageKey) -> tuple:
+        blob, version = await self.redis.hmget(self.build_key(key), "d", "v")
+        return (self.loads(blob) if blob else {}), (version.decode() if version else "0")
+
+    async def close(self):
+        # Dispatcher закриває сховище раніше за on_shutdown, якому Redis ще потрібен
+        if not self.owns_redis:
+            return
+        close = getattr(self.redis, "aclose", None) or self.redis.close
+        await close()
+
+# ==================== ЛІЧИЛЬНИКИ ====================
+class LiveStats:
+    """Лічильники для статусу бота, що оновлюються разом із даними: сесії за станами (пише сховище FSM),
+    унікальні користувачі за день (HyperLogLog, пише ProtectionMiddleware) і замовлення за годину (пише OrderStore)."""
+
+    def __init__(self, redis: Redis, prefix: str = STATS_PREFIX):
+        self.redis = redis
+        self.prefix = prefix
+        self.retention = STATS_RETENTION_DAYS * 24 * 60 * 60
+
+    def state_key(self, state: str) -> str:
+        return f"{self.prefix}:state:{state}"
+
+    def users_key(self, ts: float = None) -> str:
+        return f"{self.prefix}:users:{time.strftime('%Y%m%d', time.localtime(ts))}"
+
+    def orders_key(self, ts: float = None) -> str:
+        return f"{self.prefix}:orders:{time.strftime('%Y%m%d%H', time.localtime(ts))}"
+
+    async def snapshot(self, states) -> dict:
+        """Активні сесії за станами, унікальні користувачі сьогодні, замовлення за цю та попередню годину"""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for state in states:
+                pipe.zcount(self.state_key(state), int(now * 1000), "+inf")
+            pipe.pfcount(self.users_key(now))
+            pipe.get(self.orders_key(now))
+            pipe.get(self.orders_key(now - 60 * 60))
+            *sessions, users, orders_hour, orders_prev_hour = await pipe.execute()
+        return {
+            "sessions": dict(zip(states, sessions)),
+            "users_today": users,
+            "orders_hour": int(orders_hour or 0),
+            "orders_prev_hour": int(orders_prev_hour or 0),
+        }
+
 # ==================== ІНІЦІАЛІЗАЦІЯ ====================
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = RedisStorage.from_url(REDIS_URL)  # Використовуємо Redis для зберігання стану
-dp = Dispatcher(storage=storage)
+bot = Bot(
+    token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+redis_client = InstrumentedRedis.from_url(REDIS_URL)  # Спільне з'єднання для FSM, лімітів та інших даних
+storage = CompactRedisStorage(redis_client)  # Використовуємо Redis для зберігання стану
+live_stats = LiveStats(redis_client)
+dp = Dispatcher(storage=storage, name="pulse")
 
 # ==================== СТАНИ ФОРМИ ====================
 class OrderForm(StatesGroup):
@@ -98,55 +666,545 @@ class OrderForm(StatesGroup):
     promo_code = State()
     review = State()
 
+class AdminForm(StatesGroup):
+    blacklist_user = State()
+
+# Капча й адмінські дії короткі, тож їхні сесії не тримаємо добу
+storage.state_ttls = {
+    OrderForm.captcha.state: FSM_CAPTCHA_TTL,
+    AdminForm.blacklist_user.state: FSM_CAPTCHA_TTL,
+}
+
 # ==================== СИСТЕМА ЗАХИСТУ ====================
+class BlacklistStore:
+    """Чорний список у Redis: sorted set, де score - час закінчення блокування (inf - назавжди)"""
+
+    def __init__(self, redis: Redis, key: str = "blacklist", cache_ttl: float = BLACKLIST_CACHE_TTL,
+                 cache_size: int = 10000):
+        self.redis = redis
+        self.key = key
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # user_id -> (заблокований, дійсно до)
+
+    def _remember(self, user_id: int, blocked: bool, valid_until: float):
+        self._cache[user_id] = (blocked, valid_until)
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def contains(self, user_id: int) -> bool:
+        now = time.time()
+        cached = self._cache.get(user_id)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        expires_at = await self.redis.zscore(self.key, user_id)
+        blocked = expires_at is not None and expires_at > now
+        valid_until = now + self.cache_ttl
+        if blocked:
+            valid_until = min(valid_until, expires_at)
+        self._remember(user_id, blocked, valid_until)
+        return blocked
+
+    async def add(self, user_id: int, ttl: int = None):
+        expires_at = time.time() + ttl if ttl else float("inf")
+        await self.redis.zadd(self.key, {user_id: expires_at})
+        self._remember(user_id, True, min(time.time() + self.cache_ttl, expires_at))
+
+    async def remove(self, user_id: int) -> bool:
+        self._cache.pop(user_id, None)
+        return bool(await self.redis.zrem(self.key, user_id))
+
+    async def count(self) -> int:
+        return await self.redis.zcount(self.key, f"({time.time()}", "+inf")
+
+    async def page(self, page: int, size: int = BLACKLIST_PAGE_SIZE):
+        """Повертає ([(user_id, expires_at), ...], загальна кількість) і прибирає прострочені записи"""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(self.key, "-inf", now)
+            pipe.zcard(self.key)
+            pipe.zrange(self.key, page * size, (page + 1) * size - 1, withscores=True)
+            _, total, entries = await pipe.execute()
+        return [(int(user_id), expires_at) for user_id, expires_at in entries], total
+
+blacklist = BlacklistStore(redis_client)
+
+class PauseSwitch:
+    """Пауза бота з адмін-панелі - спільна для всіх процесів і машин: ключ у Redis,
+    у процесі - кеш на cache_ttl секунд. Якщо Redis недоступний, діє останній відомий стан."""
+
+    def __init__(self, redis: Redis, key: str = "bot:paused", cache_ttl: float = PAUSE_CACHE_TTL):
+        self.redis = redis
+        self.key = key
+        self.cache_ttl = cache_ttl
+        self._running = True
+        self._valid_until = 0.0
+
+    async def is_running(self) -> bool:
+        now = time.monotonic()
+        if now >= self._valid_until:
+            try:
+                self._running = not await self.redis.exists(self.key)
+            except RedisError as e:
+                logger.error(f"Помилка перевірки паузи бота: {e}")
+            self._valid_until = now + self.cache_ttl
+        return self._running
+
+    async def set_running(self, running: bool):
+        if running:
+            await self.redis.delete(self.key)
+        else:
+            await self.redis.set(self.key, 1)
+        self._running = running
+        self._valid_until = time.monotonic() + self.cache_ttl
+
+pause_switch = PauseSwitch(redis_client)
+
+# Ковзні вікна в Redis (sorted set на користувача): одна атомарна операція на повідомлення,
+# спільна для всіх реплік, ключі зникають самі через PEXPIRE.
+# Повертає 0 - пропустити, 1 - перевищено RATE_LIMIT, 2 - перевищено MAX_MESSAGES_PER_MIN.
+# Заодно рахує користувача в денному HyperLogLog (KEYS[3], термін ARGV[6]).
+RATE_LIMIT_SCRIPT = """
+redis.call('PFADD', KEYS[3], ARGV[5])
+redis.call('EXPIRE', KEYS[3], ARGV[6])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local period = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local msg_period = tonumber(ARGV[3])
+local msg_limit = tonumber(ARGV[4])
+local member = now .. '-' .. ARGV[7]
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - period)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 1
+end
+redis.call('ZADD', KEYS[1], now, member)
+redis.call('PEXPIRE', KEYS[1], period)
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - msg_period)
+redis.call('ZADD', KEYS[2], now, member)
+redis.call('PEXPIRE', KEYS[2], msg_period)
+if redis.call('ZCARD', KEYS[2]) > msg_limit then
+    return 2
+end
+return 0
+"""
+
 class ProtectionMiddleware(BaseMiddleware):
-    def __init__(self):
-        self.user_activity = {}
-        self.message_timestamps = {}
+    def __init__(self, redis: Redis):
+        self.check_limits = redis.register_script(RATE_LIMIT_SCRIPT)
 
     async def __call__(self, handler, event: types.Message, data):
-        global BOT_RUNNING
-
-        if not BOT_RUNNING:
+        if not await pause_switch.is_running():
             return
 
         user_id = event.from_user.id
-        now = time.time()
 
         if user_id == ADMIN_ID:
             return await handler(event, data)
 
-        if user_id in BLACKLIST:
-            await event.answer("⛔ Вам заборонено використовувати бота.")
-            return
+        try:
+            if await blacklist.contains(user_id):
+                await event.answer("⛔ Вам заборонено використовувати бота.")
+                return
+        except RedisError as e:
+            logger.error(f"Помилка перевірки чорного списку: {e}")
+
+        try:
+            verdict = await self.check_limits(
+                keys=[f"rl:{user_id}:req", f"rl:{user_id}:min", live_stats.users_key()],
+                args=[RATE_PERIOD * 1000, RATE_LIMIT, 60 * 1000, MAX_MESSAGES_PER_MIN, user_id,
+                      live_stats.retention, random.getrandbits(32)]
+            )
+        except RedisError as e:
+            # Недоступність Redis не повинна блокувати клієнтів
+            logger.error(f"Помилка перевірки лімітів: {e}")
+            return await handler(event, data)
 
         # Ліміт RATE_LIMIT за RATE_PERIOD секунд
-        if user_id in self.user_activity:
-            self.user_activity[user_id] = [
-                t for t in self.user_activity[user_id]
-                if now - t < RATE_PERIOD
-            ]
-            if len(self.user_activity[user_id]) >= RATE_LIMIT:
-                await event.answer(f"❗ Занадто багато запитів. Спробуйте через {RATE_PERIOD} сек.")
-                return
-        self.user_activity.setdefault(user_id, []).append(now)
+        if verdict == 1:
+            await event.answer(f"❗ Занадто багато запитів. Спробуйте через {RATE_PERIOD} сек.")
+            return
 
         # Ліміт MAX_MESSAGES_PER_MIN за 60 секунд
-        if user_id not in self.message_timestamps:
-            self.message_timestamps[user_id] = []
-        self.message_timestamps[user_id].append(now)
-        self.message_timestamps[user_id] = [
-            t for t in self.message_timestamps[user_id]
-            if now - t < 60
-        ]
-        if len(self.message_timestamps[user_id]) > MAX_MESSAGES_PER_MIN:
-            BLACKLIST.append(user_id)
-            logger.warning(f"User {user_id} added to blacklist")
+        if verdict == 2:
+            try:
+                await blacklist.add(user_id, ttl=BLACKLIST_AUTO_BAN_TTL)
+            except RedisError as e:
+                logger.error(f"Не вдалося додати {user_id} до чорного списку: {e}")
+            logger.warning(f"User {user_id} added to blacklist for {BLACKLIST_AUTO_BAN_TTL}s")
             await event.answer("⛔ Ваш акаунт тимчасово заблоковано за підозрілу активність.")
             return
 
         return await handler(event, data)
 
+# ==================== ВИХІДНІ ПОВІДОМЛЕННЯ ====================
+PRIORITY_ORDER = 0  # Нові замовлення адміну
+PRIORITY_CUSTOMER = 1  # Відповіді клієнтам
+PRIORITY_BULK = 2  # Фото, службові повідомлення
+
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_CUSTOMER)
+
+@contextlib.contextmanager
+def outbound_priority(priority: int):
+    """Задає пріоритет для всіх відправок у межах блоку"""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Скільки секунд чекати до наступного токена"""
+        if now < self.updated:  # Заблоковано до updated через retry_after
+            return self.updated - now + max(0.0, 1 - self.tokens) / self.rate
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block_until(self, until: float):
+        self.tokens = min(self.tokens, 1.0)
+        self.updated = max(self.updated, until)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class ChatQueue:
+    __slots__ = ("lock", "bucket", "pending")
+
+    def __init__(self, bucket: TokenBucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.pending = 0
+
+class OutboundScheduler:
+    """Черга відправок з глобальним і почерговим (на чат) лімітами.
+
+    Відправки в один чат виконуються строго по черзі, тож порядок повідомлень зберігається.
+    Глобальні токени видаються за пріоритетом: замовлення адміну, відповіді клієнтам, решта."""
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 chat_burst: int = TG_CHAT_BURST, group_rate: float = TG_GROUP_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._chats = {}  # chat_id -> ChatQueue
+        self._waiters = []  # купа (пріоритет, номер, future) в очікуванні глобального токена
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_sweep = time.monotonic()
+        # Метрики
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.wait_count = [0, 0, 0]
+        self.wait_total = [0.0, 0.0, 0.0]
+        self.wait_max = [0.0, 0.0, 0.0]
+
+    def _chat(self, chat_id: int) -> ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if time.monotonic() - self._last_sweep > 60:
+                self.sweep()
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            chat = self._chats[chat_id] = ChatQueue(bucket)
+        return chat
+
+    async def _run(self):
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            delay = self.global_bucket.delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # Відправника скасували, поки він чекав
+                continue
+            self.global_bucket.take(time.monotonic())
+            future.set_result(None)
+
+    async def _acquire_global(self, priority: int):
+        if not self._waiters and self.global_bucket.delay(time.monotonic()) == 0:
+            self.global_bucket.take(time.monotonic())
+            return
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    async def _acquire(self, chat: ChatQueue, priority: int):
+        delay = chat.bucket.delay(time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        chat.bucket.take(time.monotonic())
+        await self._acquire_global(priority)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, chat_id: int, priority: int):
+        """Тримає чергу чату, доки виконується відправка"""
+        chat = self._chat(chat_id)
+        chat.pending += 1
+        started = time.monotonic()
+        try:
+            async with chat.lock:
+                await self._acquire(chat, priority)
+                waited = time.monotonic() - started
+                self.wait_count[priority] += 1
+                self.wait_total[priority] += waited
+                self.wait_max[priority] = max(self.wait_max[priority], waited)
+                yield chat
+        finally:
+            chat.pending -= 1
+            if not chat.pending and chat.bucket.is_full(time.monotonic()):
+                self._chats.pop(chat_id, None)
+
+    async def retry_after(self, chat: ChatQueue, priority: int, seconds: float):
+        """Telegram попросив зачекати - блокуємо чат і чекаємо нового слоту"""
+        self.retries += 1
+        chat.bucket.block_until(time.monotonic() + seconds)
+        await self._acquire(chat, priority)
+
+    def sweep(self):
+        """Прибирає відпочилі чати, які не прибралися одразу після відправки"""
+        now = time.monotonic()
+        self._last_sweep = now
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.pending and chat.bucket.is_full(now):
+                del self._chats[chat_id]
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_global": len(self._waiters),
+            "queue_chats": sum(chat.pending for chat in self._chats.values()),
+            "tracked_chats": len(self._chats),
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+            "wait_avg": [
+                total / count if count else 0.0
+                for total, count in zip(self.wait_total, self.wait_count)
+            ],
+            "wait_max": list(self.wait_max),
+        }
+
+# Методи, на які поширюються ліміти Telegram на повідомлення
+RATE_LIMITED_METHODS = (
+    methods.SendMessage,
+    methods.SendPhoto,
+    methods.SendMediaGroup,
+    methods.SendLocation,
+    methods.CopyMessage,
+    methods.ForwardMessage,
+    methods.EditMessageText,
+    methods.EditMessageReplyMarkup,
+)
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Пропускає всі відправки бота через OutboundScheduler і повторює їх після TelegramRetryAfter"""
+
+    def __init__(self, scheduler: OutboundScheduler, max_retries: int = TG_SEND_RETRIES):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(method, RATE_LIMITED_METHODS) or not isinstance(chat_id, int):
+            return await make_request(bot, method)
+
+        priority = send_priority.get()
+        started = time.perf_counter()
+        async with self.scheduler.slot(chat_id, priority) as chat:
+            record_span("outbound:wait", time.perf_counter() - started)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await make_request(bot, method)
+                    self.scheduler.sent += 1
+                    return response
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        self.scheduler.failed += 1
+                        raise
+                    logger.warning(f"Flood control у чаті {chat_id}, повтор через {e.retry_after} сек.")
+                    await self.scheduler.retry_after(chat, priority, e.retry_after)
+                except Exception:
+                    self.scheduler.failed += 1
+                    raise
+
+outbound = OutboundScheduler()
+bot.session.middleware(OutboundMiddleware(outbound))
+bot.session.middleware(ApiMetricsMiddleware())  # Усередині планувальника: вимірює саме запит, без черги
+
+# ==================== FSM ====================
+async def write_fsm(storage: BaseStorage, key: StorageKey, state=UNSET, data: dict = None, ttl_state=UNSET):
+    """Записує стан і/або дані одним зверненням до сховища"""
+    if isinstance(storage, CompactRedisStorage):
+        await storage.write(key, state=state, data=data, ttl_state=ttl_state)
+        return
+
+    if state is not UNSET:
+        await storage.set_state(key=key, state=state)
+    if data is not None:
+        await storage.set_data(key=key, data=data)
+
+async def merge_fsm_data(storage: BaseStorage, key: StorageKey, changes: dict, expect: dict = None) -> bool:
+    """Змінює окремі поля даних сесії, не затираючи решту; expect - умова на поточні значення"""
+    if isinstance(storage, CompactRedisStorage):
+        return await storage.merge_data(key, changes, expect=expect)
+
+    data = await storage.get_data(key=key)
+    if expect and any(data.get(name) != value for name, value in expect.items()):
+        return False
+    data.update(changes)
+    await storage.set_data(key=key, data=data)
+    return True
+
+class BufferedFSMContext(FSMContext):
+    """FSM-контекст оновлення: стан і дані читаються один раз, зміни накопичуються в пам'яті
+    і записуються одним зверненням після завершення обробника (або раніше через flush()).
+
+    Поки обробник працює, дані сесії може змінити фонова задача (пізня адреса від геокодера).
+    Тому знімок записується, лише якщо версія даних не змінилася, а інакше поверх свіжих даних
+    зливаються тільки поля, які змінив цей обробник. clear() затирає сесію повністю."""
+
+    def __init__(self, storage: BaseStorage, key: StorageKey, state=UNSET):
+        super().__init__(storage=storage, key=key)
+        self._state = state
+        self._data = None
+        self._version = None
+        self._changes = {}
+        self._removed = set()
+        self._replace = False
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def get_state(self):
+        if self._state is UNSET:
+            self._state = await super().get_state()
+        return self._state
+
+    async def set_state(self, state=None):
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_data(self) -> dict:
+        if self._data is None:
+            if isinstance(self.storage, CompactRedisStorage):
+                self._data, self._version = await self.storage.get_data_versioned(self.key)
+            else:
+                self._data = await super().get_data()
+        return self._data.copy()
+
+    async def set_data(self, data: dict):
+        if self._data is None:
+            self._replace = True
+        else:
+            for name, value in data.items():
+                if name not in self._data or self._data[name] != value:
+                    self._changes[name] = value
+                    self._removed.discard(name)
+            for name in self._data.keys() - data.keys():
+                self._changes.pop(name, None)
+                self._removed.add(name)
+        self._data = dict(data)
+        self._data_dirty = True
+
+    async def update_data(self, data: dict = None, **kwargs) -> dict:
+        current = await self.get_data()
+        if data:
+            current.update(data)
+        current.update(kwargs)
+        await self.set_data(current)
+        return current.copy()
+
+    async def get_value(self, key: str, default=None):
+        return (await self.get_data()).get(key, default)
+
+    async def clear(self):
+        await self.set_state(None)
+        self._data = {}
+        self._replace = True
+        self._data_dirty = True
+
+    async def flush(self):
+        if not (self._state_dirty or self._data_dirty):
+            return
+        state = self._state if self._state_dirty else UNSET
+        ttl_state = self._state  # Продовжуємо TTL сесії за поточним станом
+        if not self._data_dirty or self._replace or not isinstance(self.storage, CompactRedisStorage):
+            await write_fsm(
+                self.storage, self.key, state=state, data=self._data if self._data_dirty else None,
+                ttl_state=ttl_state
+            )
+        elif not await self.storage.write(self.key, state=state, data=self._data, ttl_state=ttl_state,
+                                          version=self._version):
+            await self.storage.merge_data(self.key, self._changes, self._removed, state=state, ttl_state=ttl_state)
+        self._state_dirty = False
+        self._data_dirty = False
+        self._changes = {}
+        self._removed = set()
+        self._replace = False
+        self._data = None  # Після запису знімок міг застаріти - наступне читання візьме свіжі дані
+
+class FSMWriteBackMiddleware(BaseMiddleware):
+    """Підміняє FSMContext на BufferedFSMContext для кожного оновлення.
+    Обробники з прапорцем flags={"fsm_write_through": True} працюють зі сховищем напряму."""
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is None or get_flag(data, "fsm_write_through"):
+            return await handler(event, data)
+
+        buffered = BufferedFSMContext(state.storage, state.key, data.get("raw_state", UNSET))
+        data["state"] = buffered
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await buffered.flush()
+            except Exception as e:
+                logger.error(f"Не вдалося зберегти стан FSM: {e}")
+
 # ==================== КЛАВІАТУРИ ====================
 def style_text(text, emoji=None):
     if emoji:
@@ -192,6 +1250,8 @@ def delivery_time_kb():
     builder.adjust(1)
     return builder.as_markup()
 
+# Незмінні клавіатури створюються один раз і використовуються повторно - не змінюйте їх на місці
+@lru_cache(maxsize=None)
 def payment_kb():
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text=style_text("Готівка", "💵"), callback_data="payment_cash"))
@@ -199,6 +1259,7 @@ def payment_kb():
     builder.adjust(1)
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def review_kb():
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text=style_text("Редагувати замовлення", "✏️"), callback_data="edit_order"))
@@ -220,11 +1281,11 @@ def get_items_edit_kb(items: list, can_finish: bool = True):
     builder.adjust(1)
     return builder.as_markup()
 
-def admin_main_kb():
-    global BOT_RUNNING
+@lru_cache(maxsize=None)
+def admin_main_kb(running: bool):
     builder = InlineKeyboardBuilder()
     
-    if BOT_RUNNING:
+    if running:
         builder.add(InlineKeyboardButton(text="⏸️ Призупинити бота", callback_data="admin_pause_bot"))
     else:
         builder.add(InlineKeyboardButton(text="▶️ Запустити бота", callback_data="admin_start_bot"))
@@ -235,13 +1296,23 @@ def admin_main_kb():
     builder.adjust(1, 2, 1)
     return builder.as_markup()
 
-def admin_blacklist_kb(users: list):
+def admin_blacklist_kb(users: list, page: int = 0, pages: int = 1):
     builder = InlineKeyboardBuilder()
     for user_id in users:
         builder.add(InlineKeyboardButton(
             text=f"❌ Видалити {user_id}",
-            callback_data=f"unblock_{user_id}"
+            callback_data=f"unblock_{user_id}_{page}"
         ))
+    builder.adjust(2)
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"admin_blacklist_page_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"admin_blacklist_page_{page + 1}"))
+    if navigation:
+        builder.row(*navigation)
+
     builder.row(
         InlineKeyboardButton(text="👤 Додати користувача", callback_data="admin_add_to_blacklist"),
         InlineKeyboardButton(text="🔄 Оновити", callback_data="admin_blacklist_refresh")
@@ -249,7 +1320,6 @@ def admin_blacklist_kb(users: list):
     builder.row(
         InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")
     )
-    builder.adjust(2)
     return builder.as_markup()
 
 def admin_accept_kb(order_id: str):
@@ -260,6 +1330,21 @@ def admin_accept_kb(order_id: str):
     ))
     return builder.as_markup()
 
+def courier_offer_kb(order_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="✅ Беру замовлення", callback_data=f"claim_order_{order_id}"))
+    return builder.as_markup()
+
+def courier_delivered_kb(order_id: int):
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="📦 Доставлено", callback_data=f"deliver_order_{order_id}"))
+    return builder.as_markup()
+
+def courier_location_kb():
+    builder = ReplyKeyboardBuilder()
+    builder.add(KeyboardButton(text=style_text("Надіслати геолокацію", "📍"), request_location=True))
+    return builder.as_markup(resize_keyboard=True)
+
 # ==================== КЛЮЧОВІ ФУНКЦІЇ ====================
 def escape_html(text):
     return (text
@@ -268,58 +1353,1255 @@ def escape_html(text):
         .replace(">", "&gt;")
     )
 
+MEDIA_GROUP_SIZE = 10  # Ліміт Telegram на кількість фото в одному альбомі
+
+async def send_photo_album(chat_id: int, photos: list, caption: str = None, reply_to_message_id: int = None,
+                           priority: int = PRIORITY_BULK) -> int:
+    """Надсилає фото альбомами по MEDIA_GROUP_SIZE штук і повертає кількість доставлених фото"""
+    with outbound_priority(priority):
+        return await _send_photo_album(chat_id, photos, caption, reply_to_message_id)
+
+async def _send_photo_album(chat_id: int, photos: list, caption: str, reply_to_message_id: int) -> int:
+    sent = 0
+    for start in range(0, len(photos), MEDIA_GROUP_SIZE):
+        chunk = photos[start:start + MEDIA_GROUP_SIZE]
+        chunk_caption = caption if start == 0 else None
+        try:
+            if len(chunk) == 1:
+                # Альбом має містити щонайменше 2 фото
+                await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=chunk[0],
+                    caption=chunk_caption,
+                    reply_to_message_id=reply_to_message_id,
+                    allow_sending_without_reply=True
+                )
+            else:
+                media = [
+                    InputMediaPhoto(media=file_id, caption=chunk_caption if i == 0 else None)
+                    for i, file_id in enumerate(chunk)
+                ]
+                await bot.send_media_group(
+                    chat_id=chat_id,
+                    media=media,
+                    reply_to_message_id=reply_to_message_id,
+                    allow_sending_without_reply=True
+                )
+            sent += len(chunk)
+        except TelegramBadRequest as e:
+            # Один недійсний file_id відхиляє весь альбом - досилаємо фото цього альбому по одному
+            logger.warning(f"Не вдалося надіслати альбом у чат {chat_id}: {e}")
+            # Підпис альбому переходить до першого фото, яке вдасться надіслати
+            for file_id in chunk:
+                try:
+                    await bot.send_photo(
+                        chat_id=chat_id,
+                        photo=file_id,
+                        caption=chunk_caption,
+                        reply_to_message_id=reply_to_message_id,
+                        allow_sending_without_reply=True
+                    )
+                    sent += 1
+                    chunk_caption = None
+                except TelegramBadRequest as e:
+                    logger.error(f"Не вдалося надіслати фото {file_id} у чат {chat_id}: {e}")
+        except Exception as e:
+            logger.error(f"Не вдалося надіслати альбом у чат {chat_id}: {e}")
+    return sent
+
+background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    """Запускає фонову задачу і тримає на неї посилання до завершення"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 async def generate_captcha():
     a = random.randint(1, 5)
     b = random.randint(1, 5)
     return f"{a} + {b}", a + b
 
-async def check_subscription(user_id: int):
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+def is_subscription_channel(chat: types.Chat) -> bool:
+    if CHANNEL_ID.startswith("@"):
+        return bool(chat.username) and chat.username.lower() == CHANNEL_ID[1:].lower()
+    return str(chat.id) == CHANNEL_ID
+
+async def remember_subscription(user_id: int, subscribed: bool):
+    try:
+        await redis_client.set(
+            f"sub:{user_id}",
+            "1" if subscribed else "0",
+            ex=SUBSCRIPTION_CACHE_TTL if subscribed else SUBSCRIPTION_NEGATIVE_TTL
+        )
+    except RedisError as e:
+        logger.error(f"Помилка запису кешу підписки: {e}")
+
+async def check_subscription(user_id: int, trust_negative: bool = True):
+    """Перевірка підписки з кешем у Redis; кеш оновлюється також з оновлень chat_member каналу"""
+    try:
+        cached = await redis_client.get(f"sub:{user_id}")
+    except RedisError as e:
+        logger.error(f"Помилка читання кешу підписки: {e}")
+        cached = None
+
+    if cached == b"1" or (cached == b"0" and trust_negative):
+        return cached == b"1"
+
     try:
         member = await bot(GetChatMember(chat_id=CHANNEL_ID, user_id=user_id))
-        return member.status in ["member", "administrator", "creator"]
     except Exception as e:
         logger.error(f"Помилка перевірки підписки: {e}")
         return False
 
-async def get_address_from_coords(lat: float, lon: float):
-    """Отримати адресу за координатами за допомогою Nominatim API"""
-    if not GEOCODING_API_KEY:
-        logger.warning("GEOCODING_API_KEY не встановлено")
-        return None
-        
-    try:
-        url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1"
-        headers = {"User-Agent": "Telegram Delivery Bot"}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                data = await response.json()
-                
-                if 'address' in data:
-                    address = data['address']
-                    components = []
-                    
-                    if 'road' in address:
-                        components.append(address['road'])
-                    if 'house_number' in address:
-                        components.append(address['house_number'])
-                    if 'suburb' in address:
-                        components.append(address['suburb'])
-                    if 'city' in address:
-                        components.append(address['city'])
-                    
-                    return ", ".join(components) if components else None
-                
-                return None
-    except Exception as e:
-        logger.error(f"Помилка отримання адреси: {e}")
-        return None
+    subscribed = member.status in SUBSCRIBED_STATUSES
+    await remember_subscription(user_id, subscribed)
+    return subscribed
 
-# ==================== ОСНОВНІ КОМАНДИ ====================
-@dp.message(Command("start", "help"))
+# ==================== HTTP КЛІЄНТ ====================
+http_session: aiohttp.ClientSession = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Спільна сесія з пулом keep-alive з'єднань; створюється в on_startup, закривається в on_shutdown"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT,
+                connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT
+            ),
+            headers={"User-Agent": "Telegram Delivery Bot"},
+            raise_for_status=True
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# ==================== ГЕОКОДУВАННЯ ====================
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat: float, lon: float, precision: int = GEOCODE_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+class GeocodeCache:
+    """Дворівневий кеш адрес: LRU у процесі + Redis, ключ - клітинка геохешу.
+    Результат "адреси немає" теж кешується (None локально, порожній рядок у Redis)."""
+
+    def __init__(self, redis: Redis, prefix: str = "geo", size: int = GEOCODE_LOCAL_CACHE_SIZE,
+                 ttl: int = GEOCODE_CACHE_TTL, negative_ttl: int = GEOCODE_NEGATIVE_TTL):
+        self.redis = redis
+        self.prefix = prefix
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._local = OrderedDict()  # клітинка -> (адреса або None, дійсно до)
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+
+    def _remember(self, cell: str, address, ttl: int):
+        self._local[cell] = (address, time.time() + ttl)
+        self._local.move_to_end(cell)
+        if len(self._local) > self.size:
+            self._local.popitem(last=False)
+
+    async def get(self, cell: str):
+        """Повертає (знайдено, адреса)"""
+        cached = self._local.get(cell)
+        if cached:
+            if cached[1] > time.time():
+                self._local.move_to_end(cell)
+                self.hits_local += 1
+                GEOCODE_LOOKUPS.labels("local").inc()
+                return True, cached[0]
+            del self._local[cell]
+
+        try:
+            value = await self.redis.get(f"{self.prefix}:{cell}")
+        except RedisError as e:
+            logger.error(f"Помилка читання кешу геокодування: {e}")
+            value = None
+
+        if value is None:
+            self.misses += 1
+            GEOCODE_LOOKUPS.labels("miss").inc()
+            return False, None
+
+        self.hits_redis += 1
+        GEOCODE_LOOKUPS.labels("redis").inc()
+        address = value.decode() or None
+        self._remember(cell, address, self.ttl if address else self.negative_ttl)
+        return True, address
+
+    async def set(self, cell: str, address):
+        ttl = self.ttl if address else self.negative_ttl
+        self._remember(cell, address, ttl)
+        try:
+            await self.redis.set(f"{self.prefix}:{cell}", address or "", ex=ttl)
+        except RedisError as e:
+            logger.error(f"Помилка запису кешу геокодування: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits_local + self.hits_redis + self.misses
+        return {
+            "hits_local": self.hits_local,
+            "hits_redis": self.hits_redis,
+            "misses": self.misses,
+            "hit_ratio": (self.hits_local + self.hits_redis) / lookups if lookups else 0.0,
+            "local_size": len(self._local),
+        }
+
+geocode_cache = GeocodeCache(redis_client)
+
+async def fetch_address(lat: float, lon: float):
+    """Запит до Nominatim API; помилки мережі прокидаються далі, щоб їх не кешувати"""
+    params = {
+        "format": "json",
+        "lat": f"{lat:.6f}",
+        "lon": f"{lon:.6f}",
+        "zoom": 18,
+        "addressdetails": 1
+    }
+    async with get_http_session().get(f"{NOMINATIM_URL}/reverse", params=params) as response:
+        data = await response.json()
+
+    if 'address' in data:
+        address = data['address']
+        components = []
+
+        if 'road' in address:
+            components.append(address['road'])
+        if 'house_number' in address:
+            components.append(address['house_number'])
+        if 'suburb' in address:
+            components.append(address['suburb'])
+        if 'city' in address:
+            components.append(address['city'])
+
+        return ", ".join(components) if components else None
+
+    return None
+
+# Резервує наступний вільний слот для запиту до Nominatim (GCRA), спільний для всіх реплік.
+# Повертає затримку до слоту в мс або -1, якщо черга довша за ARGV[2].
+GEOCODE_SLOT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local max_delay = tonumber(ARGV[2])
+local slot = math.max(now, tonumber(redis.call('GET', KEYS[1]) or now))
+if slot - now > max_delay then
+    return -1
+end
+redis.call('SET', KEYS[1], slot + interval, 'PX', slot - now + interval)
+return slot - now
+"""
+
+class GeocodeScheduler:
+    """Черга запитів до Nominatim: однакові запити в польоті об'єднуються (single-flight),
+    а частота запитів обмежується спільним для всіх реплік слотом у Redis."""
+
+    def __init__(self, redis: Redis, cache: GeocodeCache, rate: float = GEOCODE_RATE,
+                 queue_limit: float = GEOCODE_QUEUE_LIMIT):
+        self.reserve_slot = redis.register_script(GEOCODE_SLOT_SCRIPT)
+        self.cache = cache
+        self.interval_ms = int(1000 / rate)
+        self.queue_limit_ms = int(queue_limit * 1000)
+        self._inflight = {}  # клітинка -> asyncio.Task
+        self._local_next = 0.0
+        self.requests = 0
+        self.merged = 0
+        self.rejected = 0
+        self.deferred = 0
+
+    async def _wait_for_slot(self) -> bool:
+        try:
+            delay_ms = await self.reserve_slot(keys=["geo:slot"], args=[self.interval_ms, self.queue_limit_ms])
+        except RedisError as e:
+            # Без Redis обмежуємо хоча б цей процес
+            logger.error(f"Помилка планування запиту геокодування: {e}")
+            now = time.monotonic()
+            slot = max(now, self._local_next)
+            self._local_next = slot + self.interval_ms / 1000
+            delay_ms = int((slot - now) * 1000)
+
+        if delay_ms < 0:
+            self.rejected += 1
+            return False
+        if delay_ms:
+            await asyncio.sleep(delay_ms / 1000)
+        return True
+
+    async def _lookup(self, cell: str, lat: float, lon: float):
+        try:
+            if not await self._wait_for_slot():
+                logger.warning(f"Черга геокодування переповнена, клітинку {cell} пропущено")
+                return None
+            self.requests += 1
+            address = await fetch_address(lat, lon)
+        except Exception as e:
+            logger.error(f"Помилка отримання адреси: {e}")
+            return None
+
+        await self.cache.set(cell, address)
+        return address
+
+    def lookup(self, cell: str, lat: float, lon: float) -> asyncio.Task:
+        task = self._inflight.get(cell)
+        if task is not None:
+            self.merged += 1
+            return task
+
+        task = asyncio.create_task(self._lookup(cell, lat, lon))
+        self._inflight[cell] = task
+        task.add_done_callback(lambda _: self._inflight.pop(cell, None))
+        return task
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "merged": self.merged,
+            "rejected": self.rejected,
+            "deferred": self.deferred,
+            "inflight": len(self._inflight),
+        }
+
+geocode_scheduler = GeocodeScheduler(redis_client, geocode_cache)
+
+async def deliver_late_address(task: asyncio.Task, on_late):
+    address = await task
+    if address:
+        await on_late(address)
+
+async def get_address_from_coords(lat: float, lon: float, on_late=None):
+    """Отримати адресу за координатами за допомогою Nominatim API.
+
+    Якщо адреса не готова за GEOCODE_WAIT_BUDGET секунд, повертає None, а запит продовжується
+    у фоні; коли адреса знайдеться, буде викликано корутину on_late(address)."""
+    if not GEOCODING_API_KEY:
+        logger.warning("GEOCODING_API_KEY не встановлено")
+        return None
+
+    cell = geohash_encode(lat, lon)
+    found, address = await geocode_cache.get(cell)
+    if found:
+        return address
+
+    task = geocode_scheduler.lookup(cell, lat, lon)
+    try:
+        with trace_span("geocode"):
+            return await asyncio.wait_for(asyncio.shield(task), GEOCODE_WAIT_BUDGET)
+    except asyncio.TimeoutError:
+        geocode_scheduler.deferred += 1
+        if on_late is not None:
+            spawn(deliver_late_address(task, on_late))
+        return None
+
+# ==================== ЗОНИ ДОСТАВКИ ====================
+EARTH_RADIUS_KM = 6371.0
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Відстань по великому колу (формула гаверсинуса)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+@dataclass
+class ZoneQuote:
+    zone: str
+    distance: float  # Км від хабу зони
+    fee: float
+
+@dataclass
+class Zone:
+    name: str
+    polygons: list  # Полігони зони; полігон - список кілець (lon, lat), перше зовнішнє, решта - дірки
+    hub_lat: float
+    hub_lon: float
+    base_fee: float
+    fee_per_km: float
+
+    @classmethod
+    def from_feature(cls, feature: dict) -> "Zone":
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        polygons = [[[(float(x), float(y)) for x, y, *_ in ring] for ring in polygon] for polygon in polygons]
+        properties = feature.get("properties") or {}
+        if properties.get("hub"):
+            hub_lon, hub_lat = properties["hub"]
+        else:
+            # Без хабу відстань рахуємо від середини зовнішнього кільця першого полігону
+            ring = polygons[0][0]
+            hub_lon = sum(x for x, _ in ring) / len(ring)
+            hub_lat = sum(y for _, y in ring) / len(ring)
+        return cls(
+            name=str(properties.get("name", "—")),
+            polygons=polygons,
+            hub_lat=float(hub_lat),
+            hub_lon=float(hub_lon),
+            base_fee=float(properties.get("fee", 0)),
+            fee_per_km=float(properties.get("fee_per_km", 0)),
+        )
+
+    def rings(self):
+        for polygon in self.polygons:
+            yield from polygon
+
+    def bbox(self) -> tuple:
+        xs = [x for ring in self.rings() for x, _ in ring]
+        ys = [y for ring in self.rings() for _, y in ring]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def contains(self, lon: float, lat: float) -> bool:
+        # Ray casting з правилом парності по всіх кільцях полігону - дірки враховуються самі собою
+        for polygon in self.polygons:
+            inside = False
+            for ring in polygon:
+                x1, y1 = ring[-1]
+                for x2, y2 in ring:
+                    if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                        inside = not inside
+                    x1, y1 = x2, y2
+            if inside:
+                return True
+        return False
+
+    def quote(self, lat: float, lon: float) -> ZoneQuote:
+        distance = distance_km(self.hub_lat, self.hub_lon, lat, lon)
+        return ZoneQuote(self.name, round(distance, 2), float(round(self.base_fee + self.fee_per_km * distance)))
+
+class ZoneIndex:
+    """Сітковий індекс зон. Для кожної клітинки заздалегідь відомо, які зони її покривають повністю
+    (відповідь без жодних обчислень) і які лише перетинають межею (точна перевірка ray casting).
+    Якщо зони перекриваються, перемагає та, що раніше у файлі."""
+
+    def __init__(self, zones: list, step: float = ZONES_GRID_STEP):
+        self.zones = zones
+        self.step = step
+        self.cells = {}  # (x, y) -> [(номер зони, чи потрібна точна перевірка), ...]
+        for number, zone in enumerate(zones):
+            self._index(number, zone)
+
+    @classmethod
+    def from_geojson(cls, data: dict, step: float = ZONES_GRID_STEP) -> "ZoneIndex":
+        features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+        zones = [
+            Zone.from_feature(feature) for feature in features
+            if (feature.get("geometry") or {}).get("type") in ("Polygon", "MultiPolygon")
+        ]
+        return cls(zones, step)
+
+    def cell(self, lon: float, lat: float) -> tuple:
+        return math.floor(lon / self.step), math.floor(lat / self.step)
+
+    def _index(self, number: int, zone: Zone):
+        # Клітинки, через які проходить межа (з запасом - за рамкою кожного ребра)
+        boundary = set()
+        for ring in zone.rings():
+            x1, y1 = ring[-1]
+            for x2, y2 in ring:
+                cx1, cy1 = self.cell(min(x1, x2), min(y1, y2))
+                cx2, cy2 = self.cell(max(x1, x2), max(y1, y2))
+                for cx in range(cx1, cx2 + 1):
+                    for cy in range(cy1, cy2 + 1):
+                        boundary.add((cx, cy))
+                x1, y1 = x2, y2
+
+        min_x, min_y, max_x, max_y = zone.bbox()
+        cx1, cy1 = self.cell(min_x, min_y)
+        cx2, cy2 = self.cell(max_x, max_y)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                if (cx, cy) in boundary:
+                    self.cells.setdefault((cx, cy), []).append((number, True))
+                elif zone.contains((cx + 0.5) * self.step, (cy + 0.5) * self.step):
+                    # Межа клітинку не перетинає - вся вона там само, де й її центр
+                    self.cells.setdefault((cx, cy), []).append((number, False))
+
+    def lookup(self, lat: float, lon: float):
+        for number, exact in self.cells.get(self.cell(lon, lat), ()):
+            zone = self.zones[number]
+            if not exact or zone.contains(lon, lat):
+                return zone.quote(lat, lon)
+        return None
+
+    def lookup_many(self, points: list) -> list:
+        """Пакетний пошук для списку (lat, lon): точки групуються за клітинками, і для клітинок,
+        повністю покритих зоною, зона визначається один раз на всю групу"""
+        result = [None] * len(points)
+        groups = {}
+        for position, (lat, lon) in enumerate(points):
+            groups.setdefault(self.cell(lon, lat), []).append(position)
+        for cell, positions in groups.items():
+            # Зони клітинки - у порядку пріоритету: точки, які не забрала зона з межею в клітинці,
+            # дістаються першій зоні, що покриває клітинку повністю
+            for number, exact in self.cells.get(cell, ()):
+                zone = self.zones[number]
+                if not exact:
+                    for position in positions:
+                        result[position] = zone.quote(*points[position])
+                    break
+                remaining = []
+                for position in positions:
+                    lat, lon = points[position]
+                    if zone.contains(lon, lat):
+                        result[position] = zone.quote(lat, lon)
+                    else:
+                        remaining.append(position)
+                positions = remaining
+                if not positions:
+                    break
+        return result
+
+class DeliveryZones:
+    """Зони з ZONES_FILE. Фоновий цикл кожні check_interval секунд перевіряє mtime файлу і,
+    якщо той змінився, будує новий індекс в окремому потоці; якщо новий файл зіпсований,
+    працюємо далі зі старим індексом. Пошук лише читає готовий індекс."""
+
+    def __init__(self, path: str = ZONES_FILE, step: float = ZONES_GRID_STEP,
+                 check_interval: float = ZONES_CHECK_INTERVAL):
+        self.path = path
+        self.step = step
+        self.check_interval = check_interval
+        self.index = None
+        self.mtime = None
+        self.reload_handlers = []
+        self._task = None
+
+    def on_reload(self, handler):
+        """Декоратор: handler() викликається після перечитування зміненого файлу"""
+        self.reload_handlers.append(handler)
+        return handler
+
+    def current(self):
+        return self.index
+
+    def load(self) -> ZoneIndex:
+        with open(self.path, encoding="utf-8") as f:
+            return ZoneIndex.from_geojson(json.load(f), self.step)
+
+    async def check(self):
+        """Перебудовує індекс, якщо файл змінився; розбір і побудова - поза циклом подій"""
+        if not self.path:
+            return
+        try:
+            mtime = (await asyncio.to_thread(os.stat, self.path)).st_mtime
+        except OSError as e:
+            logger.error(f"Файл зон {self.path} недоступний: {e}")
+            return
+        if mtime == self.mtime:
+            return
+
+        started = time.perf_counter()
+        try:
+            index = await asyncio.to_thread(self.load)
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+            # Той самий зіпсований файл не перечитуємо, доки його не змінять
+            self.mtime = mtime
+            logger.error(f"Не вдалося завантажити зони з {self.path}: {e}")
+            return
+        reloaded = self.index is not None
+        self.index = index
+        self.mtime = mtime
+        logger.info(
+            f"Зони доставки: {len(index.zones)} з {self.path}, {len(index.cells)} клітинок індексу "
+            f"за {(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+        if reloaded:
+            for handler in self.reload_handlers:
+                handler()
+
+    def lookup(self, lat: float, lon: float):
+        index = self.index
+        return index.lookup(lat, lon) if index else None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Помилка перевірки файлу зон: {e}")
+
+    def start_loop(self):
+        if self.path:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+delivery_zones = DeliveryZones()
+
+# ==================== ПРОМОКОДИ ====================
+class BloomFilter:
+    """Фільтр Блума: "ні" - точно немає, "так" - можливо є (з імовірністю помилки error_rate)"""
+
+    def __init__(self, capacity: int, error_rate: float = PROMO_BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        # Подвійне хешування: k позицій з двох 64-бітних половин одного blake2b
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+PROMO_PERCENT = "percent"
+PROMO_FIXED = "fixed"
+
+# Перевірка й погашення промокоду одним зверненням; при ARGV[3] == '0' лише перевірка.
+# KEYS: промокод, лічильники клієнтів; ARGV: id клієнта, час, чи погашати
+# Повертає {1, знижка, тип} або {код помилки}: -1 немає, -2 ще не діє, -3 минув, -4 вичерпано, -5 вже використано
+PROMO_REDEEM_SCRIPT = """
+local promo = redis.call('HMGET', KEYS[1], 'discount', 'kind', 'max_uses', 'per_user', 'starts_at', 'expires_at', 'used')
+if not promo[1] then
+    return {-1}
+end
+local now = tonumber(ARGV[2])
+if tonumber(promo[5] or 0) > now then
+    return {-2}
+end
+local expires_at = tonumber(promo[6] or 0)
+if expires_at > 0 and expires_at <= now then
+    return {-3}
+end
+local max_uses = tonumber(promo[3] or 0)
+if max_uses > 0 and tonumber(promo[7] or 0) >= max_uses then
+    return {-4}
+end
+local per_user = tonumber(promo[4] or 0)
+if per_user > 0 and tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0) >= per_user then
+    return {-5}
+end
+if ARGV[3] == '1' then
+    redis.call('HINCRBY', KEYS[1], 'used', 1)
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+end
+return {1, promo[1], promo[2]}
+"""
+
+PROMO_ERRORS = {
+    -1: "Промокод не знайдено",
+    -2: "Промокод ще не діє",
+    -3: "Термін дії промокоду минув",
+    -4: "Промокод вичерпано",
+    -5: "Ви вже використали цей промокод",
+}
+PROMO_RESULTS = {-1: "not_found", -2: "not_started", -3: "expired", -4: "exhausted", -5: "used"}
+
+@dataclass
+class Promo:
+    code: str
+    kind: str
+    discount: float
+
+    @property
+    def label(self) -> str:
+        return f"-{self.discount:g}%" if self.kind == PROMO_PERCENT else f"-{self.discount:g} грн"
+
+    def apply(self, fee: float):
+        """Знижка в гривнях з вартості доставки; None, якщо вартість ще невідома"""
+        if fee is None:
+            return None
+        amount = fee * self.discount / 100 if self.kind == PROMO_PERCENT else self.discount
+        return float(round(min(amount, fee)))
+
+def normalize_promo_code(text: str):
+    code = text.strip().upper()
+    if 3 <= len(code) <= 32 and code.replace("-", "").replace("_", "").isalnum():
+        return code
+    return None
+
+class PromoStore:
+    """Промокоди в Redis: хеш promo:{CODE}, лічильники клієнтів promo:{CODE}:users і множина promo:codes.
+
+    Множина кодів кешується у процесі фільтром Блума й оновлюється раз на refresh_interval, тож
+    вигадані чи помилково набрані коди відсіюються без звернення до Redis."""
+
+    def __init__(self, redis: Redis, prefix: str = "promo", refresh_interval: float = PROMO_REFRESH_INTERVAL):
+        self.redis = redis
+        self.prefix = prefix
+        self.refresh_interval = refresh_interval
+        self.redeem_script = redis.register_script(PROMO_REDEEM_SCRIPT)
+        self._bloom = None
+        self._loaded_at = 0.0
+        self._refreshing = asyncio.Lock()
+
+    def key(self, code: str) -> str:
+        return f"{self.prefix}:{code}"
+
+    def users_key(self, code: str) -> str:
+        return f"{self.prefix}:{code}:users"
+
+    @property
+    def codes_key(self) -> str:
+        return f"{self.prefix}:codes"
+
+    async def refresh(self):
+        codes = [code.decode() async for code in self.redis.sscan_iter(self.codes_key, count=1000)]
+        bloom = BloomFilter(len(codes) * 2)  # Із запасом на коди, додані до наступного оновлення
+        for code in codes:
+            bloom.add(code)
+        self._bloom = bloom
+        self._loaded_at = time.monotonic()
+
+    async def might_exist(self, code: str) -> bool:
+        # Фільтр перебудовує одна корутина; решта тим часом користуються старим
+        if time.monotonic() - self._loaded_at > self.refresh_interval and not self._refreshing.locked():
+            async with self._refreshing:
+                try:
+                    await self.refresh()
+                except RedisError as e:
+                    # Зі старим фільтром або зовсім без нього - тоді вирішить Redis
+                    logger.error(f"Не вдалося оновити список промокодів: {e}")
+                    self._loaded_at = time.monotonic()
+        return self._bloom is None or code in self._bloom
+
+    async def _run(self, code: str, user_id: int, redeem: bool):
+        if not await self.might_exist(code):
+            PROMO_CHECKS.labels("bloom_reject").inc()
+            return None, PROMO_ERRORS[-1]
+        result = await self.redeem_script(
+            keys=[self.key(code), self.users_key(code)], args=[user_id, time.time(), int(redeem)]
+        )
+        if result[0] != 1:
+            PROMO_CHECKS.labels(PROMO_RESULTS[result[0]]).inc()
+            return None, PROMO_ERRORS[result[0]]
+        PROMO_CHECKS.labels("redeemed" if redeem else "valid").inc()
+        return Promo(code, result[2].decode(), float(result[1])), None
+
+    async def check(self, code: str, user_id: int):
+        """(Promo, None) або (None, причина відмови); нічого не списує"""
+        return await self._run(code, user_id, redeem=False)
+
+    async def redeem(self, code: str, user_id: int):
+        """Як check, але атомарно списує використання коду"""
+        return await self._run(code, user_id, redeem=True)
+
+    async def release(self, code: str, user_id: int):
+        """Повертає використання, якщо замовлення так і не створилось"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(self.key(code), "used", -1)
+            pipe.hincrby(self.users_key(code), user_id, -1)
+            await pipe.execute()
+
+    async def add(self, code: str, kind: str, discount: float, max_uses: int = 0, per_user: int = 1,
+                  starts_at: float = 0, expires_at: float = 0):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.key(code), mapping={
+                "discount": discount, "kind": kind, "max_uses": max_uses, "per_user": per_user,
+                "starts_at": starts_at, "expires_at": expires_at,
+            })
+            pipe.hsetnx(self.key(code), "used", 0)  # Зміна умов коду не обнуляє використання
+            pipe.sadd(self.codes_key, code)
+            await pipe.execute()
+        if self._bloom is not None:
+            self._bloom.add(code)
+
+    async def remove(self, code: str) -> bool:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key(code), self.users_key(code))
+            pipe.srem(self.codes_key, code)
+            deleted, _ = await pipe.execute()
+        return bool(deleted)
+
+promos = PromoStore(redis_client)
+
+# ==================== ЗАМОВЛЕННЯ ====================
+ORDER_NEW = "new"
+ORDER_ACCEPTED = "accepted"
+ORDER_DELIVERED = "delivered"
+
+def parse_maps_location(text: str):
+    """Координати з посилання виду https://maps.google.com/?q=lat,lon (перше в тексті) або None"""
+    try:
+        query = text.split("?q=", 1)[1].split()[0]
+        lat, lon = query.split(",", 1)
+        return float(lat), float(lon)
+    except (IndexError, ValueError):
+        return None
+
+@dataclass
+class Order:
+    id: int
+    user_id: int
+    status: str = ORDER_NEW
+    created_at: float = 0.0
+    name: str = "—"
+    phone: str = "—"
+    items: list = field(default_factory=list)
+    photos: list = field(default_factory=list)
+    delivery_type: str = "—"
+    pickup_address: str = "—"
+    delivery_address: str = "—"
+    delivery_location: str = "—"  # Посилання на мапу у старому форматі; нові замовлення мають координати
+    delivery_lat: float = None
+    delivery_lon: float = None
+    delivery_zone: str = None
+    delivery_distance: float = None
+    delivery_fee: float = None
+    delivery_time: str = "—"
+    payment: str = "—"
+    change_from: str = "—"
+    promo_code: str = None
+    promo_discount: str = None  # Підпис знижки, наприклад "-20%"
+    promo_kind: str = None  # Умови коду на момент погашення - щоб перерахувати знижку
+    promo_value: float = None  # разом із вартістю доставки
+    discount_amount: float = None  # Знижка з вартості доставки, грн
+    admin_message_id: int = None
+    courier_id: int = None
+
+    def __post_init__(self):
+        # Сесії та замовлення до появи координат зберігали лише текст із посиланнями на мапи
+        if self.delivery_lat is None and "?q=" in self.delivery_location:
+            coords = parse_maps_location(self.delivery_location)
+            if coords:
+                self.delivery_lat, self.delivery_lon = coords
+                self.delivery_location = "—"
+
+    @classmethod
+    def from_state(cls, data: dict, user_id: int) -> "Order":
+        item_text = data.get("item_text", "").strip()
+        return cls(
+            id=0,
+            user_id=user_id,
+            created_at=time.time(),
+            name=data.get("name", "—"),
+            phone=data.get("phone", "—"),
+            items=[line.strip() for line in item_text.split("\n") if line.strip()],
+            photos=list(data.get("item_photos", [])),
+            delivery_type=data.get("delivery_type", "—"),
+            pickup_address=data.get("pickup_address", "—"),
+            delivery_address=data.get("delivery_address", "—"),
+            delivery_location=data.get("delivery_location", "—"),
+            delivery_lat=data.get("delivery_lat"),
+            delivery_lon=data.get("delivery_lon"),
+            delivery_zone=data.get("delivery_zone"),
+            delivery_distance=data.get("delivery_distance"),
+            delivery_fee=data.get("delivery_fee"),
+            delivery_time=data.get("delivery_time", "—"),
+            payment=data.get("payment", "—"),
+            change_from=data.get("change_from", "—"),
+            promo_code=data.get("promo_code"),
+            promo_discount=data.get("promo_discount"),
+            discount_amount=data.get("discount_amount")
+        )
+
+    def to_redis(self) -> dict:
+        record = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if value is None:
+                continue
+            record[f.name] = json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value
+        return record
+
+    @classmethod
+    def from_redis(cls, record: dict) -> "Order":
+        values = {}
+        for f in fields(cls):
+            raw = record.get(f.name.encode())
+            if raw is None:
+                continue
+            raw = raw.decode()
+            if f.type is list:
+                values[f.name] = json.loads(raw)
+            elif f.type is int:
+                values[f.name] = int(raw)
+            elif f.type is float:
+                values[f.name] = float(raw)
+            else:
+                values[f.name] = raw
+        return cls(**values)
+
+# Атомарна зміна статусу: 1 - змінено, 0 - замовлення вже не в статусі ARGV[1]
+ORDER_STATUS_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'status') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2], ARGV[2] .. '_at', ARGV[4])
+redis.call('ZREM', KEYS[2], ARGV[3])
+redis.call('ZADD', KEYS[3], ARGV[4], ARGV[3])
+return 1
+"""
+
+# Створення замовлення одним зверненням до Redis: номер, запис, індекси та подія order_created.
+# KEYS: лічильник, індекс за часом, індекс клієнта, індекс статусу, потік подій, лічильник замовлень за годину
+# ARGV: префікс ключів, час створення, maxlen потоку, термін годинного лічильника, далі пари поле/значення
+ORDER_CREATE_SCRIPT = """
+local order_id = redis.call('INCR', KEYS[1])
+redis.call('HSET', ARGV[1] .. ':' .. order_id, 'id', order_id, unpack(ARGV, 5))
+redis.call('ZADD', KEYS[2], ARGV[2], order_id)
+redis.call('ZADD', KEYS[3], ARGV[2], order_id)
+redis.call('ZADD', KEYS[4], ARGV[2], order_id)
+redis.call('XADD', KEYS[5], 'MAXLEN', '~', ARGV[3], '*', 'type', 'order_created', 'order_id', order_id)
+redis.call('INCR', KEYS[6])
+redis.call('EXPIRE', KEYS[6], ARGV[4])
+return order_id
+"""
+
+class OrderStore:
+    """Замовлення в Redis: хеш order:{id} та індекси (sorted set за часом) за статусом, клієнтом і часом"""
+
+    def __init__(self, redis: Redis, prefix: str = "order", stream: str = "orders:events"):
+        self.redis = redis
+        self.prefix = prefix
+        self.stream = stream
+        self.create_order = redis.register_script(ORDER_CREATE_SCRIPT)
+        self.change_status = redis.register_script(ORDER_STATUS_SCRIPT)
+
+    def key(self, order_id: int) -> str:
+        return f"{self.prefix}:{order_id}"
+
+    def status_key(self, status: str) -> str:
+        return f"{self.prefix}s:status:{status}"
+
+    def user_key(self, user_id: int) -> str:
+        return f"{self.prefix}s:user:{user_id}"
+
+    @property
+    def time_key(self) -> str:
+        return f"{self.prefix}s:by_time"
+
+    async def create(self, order: Order) -> Order:
+        """Зберігає замовлення і публікує подію order_created; номери видає INCR - монотонні й унікальні"""
+        record = order.to_redis()
+        record.pop("id")
+        args = [self.prefix, order.created_at, ORDER_STREAM_MAXLEN, live_stats.retention]
+        for name, value in record.items():
+            args += [name, value]
+        order.id = await self.create_order(
+            keys=[
+                f"{self.prefix}:seq",
+                self.time_key,
+                self.user_key(order.user_id),
+                self.status_key(order.status),
+                self.stream,
+                live_stats.orders_key(order.created_at)
+            ],
+            args=args
+        )
+        return order
+
+    async def get(self, order_id: int):
+        record = await self.redis.hgetall(self.key(order_id))
+        return Order.from_redis(record) if record else None
+
+    async def update(self, order_id: int, **values):
+        await self.redis.hset(self.key(order_id), mapping=values)
+
+    async def set_status(self, order_id: int, old: str, new: str) -> bool:
+        changed = await self.change_status(
+            keys=[self.key(order_id), self.status_key(old), self.status_key(new)],
+            args=[old, new, order_id, time.time()]
+        )
+        return bool(changed)
+
+    async def ids_by_status(self, status: str, limit: int = 50) -> list:
+        return [int(order_id) for order_id in await self.redis.zrevrange(self.status_key(status), 0, limit - 1)]
+
+    async def ids_by_user(self, user_id: int, limit: int = 50) -> list:
+        return [int(order_id) for order_id in await self.redis.zrevrange(self.user_key(user_id), 0, limit - 1)]
+
+    async def ids_between(self, start: float, end: float) -> list:
+        return [int(order_id) for order_id in await self.redis.zrangebyscore(self.time_key, start, end)]
+
+orders = OrderStore(redis_client)
+
+async def reprice_open_orders(batch: int = 500) -> tuple:
+    """Перераховує зону й вартість доставки нових замовлень з координатами за поточним файлом зон.
+    Повертає (кількість змінених, кількість тих, що тепер поза зонами)"""
+    index = delivery_zones.current()
+    if index is None:
+        return 0, 0
+
+    order_ids = await orders.ids_by_status(ORDER_NEW, limit=1_000_000)
+    changed = outside = 0
+    for start in range(0, len(order_ids), batch):
+        chunk = order_ids[start:start + batch]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for order_id in chunk:
+                pipe.hmget(orders.key(order_id), "delivery_lat", "delivery_lon", "delivery_zone", "delivery_fee",
+                           "promo_kind", "promo_value", "discount_amount")
+            rows = await pipe.execute()
+
+        located = [(order_id, row) for order_id, row in zip(chunk, rows) if row[0] is not None and row[1] is not None]
+        quotes = index.lookup_many([(float(row[0]), float(row[1])) for _, row in located])
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (order_id, (_, _, zone, fee, promo_kind, promo_value, discount)), quote in zip(located, quotes):
+                if quote is None:
+                    outside += 1
+                    if zone is not None:
+                        pipe.hdel(orders.key(order_id), "delivery_zone", "delivery_distance", "delivery_fee",
+                                  "discount_amount")
+                elif zone is None or zone.decode() != quote.zone or float(fee) != quote.fee:
+                    changed += 1
+                    values = {"delivery_zone": quote.zone, "delivery_distance": quote.distance, "delivery_fee": quote.fee}
+                    if promo_kind is not None:
+                        promo = Promo(None, promo_kind.decode(), float(promo_value))
+                        values["discount_amount"] = promo.apply(quote.fee)
+                    elif discount is not None:
+                        # Замовлення до появи promo_kind: знижка не може перевищити нову вартість
+                        values["discount_amount"] = min(float(discount), quote.fee)
+                    pipe.hset(orders.key(order_id), mapping=values)
+            await pipe.execute()
+
+    logger.info(f"Перерахунок доставки: {len(order_ids)} нових замовлень, змінено {changed}, поза зонами {outside}")
+    return changed, outside
+
+class StreamWorkers:
+    """Пул споживачів потоку подій у групі Redis Streams.
+
+    Подія підтверджується (XACK) лише після успішної обробки; події, що зависли у впалого
+    процесу довше за claim_idle секунд, забирає інший споживач, а після max_deliveries спроб
+    подію відкидаємо з записом у лог."""
+
+    def __init__(self, redis: Redis, stream: str, group: str, workers: int = ORDER_WORKERS,
+                 claim_idle: int = ORDER_CLAIM_IDLE, max_deliveries: int = ORDER_MAX_DELIVERIES):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.workers = workers
+        self.claim_idle_ms = claim_idle * 1000
+        self.max_deliveries = max_deliveries
+        self.consumer_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        self.handlers = {}  # тип події -> корутина(payload)
+        self._tasks = []
+        self._stopping = False
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.busy = 0  # Пачки подій, що зараз обробляються
+
+    def on(self, event_type: str):
+        def register(handler):
+            self.handlers[event_type] = handler
+            return handler
+        return register
+
+    async def start(self):
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except RedisError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._consume(f"{self.consumer_prefix}-{i}"))
+            for i in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._reclaim(f"{self.consumer_prefix}-reclaim")))
+
+    async def stop(self, timeout: float = 0):
+        """Зупиняє читання; пачки, що вже обробляються, отримують до timeout секунд на завершення.
+        Непідтверджені події залишаються в pending і дістануться іншому процесу"""
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        while self.busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _process(self, entry_id, payload: dict):
+        event_type = payload.get(b"type", b"").decode()
+        handler = self.handlers.get(event_type)
+        try:
+            if handler is not None:
+                await handler(payload)
+        except Exception as e:
+            # Без XACK подія залишиться в pending і буде оброблена повторно
+            self.failed += 1
+            logger.error(f"Помилка обробки події {event_type} {entry_id}: {e}")
+            return
+        await self.redis.xack(self.stream, self.group, entry_id)
+        self.processed += 1
+
+    async def _consume(self, consumer: str):
+        while not self._stopping:
+            try:
+                response = await self.redis.xreadgroup(
+                    self.group, consumer, {self.stream: ">"}, count=10, block=5000
+                )
+                self.busy += 1
+                try:
+                    for _, entries in response or []:
+                        for entry_id, payload in entries:
+                            await self._process(entry_id, payload)
+                finally:
+                    self.busy -= 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Помилка читання потоку {self.stream}: {e}")
+                await asyncio.sleep(1)
+
+    async def _reclaim(self, consumer: str):
+        while not self._stopping:
+            await asyncio.sleep(self.claim_idle_ms / 2000)
+            try:
+                pending = await self.redis.xpending_range(
+                    self.stream, self.group, "-", "+", 100, idle=self.claim_idle_ms
+                )
+                for entry in pending:
+                    entry_id = entry["message_id"]
+                    if entry["times_delivered"] >= self.max_deliveries:
+                        self.dropped += 1
+                        logger.error(f"Подію {entry_id} з {self.stream} відкинуто після {self.max_deliveries} спроб")
+                        await self.redis.xack(self.stream, self.group, entry_id)
+                        continue
+                    # XCLAIM з min_idle_time гарантує, що подію забере лише один споживач
+                    claimed = await self.redis.xclaim(
+                        self.stream, self.group, consumer, self.claim_idle_ms, [entry_id]
+                    )
+                    self.busy += 1
+                    try:
+                        for claimed_id, payload in claimed:
+                            if payload:
+                                await self._process(claimed_id, payload)
+                    finally:
+                        self.busy -= 1
+                await self._forget_idle_consumers()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Помилка повторної обробки подій {self.stream}: {e}")
+
+    async def _forget_idle_consumers(self):
+        # Споживачі зупинених процесів без незавершених подій більше не потрібні
+        for consumer in await self.redis.xinfo_consumers(self.stream, self.group):
+            name = consumer["name"]
+            name = name.decode() if isinstance(name, bytes) else name
+            if consumer["pending"] == 0 and consumer["idle"] > 3600 * 1000 and not name.startswith(self.consumer_prefix):
+                await self.redis.xgroup_delconsumer(self.stream, self.group, name)
+
+    def stats(self) -> dict:
+        return {
+            "tasks": len(self._tasks),
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+order_workers = StreamWorkers(redis_client, orders.stream, "fanout")
+
+# ==================== ВІДОБРАЖЕННЯ ЗАМОВЛЕНЬ ====================
+ORDER_VIEW_REVIEW = "review"
+ORDER_VIEW_ADMIN = "admin"
+ORDER_VIEW_COURIER = "courier"
+
+# Шаблони збираються один раз; рендер лише підставляє поля замовлення
+ORDER_HEADERS = {
+    ORDER_VIEW_REVIEW: "📋 <b>ПЕРЕВІРТЕ ВАШЕ ЗАМОВЛЕННЯ:</b>\n\n👤 Ім'я: {name}\n📱 Телефон: {phone}\n",
+    ORDER_VIEW_ADMIN: "🆕 <b>НОВЕ ЗАМОВЛЕННЯ #{id}:</b>\n\n👤 Клієнт: {name} (ID: {user_id})\n📱 Телефон: {phone}\n",
+    ORDER_VIEW_COURIER: "🛵 <b>ЗАМОВЛЕННЯ #{id}:</b>\n\n👤 Клієнт: {name}\n📱 Телефон: {phone}\n",
+}
+ORDER_PROMO = "🎟️ Промокод: {}\n"
+ORDER_PROMO_DISCOUNT = "🎟️ Промокод: {} ({} на доставку)\n"
+ORDER_DELIVERY = (
+    "📦 Що доставити:\n{items}\n"
+    "🚛 Тип: {delivery_type}\n"
+    "🏠 Адреса відправлення: {pickup_address}\n"
+    "📍 Адреса доставки: {delivery_address}\n"
+)
+ORDER_MAP_LINKS = (
+    "🗺️ Переглянути на: <a href='https://maps.google.com/?q={lat},{lon}'>Google Maps</a> | "
+    "<a href='https://maps.apple.com/?q={lat},{lon}'>Apple Maps</a>\n"
+)
+ORDER_MAP_LINK = "🗺️ <a href='{}'>Подивитися на мапі</a>\n"
+ORDER_ZONE = "🧭 Зона: {zone}, {distance:.1f} км\n🚚 Вартість доставки: {fee:.0f} грн\n"
+ORDER_ZONE_DISCOUNT = "🧭 Зона: {zone}, {distance:.1f} км\n🚚 Вартість доставки: <s>{fee:.0f}</s> {total:.0f} грн\n"
+ORDER_PAYMENT = "⏰ Час доставки: {delivery_time}\n💰 Оплата: {payment}\n"
+ORDER_CHANGE = "💲 Решта з: {}\n"
+PAYMENT_CASH = "Готівка 💵"
+
+def render_order(order: Order, view: str = ORDER_VIEW_REVIEW) -> str:
+    """Текст замовлення для клієнта (review), адміна (admin) чи кур'єра (courier); вигляди мають спільну основну частину"""
+    parts = [ORDER_HEADERS[view].format(id=order.id, name=order.name, user_id=order.user_id, phone=order.phone)]
+    if order.promo_discount:
+        parts.append(ORDER_PROMO_DISCOUNT.format(order.promo_code, order.promo_discount))
+    elif order.promo_code:
+        parts.append(ORDER_PROMO.format(order.promo_code))
+    parts.append(ORDER_DELIVERY.format(
+        items="\n".join(["• " + item for item in order.items]) if order.items else "—",
+        delivery_type=order.delivery_type,
+        pickup_address=order.pickup_address,
+        delivery_address=order.delivery_address
+    ))
+    if order.delivery_lat is not None:
+        parts.append(ORDER_MAP_LINKS.format(lat=order.delivery_lat, lon=order.delivery_lon))
+    elif order.delivery_location.startswith("http"):  # Для зворотної сумісності
+        parts.append(ORDER_MAP_LINK.format(order.delivery_location))
+    if order.delivery_fee is not None and order.discount_amount:
+        parts.append(ORDER_ZONE_DISCOUNT.format(
+            zone=order.delivery_zone, distance=order.delivery_distance, fee=order.delivery_fee,
+            total=max(order.delivery_fee - order.discount_amount, 0)
+        ))
+    elif order.delivery_fee is not None:
+        parts.append(ORDER_ZONE.format(zone=order.delivery_zone, distance=order.delivery_distance, fee=order.delivery_fee))
+    parts.append(ORDER_PAYMENT.format(delivery_time=order.delivery_time, payment=order.payment))
+    if order.payment == PAYMENT_CASH:
+        parts.append(ORDER_CHANGE.format(order.change_from))
+    return "".join(parts)
+
+# ==================== ОСНОВНІ КОМАНДИ ====================
+@dp.message(Command("start", "help"))
 async def send_welcome(message: types.Message, state: FSMContext):
-    global BOT_RUNNING
-    if not BOT_RUNNING:
+    if not await pause_switch.is_running():
         await message.answer("⏸️ Бот тимчасово призупинено. Спробуйте пізніше.")
         return
         
@@ -353,13 +2635,13 @@ async def send_welcome(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "check_subscription")
 async def check_subscription_callback(callback: types.CallbackQuery, state: FSMContext):
-    global BOT_RUNNING
-    if not BOT_RUNNING:
+    if not await pause_switch.is_running():
         await callback.message.answer("⏸️ Бот тимчасово призупинено. Спробуйте пізніше.")
         return
         
     try:
-        if await check_subscription(callback.from_user.id):
+        # Користувач щойно натиснув "Я підписався" - негативному кешу не довіряємо
+        if await check_subscription(callback.from_user.id, trust_negative=False):
             await callback.message.delete()
             captcha_text, answer = await generate_captcha()
             await state.update_data(captcha_answer=answer)
@@ -371,6 +2653,16 @@ async def check_subscription_callback(callback: types.CallbackQuery, state: FSMC
         logger.error(f"Error in check_subscription_callback: {e}")
         await callback.answer("❌ Сталася помилка. Спробуйте ще раз.", show_alert=True)
 
+@dp.chat_member()
+async def channel_member_updated(update: types.ChatMemberUpdated):
+    # Вступ і вихід з каналу одразу оновлюють кеш підписки (бот має бути адміністратором каналу)
+    if not is_subscription_channel(update.chat):
+        return
+    await remember_subscription(
+        update.new_chat_member.user.id,
+        update.new_chat_member.status in SUBSCRIBED_STATUSES
+    )
+
 @dp.message(OrderForm.captcha)
 async def check_captcha(message: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -389,8 +2681,7 @@ async def check_captcha(message: types.Message, state: FSMContext):
 
 @dp.message(F.text.contains("нове замовлення"))
 async def new_order(message: types.Message, state: FSMContext):
-    global BOT_RUNNING
-    if not BOT_RUNNING:
+    if not await pause_switch.is_running():
         await message.answer("⏸️ Бот тимчасово призупинено. Спробуйте пізніше.")
         return
         
@@ -427,8 +2718,7 @@ async def get_phone(message: types.Message, state: FSMContext):
         await message.answer("❗ Будь ласка, надішліть номер телефону")
         return
     
-    await state.update_data(phone=escape_html(phone))
-    await state.update_data(item_text="", item_photos=[])
+    await state.update_data(phone=escape_html(phone), item_text="", item_photos=[])
     request_text = "Що потрібно доставити? Надішліть опис, фото або все разом.\nКоли закінчите, натисніть кнопку \"Це все\" внизу."
     await message.answer(request_text, reply_markup=item_input_kb())
     await state.set_state(OrderForm.item)
@@ -510,7 +2800,9 @@ async def get_pickup(message: types.Message, state: FSMContext):
                         reply_markup=builder.as_markup(resize_keyboard=True))
     await state.set_state(OrderForm.delivery_address)
 
-@dp.message(OrderForm.delivery_address_method)
+# Пізня адреса від геокодера пишеться у сховище напряму (fill_address), тому і сам обробник
+# пише одразу, а не після завершення: інакше відкладений запис може затерти уточнену адресу
+@dp.message(OrderForm.delivery_address_method, flags={"fsm_write_through": True})
 async def handle_delivery_address_method(message: types.Message, state: FSMContext):
     if message.text == "Скасувати замовлення":
         await state.clear()
@@ -522,18 +2814,48 @@ async def handle_delivery_address_method(message: types.Message, state: FSMConte
         lat = location.latitude
         lon = location.longitude
         
+        if delivery_zones.path and delivery_zones.index is None:
+            # Файл зон ще не завантажився - без зони не знаємо ні покриття, ні вартості
+            await message.answer(
+                "⏳ Не вдалося визначити зону доставки. Надішліть геолокацію ще раз за хвилину",
+                reply_markup=delivery_address_method_kb()
+            )
+            return
+
+        # Зона - до геокодування: поза зонами адреса вже не потрібна
+        quote = delivery_zones.lookup(lat, lon)
+        if quote is None and delivery_zones.index is not None:
+            await message.answer(
+                "❗ На жаль, ця адреса поза зоною доставки. Надішліть іншу геолокацію або введіть адресу вручну",
+                reply_markup=delivery_address_method_kb()
+            )
+            return
+
+        fallback_text = f"Координати: {lat:.6f}, {lon:.6f}"
+
+        async def fill_address(address: str):
+            # Атомарно змінюємо одне поле і лише якщо клієнт ще не змінив адресу: паралельний
+            # запис наступного кроку форми не затре адресу, а вона - його поля
+            if await merge_fsm_data(state.storage, state.key, {"delivery_address": address},
+                                    expect={"delivery_address": fallback_text}):
+                await message.answer(f"📍 Адресу уточнено: {address}")
+
         # Отримуємо адресу за координатами
-        address_text = await get_address_from_coords(lat, lon)
+        address_text = await get_address_from_coords(lat, lon, on_late=fill_address)
         if not address_text:
-            address_text = f"Координати: {lat:.6f}, {lon:.6f}"
+            address_text = fallback_text
         
-        # Генеруємо посилання для обох карт
-        maps_links = f"Google Maps: https://maps.google.com/?q={lat},{lon}\nApple Maps: https://maps.apple.com/?q={lat},{lon}"
-        await state.update_data(delivery_location=maps_links)
-        await state.update_data(delivery_address=address_text)  # Зберігаємо адресу текстом
+        # Координати зберігаємо окремо - посилання на мапи будує render_order
+        await state.update_data(
+            delivery_lat=lat, delivery_lon=lon, delivery_location="—", delivery_address=address_text,
+            delivery_zone=quote.zone if quote else None,
+            delivery_distance=quote.distance if quote else None,
+            delivery_fee=quote.fee if quote else None
+        )
         
+        zone_text = f"\nЗона: {quote.zone}, доставка {quote.fee:.0f} грн" if quote else ""
         await message.answer(
-            f"Дякуємо! Ваша геолокація збережена.\nАдреса: {address_text}",
+            f"Дякуємо! Ваша геолокація збережена.\nАдреса: {address_text}{zone_text}",
             reply_markup=ReplyKeyboardRemove()
         )
         
@@ -561,8 +2883,10 @@ async def get_delivery_address(message: types.Message, state: FSMContext):
         await message.answer("❗ Адреса занадто коротка. Будь ласка, введіть повну адресу")
         return
         
-    await state.update_data(delivery_address=escape_html(message.text))
-    await state.update_data(delivery_location="—")
+    await state.update_data(
+        delivery_address=escape_html(message.text), delivery_location="—", delivery_lat=None, delivery_lon=None,
+        delivery_zone=None, delivery_distance=None, delivery_fee=None
+    )
     
     request_text = "Оберіть час доставки:"
     await message.answer(request_text, reply_markup=delivery_time_kb())
@@ -606,10 +2930,10 @@ async def get_custom_time(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data.in_({"payment_cash", "payment_cashless"}))
 async def get_payment(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=None)
-    payment = "Готівка 💵" if callback.data == "payment_cash" else "Переказ на карту 💳"
+    payment = PAYMENT_CASH if callback.data == "payment_cash" else "Переказ на карту 💳"
     await state.update_data(payment=payment)
 
-    if payment == "Готівка 💵":
+    if payment == PAYMENT_CASH:
         builder = ReplyKeyboardBuilder()
         builder.add(KeyboardButton(text="Скасувати замовлення"))
         await callback.message.answer("З якої суми потрібна решта? (наприклад, 500 грн)",
@@ -636,54 +2960,14 @@ async def get_change_from(message: types.Message, state: FSMContext):
     await state.set_state(OrderForm.review)
 
 async def show_order_review(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-
-    item_text = data.get("item_text", "").strip()
-    items = [line.strip() for line in item_text.split('\n') if line.strip()]
-    item_photos = data.get("item_photos", [])
-    delivery_type = data.get("delivery_type", "—")
-    pickup_address = data.get("pickup_address", "—")
-    delivery_address = data.get("delivery_address", "—")
-    delivery_location = data.get("delivery_location", "—")
-    delivery_time = data.get("delivery_time", "—")
-    payment = data.get("payment", "—")
-    change_from = data.get("change_from", "—")
-
-    if items:
-        items_text = "\n".join(f"• {item}" for item in items)
-    else:
-        items_text = "—"
-    
-    review_text = (
-        f"📋 <b>ПЕРЕВІРТЕ ВАШЕ ЗАМОВЛЕННЯ:</b>\n\n"
-        f"👤 Ім'я: {data.get('name', '—')}\n"
-        f"📱 Телефон: {data.get('phone', '—')}\n"
-        f"📦 Що доставити:\n{items_text}\n"
-        f"🚛 Тип: {delivery_type}\n"
-        f"🏠 Адреса відправлення: {pickup_address}\n"
-        f"📍 Адреса доставки: {delivery_address}\n"
-    )
-    
-    if delivery_location != "—":
-        if "\n" in delivery_location:  # Якщо є обидва посилання
-            google_link, apple_link = delivery_location.split("\n")
-            review_text += f"🗺️ Переглянути на: <a href='{google_link.split(': ')[1]}'>Google Maps</a> | <a href='{apple_link.split(': ')[1]}'>Apple Maps</a>\n"
-        elif delivery_location.startswith("http"):  # Для зворотної сумісності
-            review_text += f"🗺️ <a href='{delivery_location}'>Подивитися на мапі</a>\n"
-    
-    review_text += (
-        f"⏰ Час доставки: {delivery_time}\n"
-        f"💰 Оплата: {payment}\n"
+    order = Order.from_state(await state.get_data(), state.key.user_id)
+    review_message = await message.answer(
+        render_order(order, ORDER_VIEW_REVIEW), reply_markup=review_kb(), disable_web_page_preview=True
     )
-    
-    if payment == "Готівка 💵":
-        review_text += f"💲 Решта з: {change_from}\n"
 
-    await message.answer(review_text, reply_markup=review_kb(), disable_web_page_preview=True)
-
-    # Відправляємо всі фото окремими повідомленнями
-    for photo_id in item_photos:
-        await message.answer_photo(photo=photo_id)
+    # Фото відправляємо альбомами у відповідь на повідомлення із замовленням
+    if order.photos:
+        await send_photo_album(message.chat.id, order.photos, reply_to_message_id=review_message.message_id)
 
 @dp.callback_query(F.data == "edit_order")
 async def edit_order(callback: types.CallbackQuery, state: FSMContext):
@@ -775,6 +3059,7 @@ async def finish_editing(callback: types.CallbackQuery, state: FSMContext):
 async def enter_promo_code(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=None)
     builder = ReplyKeyboardBuilder()
+    builder.add(KeyboardButton(text="Без промокоду"))
     builder.add(KeyboardButton(text="Скасувати замовлення"))
     await callback.message.answer(
         "Введіть промокод:",
@@ -790,140 +3075,551 @@ async def process_promo_code(message: types.Message, state: FSMContext):
         await message.answer("Замовлення скасовано.", reply_markup=new_order_kb())
         return
         
-    promo_code = message.text.strip()
-    await state.update_data(promo_code=promo_code)
-    
-    # Відправляємо замовлення адміну
-    client_id = message.from_user.id
-    await state.update_data(user_id=client_id)
-    
-    await send_order_to_admin(message, state)
-    await message.answer(
-        f"✅ Дякуємо! Ваше замовлення з промокодом \"{promo_code}\" оформлено. Очікуйте підтвердження.",
-        reply_markup=new_order_kb()
-    )
-    await state.clear()
+    if message.text == "Без промокоду":
+        await state.update_data(promo_code=None, promo_discount=None, discount_amount=None)
+        await message.answer("Гаразд, без промокоду.", reply_markup=ReplyKeyboardRemove())
+        await show_order_review(message, state)
+        await state.set_state(OrderForm.review)
+        return
+
+    # Код лише перевіряємо; списується він атомарно під час надсилання замовлення
+    promo_code = normalize_promo_code(message.text or "")
+    try:
+        promo, error = await promos.check(promo_code, message.from_user.id) if promo_code else (None, PROMO_ERRORS[-1])
+    except RedisError as e:
+        logger.error(f"Не вдалося перевірити промокод {promo_code} клієнта {message.from_user.id}: {e}")
+        await message.answer("❌ Не вдалося перевірити промокод. Спробуйте пізніше або натисніть «Без промокоду».")
+        return
+    if promo is None:
+        await message.answer(f"❌ {error}. Спробуйте інший промокод або натисніть «Без промокоду».")
+        return
+
+    data = await state.get_data()
+    discount_amount = promo.apply(data.get("delivery_fee"))
+    await state.update_data(promo_code=promo.code, promo_discount=promo.label, discount_amount=discount_amount)
+    if discount_amount is not None:
+        discount_text = f"доставка {data['delivery_fee'] - discount_amount:.0f} грн замість {data['delivery_fee']:.0f} грн"
+    else:
+        discount_text = f"знижка {promo.label} на доставку"
+    await message.answer(f"✅ Промокод {promo.code} застосовано: {discount_text}", reply_markup=ReplyKeyboardRemove())
+    await show_order_review(message, state)
+    await state.set_state(OrderForm.review)
 
 @dp.callback_query(F.data == "send_order")
 async def send_order(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(reply_markup=None)
     
-    client_id = callback.from_user.id
-    await state.update_data(user_id=client_id)
-    
-    await send_order_to_admin(callback.message, state)
+    order = await submit_order(callback.message, state, callback.from_user.id)
+    if order is None:
+        await callback.message.edit_reply_markup(reply_markup=review_kb())
+        await callback.answer()
+        return
+
     await callback.message.answer(
-        "Дякуємо! Ваше замовлення оформлено. Очікуйте підтвердження.",
+        f"Дякуємо! Ваше замовлення #{order.id} оформлено. Очікуйте підтвердження.",
         reply_markup=new_order_kb()
     )
     await state.clear()
     await callback.answer()
 
-async def send_order_to_admin(message: types.Message, state: FSMContext):
+async def submit_order(message: types.Message, state: FSMContext, user_id: int):
+    """Зберігає замовлення зі стану форми; адміна сповіщають фонові обробники потоку замовлень.
+    Повертає None, якщо зберегти не вдалося."""
     data = await state.get_data()
-    
-    order_id = str(int(time.time()))[-6:]
-    user_id = data.get('user_id')
-    
-    if not user_id:
-        logger.error("Не знайдено user_id у стані")
-        await message.answer("❌ Помилка: не вдалося ідентифікувати клієнта")
-        return
+    order = Order.from_state(data, user_id)
 
-    item_text = data.get('item_text', '').strip()
-    items = [line.strip() for line in item_text.split('\n') if line.strip()]
-    item_photos = data.get('item_photos', [])
-    
-    if items:
-        items_text = "\n".join(f"• {item}" for item in items)
-    else:
-        items_text = "—"
-
-    delivery_type = data.get('delivery_type', '—')
-    pickup_address = data.get('pickup_address', '—')
-    delivery_address = data.get('delivery_address', '—')  # Текстова адреса
-    delivery_location = data.get('delivery_location', '—')
-    delivery_time = data.get('delivery_time', '—')
-    payment = data.get('payment', '—')
-    change_from = data.get('change_from', '—')
-    promo_code = data.get('promo_code', None)
-
-    order_message = (
-        f"🆕 <b>НОВЕ ЗАМОВЛЕННЯ #{order_id}:</b>\n\n"
-        f"👤 Клієнт: {data.get('name', '—')} (ID: {user_id})\n"
-        f"📱 Телефон: {data.get('phone', '—')}\n"
-    )
-    
-    if promo_code:
-        order_message += f"🎟️ Промокод: {promo_code}\n"
-    
-    order_message += (
-        f"📦 Що доставити:\n{items_text}\n"
-        f"🚛 Тип: {delivery_type}\n"
-        f"🏠 Адреса відправлення: {pickup_address}\n"
-        f"📍 Адреса доставки: {delivery_address}\n"  # Текстова адреса
-    )
-    
-    if delivery_location != "—":
-        if "\n" in delivery_location:  # Якщо є обидва посилання
-            google_link, apple_link = delivery_location.split("\n")
-            order_message += f"🗺️ Переглянути на: <a href='{google_link.split(': ')[1]}'>Google Maps</a> | <a href='{apple_link.split(': ')[1]}'>Apple Maps</a>\n"
-        elif delivery_location.startswith("http"):  # Для зворотної сумісності
-            order_message += f"🗺️ <a href='{delivery_location}'>Подивитися на мапі</a>\n"
-    
-    order_message += (
-        f"⏰ Час доставки: {delivery_time}\n"
-        f"💰 Оплата: {payment}\n"
-    )
-    
-    if payment == "Готівка 💵":
-        order_message += f"💲 Решта з: {change_from}\n"
+    if order.promo_code:
+        # Умови коду могли змінитися після перевірки - знижку рахуємо за результатом погашення
+        try:
+            promo, error = await promos.redeem(order.promo_code, user_id)
+        except RedisError as e:
+            logger.error(f"Не вдалося погасити промокод {order.promo_code} клієнта {user_id}: {e}")
+            await message.answer("❌ Не вдалося оформити замовлення. Спробуйте ще раз.")
+            return None
+        if promo is None:
+            await state.update_data(promo_code=None, promo_discount=None, discount_amount=None)
+            await message.answer(f"❌ {error}. Промокод прибрано - перевірте замовлення і надішліть його ще раз.")
+            return None
+        order.promo_discount = promo.label
+        order.promo_kind, order.promo_value = promo.kind, promo.discount
+        order.discount_amount = promo.apply(order.delivery_fee)
 
     try:
+        await orders.create(order)
+    except RedisError as e:
+        logger.error(f"Не вдалося зберегти замовлення клієнта {user_id}: {e}")
+        if order.promo_code:
+            with contextlib.suppress(RedisError):
+                await promos.release(order.promo_code, user_id)
+        await message.answer("❌ Не вдалося оформити замовлення. Спробуйте ще раз.")
+        return None
+
+    return order
+
+async def send_order_to_admin(order: Order):
+    with outbound_priority(PRIORITY_ORDER):
         msg = await bot.send_message(
             chat_id=ADMIN_ID, 
-            text=order_message, 
-            reply_markup=admin_accept_kb(order_id),
+            text=render_order(order, ORDER_VIEW_ADMIN),
+            reply_markup=admin_accept_kb(str(order.id)),
             disable_web_page_preview=True
         )
-        
-        # Відправляємо всі фото окремими повідомленнями
-        for photo_id in item_photos:
-            await bot.send_photo(chat_id=ADMIN_ID, photo=photo_id)
-            
-    except Exception as e:
-        logger.error(f"Не вдалося надіслати замовлення адміну: {e}")
-
-@dp.callback_query(F.data.startswith("accept_order_"))
-async def accept_order(callback: types.CallbackQuery):
-    order_id = callback.data.split("_")[-1]
+    await orders.update(order.id, admin_message_id=msg.message_id)
     
-    await callback.message.edit_text(
-        text=callback.message.text + "\n\n✅ <b>ЗАМОВЛЕННЯ ПРИЙНЯТЕ</b>",
-        reply_markup=None
+    # Фото відправляємо альбомами у відповідь на повідомлення із замовленням
+    if order.photos:
+        sent = await send_photo_album(
+            ADMIN_ID,
+            order.photos,
+            caption=f"📷 Фото до замовлення #{order.id}",
+            reply_to_message_id=msg.message_id
+        )
+        if sent < len(order.photos):
+            logger.warning(f"Замовлення #{order.id}: адміну доставлено {sent} з {len(order.photos)} фото")
+
+@order_workers.on("order_created")
+async def notify_admin_about_order(fields: dict):
+    order = await orders.get(int(fields[b"order_id"]))
+    if order is None:
+        logger.error(f"Замовлення #{fields[b'order_id'].decode()} з потоку не знайдено")
+        return
+    if order.delivery_lat is not None:
+        # Замовлення з координатами спершу пропонуємо кур'єрам; адмін отримає його після останньої хвилі
+        await courier_dispatch.start(order)
+        return
+    if order.admin_message_id is not None:
+        # Подію доставлено повторно, а адмін уже отримав замовлення
+        return
+    await send_order_to_admin(order)
+
+@dp.callback_query(F.data.startswith("accept_order_"))
+async def accept_order(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ У вас немає доступу")
+        return
+
+    order_id_str = callback.data.split("_")[-1]
+    order = await orders.get(int(order_id_str)) if order_id_str.isdigit() else None
+    if order is None:
+        await callback.answer("❌ Замовлення не знайдено", show_alert=True)
+        return
+
+    if not await orders.set_status(order.id, ORDER_NEW, ORDER_ACCEPTED):
+        await callback.answer(f"Замовлення #{order.id} вже прийняте")
+        return
+    DISPATCH_ASSIGNMENT.labels("admin").observe(time.time() - order.created_at)
+    spawn(courier_dispatch.close_offers(order))
+    
+    await callback.message.edit_text(
+        text=render_order(order, ORDER_VIEW_ADMIN) + "\n\n✅ <b>ЗАМОВЛЕННЯ ПРИЙНЯТЕ</b>",
+        reply_markup=None,
+        disable_web_page_preview=True
     )
     
-    client_id = None
-    for line in callback.message.text.split('\n'):
-        if "ID:" in line:
-            try:
-                client_id = int(line.split('ID:')[1].strip().split(')')[0])
-                break
-            except (ValueError, IndexError):
-                logger.error("Помилка парсингу ID клієнта")
+    try:
+        await bot.send_message(
+            chat_id=order.user_id,
+            text=f"✅ Ваше замовлення #{order.id} прийнято в обробку!\n\n"
+                 f"Очікуйте дзвінка від нашого менеджера для підтвердження деталей.",
+            reply_markup=new_order_kb()
+        )
+    except Exception as e:
+        logger.error(f"Не вдалося повідомити клієнта про прийняття замовлення: {e}")
     
-    if client_id:
-        try:
-            await bot.send_message(
-                chat_id=client_id,
-                text=f"✅ Ваше замовлення #{order_id} прийнято в обробку!\n\n"
-                     f"Очікуйте дзвінка від нашого менеджера для підтвердження деталей.",
-                reply_markup=new_order_kb()
+    await callback.answer(f"Замовлення #{order.id} прийнято")
+
+# ==================== КУР'ЄРИ ====================
+# Координати кур'єра на зміні: GEO-індекс + час останнього оновлення. -1 - не кур'єр, 0 - не на зміні.
+# KEYS: усі кур'єри, на зміні, GEO-індекс, час координат; ARGV: id, довгота, широта, час
+COURIER_LOCATION_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('GEOADD', KEYS[3], ARGV[2], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[1])
+return 1
+"""
+
+# Хвиля пропозицій: найближчі вільні кур'єри зі свіжими координатами, яким це замовлення ще не пропонували.
+# KEYS: GEO-індекс, час координат, зайняті кур'єри, пропозиції замовлення (кур'єр -> id повідомлення)
+# ARGV: довгота, широта, радіус (км), розмір хвилі, мінімальний час координат, термін пропозицій
+# Повертає пари id, відстань (км)
+DISPATCH_OFFER_SCRIPT = """
+local found = redis.call('GEOSEARCH', KEYS[1], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'km', 'ASC', 'WITHDIST')
+local result = {}
+for _, item in ipairs(found) do
+    local courier = item[1]
+    local seen = redis.call('ZSCORE', KEYS[2], courier)
+    if seen and tonumber(seen) >= tonumber(ARGV[5])
+        and redis.call('HEXISTS', KEYS[3], courier) == 0
+        and redis.call('HEXISTS', KEYS[4], courier) == 0 then
+        redis.call('HSET', KEYS[4], courier, 0)
+        table.insert(result, courier)
+        table.insert(result, item[2])
+        if #result >= 2 * tonumber(ARGV[4]) then
+            break
+        end
+    end
+end
+if #result > 0 then
+    redis.call('EXPIRE', KEYS[4], ARGV[6])
+end
+return result
+"""
+
+# Атомарне взяття замовлення: 1 - взято, 0 - вже взяте/прийняте, -1 - кур'єру не пропонували, -2 - кур'єр зайнятий.
+# KEYS: замовлення, індекс статусу ARGV[4], індекс статусу ARGV[5], пропозиції, зайняті кур'єри, черга хвиль
+# ARGV: кур'єр, id замовлення, час, статус "нове", статус "прийняте"
+DISPATCH_CLAIM_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'status') ~= ARGV[4] then
+    return 0
+end
+if redis.call('HEXISTS', KEYS[4], ARGV[1]) == 0 then
+    return -1
+end
+if redis.call('HEXISTS', KEYS[5], ARGV[1]) == 1 then
+    return -2
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[5], ARGV[5] .. '_at', ARGV[3], 'courier_id', ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+redis.call('HSET', KEYS[5], ARGV[1], ARGV[2])
+redis.call('ZREM', KEYS[6], ARGV[2])
+return 1
+"""
+
+# Замовлення, чия хвиля минула. Забрані одразу переносяться на lease секунд уперед, тож
+# інші процеси їх не бачать, а якщо процес впав - хвилю повторить хтось інший.
+# KEYS: черга хвиль; ARGV: час, скільки забрати, до коли утримувати
+DISPATCH_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, order_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], order_id)
+end
+return due
+"""
+
+COURIER_OFFER = (
+    "🛵 <b>Нове замовлення #{id}</b> - {distance:.1f} км від вас\n\n"
+    "📍 {address}\n⏰ {delivery_time}\n💰 {payment}\n\n"
+    "Пропозиція діє {timeout} с"
+)
+
+class CourierDispatch:
+    """Пропонує замовлення найближчим вільним кур'єрам хвилями.
+
+    Кожна хвиля - до wave_size кур'єрів у радіусі radius_km * номер хвилі. Усі хвилі, починаючи
+    з першої, запускає той процес, що першим забере замовлення з черги хвиль (sorted set за часом);
+    якщо за offer_timeout ніхто не взяв, замовлення знову стає в чергу. Після останньої хвилі
+    замовлення йде адміну, але пропозиції кур'єрам діють далі: хто перший - кур'єр чи адмін -
+    той і приймає."""
+
+    def __init__(self, redis: Redis, prefix: str = "couriers", radius_km: float = COURIER_RADIUS_KM,
+                 wave_size: int = COURIER_WAVE_SIZE, waves: int = COURIER_WAVES,
+                 offer_timeout: int = COURIER_OFFER_TIMEOUT, poll_interval: float = DISPATCH_POLL_INTERVAL):
+        self.redis = redis
+        self.prefix = prefix
+        self.radius_km = radius_km
+        self.wave_size = wave_size
+        self.waves = waves
+        self.offer_timeout = offer_timeout
+        self.poll_interval = poll_interval
+        self.update_location = redis.register_script(COURIER_LOCATION_SCRIPT)
+        self.offer = redis.register_script(DISPATCH_OFFER_SCRIPT)
+        self.claim_order = redis.register_script(DISPATCH_CLAIM_SCRIPT)
+        self.pop_due = redis.register_script(DISPATCH_DUE_SCRIPT)
+        self._task = None
+
+    @property
+    def all_key(self) -> str:
+        return f"{self.prefix}:all"
+
+    @property
+    def shift_key(self) -> str:
+        return f"{self.prefix}:on_shift"
+
+    @property
+    def geo_key(self) -> str:
+        return f"{self.prefix}:geo"
+
+    @property
+    def seen_key(self) -> str:
+        return f"{self.prefix}:seen"
+
+    @property
+    def busy_key(self) -> str:
+        return f"{self.prefix}:busy"
+
+    @property
+    def due_key(self) -> str:
+        return f"{orders.prefix}s:dispatch:due"
+
+    def offers_key(self, order_id: int) -> str:
+        return f"{orders.key(order_id)}:offers"
+
+    # --- Кур'єри ---
+    async def register(self, courier_id: int) -> bool:
+        return bool(await self.redis.sadd(self.all_key, courier_id))
+
+    async def unregister(self, courier_id: int) -> bool:
+        await self.end_shift(courier_id)
+        return bool(await self.redis.srem(self.all_key, courier_id))
+
+    async def start_shift(self, courier_id: int) -> bool:
+        if not await self.redis.sismember(self.all_key, courier_id):
+            return False
+        await self.redis.sadd(self.shift_key, courier_id)
+        return True
+
+    async def end_shift(self, courier_id: int):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.srem(self.shift_key, courier_id)
+            pipe.zrem(self.geo_key, courier_id)
+            pipe.zrem(self.seen_key, courier_id)
+            await pipe.execute()
+
+    async def locate(self, courier_id: int, lat: float, lon: float) -> int:
+        return await self.update_location(
+            keys=[self.all_key, self.shift_key, self.geo_key, self.seen_key],
+            args=[courier_id, lon, lat, time.time()]
+        )
+
+    # --- Хвилі ---
+    async def start(self, order: Order):
+        """Ставить замовлення в чергу хвиль; першу хвилю запустить фоновий цикл.
+        ZADD NX робить повторну доставку події з потоку безпечною: замовлення, яке вже чекає
+        хвилі, не потрапить у чергу вдруге, а якщо процес впав до хвилі - її виконає інший"""
+        await self.redis.zadd(self.due_key, {order.id: time.time()}, nx=True)
+
+    async def run_wave(self, order_id: int):
+        order = await orders.get(order_id)
+        if order is None or order.status != ORDER_NEW:
+            await self.redis.zrem(self.due_key, order_id)
+            return
+
+        candidates = []
+        while not candidates:
+            wave = await self.redis.hincrby(orders.key(order_id), "dispatch_wave", 1)
+            if wave > self.waves:
+                await self.escalate(order)
+                return
+            found = await self.offer(
+                keys=[self.geo_key, self.seen_key, self.busy_key, self.offers_key(order_id)],
+                args=[order.delivery_lon, order.delivery_lat, self.radius_km * wave, self.wave_size,
+                      time.time() - COURIER_LOCATION_TTL, self.offer_timeout * (self.waves + 1) + 3600]
             )
-        except Exception as e:
-            logger.error(f"Не вдалося повідомити клієнта про прийняття замовлення: {e}")
-    
-    await callback.answer(f"Замовлення #{order_id} прийнято")
+            candidates = [(int(found[i]), float(found[i + 1])) for i in range(0, len(found), 2)]
+
+        await self.redis.zadd(self.due_key, {order_id: time.time() + self.offer_timeout})
+        DISPATCH_OFFERS.inc(len(candidates))
+        logger.info(f"Замовлення #{order_id}: хвиля {wave}, пропозиції {len(candidates)} кур'єрам")
+
+        async def send_offer(courier_id: int, distance: float):
+            try:
+                msg = await bot.send_message(
+                    chat_id=courier_id,
+                    text=COURIER_OFFER.format(
+                        id=order.id, distance=distance, address=order.delivery_address,
+                        delivery_time=order.delivery_time, payment=order.payment, timeout=self.offer_timeout
+                    ),
+                    reply_markup=courier_offer_kb(order.id)
+                )
+                return courier_id, msg.message_id
+            except Exception as e:
+                logger.warning(f"Не вдалося запропонувати замовлення #{order.id} кур'єру {courier_id}: {e}")
+                return courier_id, None
+
+        with outbound_priority(PRIORITY_ORDER):
+            sent = await asyncio.gather(*(send_offer(*candidate) for candidate in candidates))
+        message_ids = {courier_id: message_id for courier_id, message_id in sent if message_id is not None}
+        if message_ids:
+            await self.redis.hset(self.offers_key(order_id), mapping=message_ids)
+
+    async def escalate(self, order: Order):
+        # З черги хвиль прибираємо лише після успішної відправки: якщо вона впаде,
+        # оренда з pop_due закінчиться, і спробу повторить фоновий цикл
+        if order.admin_message_id is None:
+            logger.info(f"Замовлення #{order.id}: жоден кур'єр не взяв, передаємо адміну")
+            await send_order_to_admin(order)
+            DISPATCH_ESCALATIONS.inc()
+        await self.redis.zrem(self.due_key, order.id)
+
+    async def claim(self, order_id: int, courier_id: int) -> int:
+        return await self.claim_order(
+            keys=[orders.key(order_id), orders.status_key(ORDER_NEW), orders.status_key(ORDER_ACCEPTED),
+                  self.offers_key(order_id), self.busy_key, self.due_key],
+            args=[courier_id, order_id, time.time(), ORDER_NEW, ORDER_ACCEPTED]
+        )
+
+    async def complete(self, order: Order) -> bool:
+        delivered = await orders.set_status(order.id, ORDER_ACCEPTED, ORDER_DELIVERED)
+        await self.redis.hdel(self.busy_key, order.courier_id)
+        return delivered
+
+    async def close_offers(self, order: Order, courier_id: int = None):
+        """Прибирає кнопку з пропозицій іншим кур'єрам і позначає замовлення в адміна"""
+        offers = await self.redis.hgetall(self.offers_key(order.id))
+        await self.redis.delete(self.offers_key(order.id))
+        with outbound_priority(PRIORITY_BULK):
+            for raw_courier, raw_message_id in offers.items():
+                other, message_id = int(raw_courier), int(raw_message_id)
+                if other == courier_id or not message_id:
+                    continue
+                with contextlib.suppress(Exception):
+                    await bot.edit_message_text(
+                        chat_id=other, message_id=message_id,
+                        text=f"❌ Замовлення #{order.id} вже взяли"
+                    )
+            if courier_id is not None and order.admin_message_id is not None:
+                with contextlib.suppress(Exception):
+                    await bot.edit_message_text(
+                        chat_id=ADMIN_ID, message_id=order.admin_message_id,
+                        text=render_order(order, ORDER_VIEW_ADMIN) + f"\n\n🛵 <b>ВЗЯВ КУР'ЄР</b> (ID: {courier_id})",
+                        reply_markup=None, disable_web_page_preview=True
+                    )
+
+    # --- Фоновий цикл ---
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                due = await self.pop_due(keys=[self.due_key], args=[now, 50, now + self.offer_timeout])
+                results = await asyncio.gather(*(self.run_wave(int(order_id)) for order_id in due),
+                                               return_exceptions=True)
+                for order_id, result in zip(due, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Помилка хвилі замовлення #{order_id.decode()}: {result}")
+            except Exception as e:
+                logger.error(f"Помилка циклу диспетчеризації: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start_loop(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+courier_dispatch = CourierDispatch(redis_client)
+
+@dp.message(Command("courier_on"))
+async def courier_on(message: types.Message):
+    if not await courier_dispatch.start_shift(message.from_user.id):
+        await message.answer("⛔ Ви не зареєстровані як кур'єр")
+        return
+    await message.answer(
+        "🟢 Ви на зміні. Надішліть геолокацію - краще трансляцію геопозиції, - "
+        "щоб отримувати замовлення поруч. Завершити зміну: /courier_off",
+        reply_markup=courier_location_kb()
+    )
+
+@dp.message(Command("courier_off"))
+async def courier_off(message: types.Message):
+    await courier_dispatch.end_shift(message.from_user.id)
+    await message.answer("🔴 Зміну завершено, нові замовлення не надходитимуть", reply_markup=ReplyKeyboardRemove())
+
+@dp.message(F.location)
+async def courier_location(message: types.Message):
+    # Геолокацію клієнта під час оформлення обробляє handle_delivery_address_method, зареєстрований раніше
+    result = await courier_dispatch.locate(message.from_user.id, message.location.latitude, message.location.longitude)
+    if result == 0:
+        await message.answer("Щоб отримувати замовлення, почніть зміну: /courier_on")
+    elif result == 1:
+        await message.answer("📍 Геолокацію оновлено", reply_markup=ReplyKeyboardRemove())
+
+@dp.edited_message(F.location)
+async def courier_live_location(message: types.Message):
+    # Трансляція геопозиції приходить як редагування повідомлення
+    await courier_dispatch.locate(message.from_user.id, message.location.latitude, message.location.longitude)
+
+@dp.callback_query(F.data.startswith("claim_order_"))
+async def claim_order(callback: types.CallbackQuery):
+    order_id_str = callback.data.split("_")[-1]
+    if not order_id_str.isdigit():
+        await callback.answer("❌ Замовлення не знайдено", show_alert=True)
+        return
+
+    result = await courier_dispatch.claim(int(order_id_str), callback.from_user.id)
+    if result == -1:
+        await callback.answer("⛔ Ця пропозиція не для вас")
+        return
+    if result == -2:
+        await callback.answer("❗ Спершу доставте поточне замовлення", show_alert=True)
+        return
+    if result == 0:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer(f"Замовлення #{order_id_str} вже взяли", show_alert=True)
+        return
+
+    order = await orders.get(int(order_id_str))
+    DISPATCH_ASSIGNMENT.labels("courier").observe(time.time() - order.created_at)
+    await callback.message.edit_text(
+        text=render_order(order, ORDER_VIEW_COURIER) + "\n\n✅ <b>ВИ ВЗЯЛИ ЦЕ ЗАМОВЛЕННЯ</b>",
+        reply_markup=courier_delivered_kb(order.id),
+        disable_web_page_preview=True
+    )
+    spawn(courier_dispatch.close_offers(order, callback.from_user.id))
+
+    try:
+        await bot.send_message(
+            chat_id=order.user_id,
+            text=f"✅ Ваше замовлення #{order.id} прийнято! Кур'єр {escape_html(callback.from_user.full_name)} "
+                 f"вже в дорозі й зателефонує вам.",
+            reply_markup=new_order_kb()
+        )
+    except Exception as e:
+        logger.error(f"Не вдалося повідомити клієнта про прийняття замовлення: {e}")
+
+    await callback.answer(f"Замовлення #{order.id} ваше")
+
+@dp.callback_query(F.data.startswith("deliver_order_"))
+async def deliver_order(callback: types.CallbackQuery):
+    order_id_str = callback.data.split("_")[-1]
+    order = await orders.get(int(order_id_str)) if order_id_str.isdigit() else None
+    if order is None or order.courier_id != callback.from_user.id:
+        await callback.answer("⛔ Це не ваше замовлення")
+        return
+
+    if not await courier_dispatch.complete(order):
+        await callback.answer(f"Замовлення #{order.id} вже позначене")
+        return
+
+    await callback.message.edit_text(
+        text=render_order(order, ORDER_VIEW_COURIER) + "\n\n📦 <b>ДОСТАВЛЕНО</b>",
+        reply_markup=None,
+        disable_web_page_preview=True
+    )
+    try:
+        await bot.send_message(chat_id=order.user_id, text=f"📦 Ваше замовлення #{order.id} доставлено. Дякуємо!")
+    except Exception as e:
+        logger.error(f"Не вдалося повідомити клієнта про доставку: {e}")
+    await callback.answer("Дякуємо!")
+
+@dp.message(Command("courier_add", "courier_del"))
+async def admin_couriers(message: types.Message):
+    """/courier_add ID, /courier_del ID - реєстр кур'єрів"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас немає доступу до цієї команди")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Використання: /courier_add ID або /courier_del ID")
+        return
+
+    courier_id = int(parts[1])
+    if parts[0].startswith("/courier_add"):
+        added = await courier_dispatch.register(courier_id)
+        await message.answer(f"✅ Кур'єра {courier_id} додано" if added else f"Кур'єр {courier_id} вже в списку")
+    else:
+        removed = await courier_dispatch.unregister(courier_id)
+        await message.answer(f"✅ Кур'єра {courier_id} видалено" if removed else f"Кур'єра {courier_id} немає в списку")
 
 # ==================== АДМІН ПАНЕЛЬ ====================
 @dp.message(Command("admin"))
@@ -931,7 +3627,43 @@ async def admin_panel(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("⛔ У вас немає доступу до цієї команди")
         return
-    await message.answer("👨‍💻 <b>Адмін панель</b>", reply_markup=admin_main_kb())
+    await message.answer("👨‍💻 <b>Адмін панель</b>", reply_markup=admin_main_kb(await pause_switch.is_running()))
+
+def format_trace(trace: Trace) -> str:
+    spans = sorted(trace.spans.items(), key=lambda item: item[1][1], reverse=True)
+    breakdown = "\n".join(
+        f"    {escape_html(name)}: {total * 1000:.0f} мс ×{count}" for name, (count, total) in spans[:6]
+    )
+    accounted = sum(total for _, total in trace.spans.values())
+    return (
+        f"<b>{trace.duration * 1000:.0f} мс</b> {escape_html(trace.handler)} ({trace.update_type}), "
+        f"user <code>{trace.user_id}</code>, {time.strftime('%d.%m %H:%M:%S', time.localtime(trace.started_at))}\n"
+        f"    стан: {escape_html(trace.state_before or '—')} → {escape_html(trace.state_after or '—')}\n"
+        f"{breakdown + chr(10) if breakdown else ''}"
+        f"    решта (код обробника): {max(trace.duration - accounted, 0) * 1000:.0f} мс"
+    )
+
+@dp.message(Command("slow"))
+async def admin_slow_updates(message: types.Message):
+    """/slow [N] - найповільніші оновлення з буферів профайлера цього процесу"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас немає доступу до цієї команди")
+        return
+
+    parts = message.text.split()
+    n = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 5
+    traces = profiler.slowest(min(max(n, 1), 20))
+    if not traces:
+        await message.answer("📭 Ще немає збережених трас")
+        return
+
+    text = f"🐢 <b>Найповільніші оновлення</b> (поріг {profiler.threshold * 1000:.0f} мс):"
+    for trace in traces:
+        entry = "\n\n" + format_trace(trace)
+        if len(text) + len(entry) > 4000:
+            break
+        text += entry
+    await message.answer(text)
 
 @dp.callback_query(F.data == "admin_status")
 async def admin_status(callback: types.CallbackQuery):
@@ -939,19 +3671,30 @@ async def admin_status(callback: types.CallbackQuery):
         await callback.answer("⛔ У вас немає доступу")
         return
     
-    storage = dp.storage
-    active_sessions = 0
-    
-    if isinstance(storage, MemoryStorage):
-        data_dict = getattr(storage, '_data', {})
-        active_sessions = len(data_dict)
+    order_states = [state.state for state in OrderForm.__all_states__]
+    counters = await live_stats.snapshot(order_states)
+    active_sessions = sum(counters["sessions"].values())
     
     status_text = (
         "📊 <b>Статус бота:</b>\n\n"
-        f"🟢 Стан: {'Активний ▶️' if BOT_RUNNING else 'Призупинено ⏸️'}\n"
-        f"👥 Користувачів у чорному списку: {len(BLACKLIST)}\n"
-        f"📈 Активних сесій: {active_sessions}"
+        f"🟢 Стан: {'Активний ▶️' if await pause_switch.is_running() else 'Призупинено ⏸️'}\n"
+        f"👥 Користувачів у чорному списку: {await blacklist.count()}\n"
+        f"📈 Активних сесій: {active_sessions}\n"
+        f"🙋 Унікальних користувачів сьогодні: {counters['users_today']}\n"
+        f"📦 Замовлень за годину: {counters['orders_hour']} (попередня: {counters['orders_prev_hour']})"
     )
+    if webhook_handler is not None:
+        stats = webhook_handler.stats()
+        status_text += (
+            f"\n📥 Черга оновлень: {stats['queue_depth']} (в обробці: {stats['in_progress']})"
+            f"\n⏱️ Затримка обробки: сер. {stats['lag_avg'] * 1000:.0f} мс, макс. {stats['lag_max'] * 1000:.0f} мс"
+        )
+    funnel = [
+        f"  • {state.split(':', 1)[1]}: {count}"
+        for state, count in counters["sessions"].items() if count
+    ]
+    if funnel:
+        status_text += "\n\n🧭 <b>Сесії за кроками:</b>\n" + "\n".join(funnel)
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Оновити", callback_data="admin_status")],
@@ -967,36 +3710,40 @@ async def admin_status(callback: types.CallbackQuery):
         await callback.answer("Статус не змінився")
     await callback.answer()
 
+async def render_blacklist(page: int = 0):
+    entries, total = await blacklist.page(page)
+    if not total:
+        text = "📋 <b>Чорний список порожній</b>\n\nВи можете додати користувачів вручну"
+        return text, admin_blacklist_kb([])
+
+    pages = (total + BLACKLIST_PAGE_SIZE - 1) // BLACKLIST_PAGE_SIZE
+    if page >= pages:
+        # Сторінка зникла після видалення останніх записів
+        page = pages - 1
+        entries, total = await blacklist.page(page)
+
+    lines = []
+    for user_id, expires_at in entries:
+        if expires_at == float("inf"):
+            lines.append(f"• {user_id}")
+        else:
+            lines.append(f"• {user_id} (до {time.strftime('%d.%m %H:%M', time.localtime(expires_at))})")
+
+    text = f"📋 <b>Чорний список ({total}):</b>\n\n" + "\n".join(lines)
+    if pages > 1:
+        text += f"\n\nСторінка {page + 1}/{pages}"
+    return text, admin_blacklist_kb([user_id for user_id, _ in entries], page, pages)
+
 @dp.callback_query(F.data == "admin_blacklist")
-async def admin_show_blacklist(callback: types.CallbackQuery):
+async def admin_show_blacklist(callback: types.CallbackQuery, page: int = 0, notice: str = None):
+    """Показує сторінку чорного списку і сама відповідає на callback (notice - текст відповіді)"""
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
     
     try:
-        if not BLACKLIST:
-            text = "📋 <b>Чорний список порожній</b>\n\nВи можете додати користувачів вручну"
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="👤 Додати користувача", callback_data="admin_add_to_blacklist")],
-                [InlineKeyboardButton(text="🔄 Оновити", callback_data="admin_blacklist_refresh")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-            ])
-            await callback.message.edit_text(text=text, reply_markup=keyboard)
-        else:
-            text = "📋 <b>Чорний список:</b>\n\n" + "\n".join(f"• {user_id}" for user_id in BLACKLIST)
-            new_keyboard = admin_blacklist_kb(BLACKLIST)
-            
-            # Перевіряємо, чи змінився вміст або клавіатура
-            current_text = callback.message.text or ""
-            current_markup = callback.message.reply_markup
-            
-            if text != current_text or new_keyboard != current_markup:
-                await callback.message.edit_text(
-                    text=text,
-                    reply_markup=new_keyboard
-                )
-            else:
-                await callback.answer("Список не змінився")
+        text, keyboard = await render_blacklist(page)
+        await callback.message.edit_text(text=text, reply_markup=keyboard)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
             await callback.answer("Список не змінився")
@@ -1006,17 +3753,26 @@ async def admin_show_blacklist(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Помилка при оновленні чорного списку: {e}")
         await callback.answer("❌ Сталася помилка")
+    else:
+        await callback.answer(notice)
+
+@dp.callback_query(F.data.startswith("admin_blacklist_page_"))
+async def admin_blacklist_page(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ У вас немає доступу")
+        return
+    page_str = callback.data.split("_")[-1]
+    await admin_show_blacklist(callback, page=int(page_str) if page_str.isdigit() else 0)
 
 @dp.callback_query(F.data == "admin_blacklist_refresh")
 async def admin_refresh_blacklist(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
-    await admin_show_blacklist(callback)
-    await callback.answer("🔄 Список оновлено")
+    await admin_show_blacklist(callback, notice="🔄 Список оновлено")
 
 @dp.callback_query(F.data == "admin_add_to_blacklist")
-async def admin_add_blacklist(callback: types.CallbackQuery):
+async def admin_add_blacklist(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
@@ -1027,64 +3783,75 @@ async def admin_add_blacklist(callback: types.CallbackQuery):
             [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
         ])
     )
+    await state.set_state(AdminForm.blacklist_user)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("unblock_")
+# Команди (/reprice, /promo_add, ...) зареєстровані нижче, тож пропускаємо їх далі, а не приймаємо за ID
+@dp.message(AdminForm.blacklist_user, ~F.text.startswith("/"))
+async def admin_add_blacklist_user(message: types.Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        await state.clear()
+        return
+
+    user_id_str = (message.text or "").strip()
+    if not user_id_str.isdigit():
+        await message.answer("❗ Введіть ID користувача цифрами")
+        return
+
+    user_id = int(user_id_str)
+    if user_id == ADMIN_ID:
+        await message.answer("❗ Не можна заблокувати адміністратора")
+        return
+
+    await blacklist.add(user_id)
+    await state.clear()
+    logger.info(f"User {user_id} added to blacklist by admin")
+    text, keyboard = await render_blacklist()
+    await message.answer(f"✅ Користувача {user_id} додано до чорного списку\n\n{text}", reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("unblock_"))
 async def unblock_user(callback: types.CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
 
-    user_id_str = callback.data.split("_")[1]
+    parts = callback.data.split("_")
+    user_id_str = parts[1]
     if not user_id_str.isdigit():
         await callback.answer("❌ Невірний ідентифікатор користувача")
         return
 
     user_id = int(user_id_str)
+    page = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
     
-    if user_id in BLACKLIST:
-        BLACKLIST.remove(user_id)
+    if await blacklist.remove(user_id):
         await callback.answer(f"✅ Користувача {user_id} видалено з чорного списку")
     else:
         await callback.answer(f"❌ Користувача {user_id} немає у чорному списку")
         return
     
     # Оновлюємо повідомлення зі списком
-    if not BLACKLIST:
-        text = "📋 <b>Чорний список порожній</b>\n\nВи можете додати користувачів вручну"
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👤 Додати користувача", callback_data="admin_add_to_blacklist")],
-            [InlineKeyboardButton(text="🔄 Оновити", callback_data="admin_blacklist_refresh")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ])
-        await callback.message.edit_text(text=text, reply_markup=keyboard)
-    else:
-        text = "📋 <b>Чорний список:</b>\n\n" + "\n".join(f"• {user_id}" for user_id in BLACKLIST)
-        await callback.message.edit_text(
-            text=text,
-            reply_markup=admin_blacklist_kb(BLACKLIST)
-        )
+    text, keyboard = await render_blacklist(page)
+    await callback.message.edit_text(text=text, reply_markup=keyboard)
 
 @dp.callback_query(F.data == "admin_pause_bot")
 async def admin_pause(callback: types.CallbackQuery):
-    global BOT_RUNNING
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
 
-    BOT_RUNNING = False
-    await callback.message.edit_text("⏸️ Бот призупинено", reply_markup=admin_main_kb())
+    await pause_switch.set_running(False)
+    await callback.message.edit_text("⏸️ Бот призупинено", reply_markup=admin_main_kb(False))
     await callback.answer("⏸️ Призупинено")
 
 @dp.callback_query(F.data == "admin_start_bot")
 async def admin_start(callback: types.CallbackQuery):
-    global BOT_RUNNING
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
 
-    BOT_RUNNING = True
-    await callback.message.edit_text("▶️ Бот запущено", reply_markup=admin_main_kb())
+    await pause_switch.set_running(True)
+    await callback.message.edit_text("▶️ Бот запущено", reply_markup=admin_main_kb(True))
     await callback.answer("▶️ Запущено")
 
 @dp.callback_query(F.data == "admin_stop_bot")
@@ -1095,61 +3862,658 @@ async def admin_stop(callback: types.CallbackQuery):
 
     await callback.message.edit_text("⏹️ Бот зупиняється...")
     await callback.answer("⏹️ Зупинено")
-    await on_shutdown(bot)
-    await bot.session.close()
-    os._exit(0)
+    # Сам цей обробник теж в обробці, тому завершення лише запускаємо, а не чекаємо тут
+    request_shutdown("admin")
+    if SUPERVISOR_PID is not None:
+        # Інакше супервізор перезапустить цей процес, а решта працюватимуть далі:
+        # SIGTERM супервізору зупиняє всі процеси-обробники разом із ним
+        os.kill(SUPERVISOR_PID, signal.SIGTERM)
 
 @dp.callback_query(F.data == "admin_back")
-async def admin_back(callback: types.CallbackQuery):
+async def admin_back(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ У вас немає доступу")
         return
-    await callback.message.edit_text("👨‍💻 <b>Адмін панель</b>", reply_markup=admin_main_kb())
+    if await state.get_state() == AdminForm.blacklist_user.state:
+        await state.clear()
+    await callback.message.edit_text("👨‍💻 <b>Адмін панель</b>", reply_markup=admin_main_kb(await pause_switch.is_running()))
     await callback.answer()
 
-# ==================== ОБРОБКА ПОМИЛОК ====================
-async def on_startup(bot: Bot):
-    logger.info("Бот успішно запущений")
-    await bot.send_message(chat_id=ADMIN_ID, text="🟢 Бот запущений")
+@dp.message(Command("reprice"))
+async def admin_reprice(message: types.Message):
+    """/reprice - перерахувати доставку нових замовлень за поточним файлом зон"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас немає доступу до цієї команди")
+        return
+    if delivery_zones.current() is None:
+        await message.answer("Зони доставки не налаштовані (ZONES_FILE)")
+        return
+    changed, outside = await reprice_open_orders()
+    await message.answer(f"🧾 Перераховано доставку: змінено {changed}, поза зонами {outside}")
 
-async def on_shutdown(bot: Bot):
-    logger.info("Бот зупиняється...")
-    await bot.send_message(chat_id=ADMIN_ID, text="🔴 Бот зупиняється")
-    await bot.session.close()
+@dp.message(Command("promo_add", "promo_del"))
+async def admin_promo(message: types.Message):
+    """/promo_add КОД ЗНИЖКА[%] [ліміт] [на_клієнта] [днів], /promo_del КОД"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас немає доступу до цієї команди")
+        return
+
+    usage = (
+        "Використання:\n/promo_add КОД 20% [ліміт] [на клієнта] [днів] - знижка у відсотках\n"
+        "/promo_add КОД 30 [ліміт] [на клієнта] [днів] - знижка у гривнях\n"
+        "/promo_del КОД\n\nЛіміт 0 - без обмежень, на клієнта за замовчуванням 1"
+    )
+    parts = message.text.split()
+    code = normalize_promo_code(parts[1]) if len(parts) > 1 else None
+    if code is None:
+        await message.answer(usage)
+        return
+
+    if parts[0].startswith("/promo_del"):
+        removed = await promos.remove(code)
+        await message.answer(f"✅ Промокод {code} видалено" if removed else f"Промокоду {code} немає")
+        return
+
+    try:
+        discount_text = parts[2]
+        kind = PROMO_PERCENT if discount_text.endswith("%") else PROMO_FIXED
+        discount = float(discount_text.rstrip("%"))
+        options = parts[3:6]
+        max_uses, per_user, days = (int(value) for value in options + ["0", "1", "0"][len(options):])
+    except (IndexError, ValueError):
+        await message.answer(usage)
+        return
+    if discount <= 0 or (kind == PROMO_PERCENT and discount > 100):
+        await message.answer("❗ Знижка має бути більшою за 0 (і не більше 100%)")
+        return
+
+    expires_at = time.time() + days * 24 * 60 * 60 if days else 0
+    await promos.add(code, kind, discount, max_uses=max_uses, per_user=per_user, expires_at=expires_at)
+    promo = Promo(code, kind, discount)
+    await message.answer(
+        f"✅ Промокод {code}: {promo.label} на доставку, "
+        f"ліміт {max_uses or '∞'}, на клієнта {per_user or '∞'}"
+        + (f", до {time.strftime('%d.%m.%Y %H:%M', time.localtime(expires_at))}" if expires_at else "")
+    )
+
+@delivery_zones.on_reload
+def reprice_after_reload():
+    # Файл змінюється на всіх репліках одночасно; перераховує лише лідер
+    if leader.is_leader:
+        spawn(reprice_open_orders())
+
+# ==================== КООРДИНАЦІЯ ПРОЦЕСІВ ====================
+LEASE_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+LEASE_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class LeaderLease:
+    """Оренда лідерства в Redis: серед усіх процесів і машин лідер рівно один.
+
+    Лідер продовжує оренду кожну третину TTL; якщо він зникне, оренда спливе,
+    і її забере інший процес. При отриманні лідерства викликаються колбеки on_acquire."""
+
+    def __init__(self, redis: Redis, key: str = "leader", ttl: int = LEADER_LEASE_TTL):
+        self.redis = redis
+        self.key = key
+        self.ttl_ms = ttl * 1000
+        self.token = f"{socket.gethostname()}-{os.getpid()}-{random.getrandbits(32):08x}"
+        self.renew = redis.register_script(LEASE_RENEW_SCRIPT)
+        self.release = redis.register_script(LEASE_RELEASE_SCRIPT)
+        self.is_leader = False
+        self._callbacks = []
+        self._task = None
+        self._renewed_at = 0.0
+
+    def on_acquire(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    async def _tick(self):
+        if self.is_leader:
+            if await self.renew(keys=[self.key], args=[self.token, self.ttl_ms]):
+                self._renewed_at = time.monotonic()
+                return
+            self.is_leader = False
+            logger.warning("Лідерство втрачено")
+
+        if await self.redis.set(self.key, self.token, nx=True, px=self.ttl_ms):
+            self.is_leader = True
+            self._renewed_at = time.monotonic()
+            logger.info(f"Процес {self.token} став лідером")
+            for callback in self._callbacks:
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.error(f"Помилка обробника лідерства: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            try:
+                await self._tick()
+            except RedisError as e:
+                logger.error(f"Помилка продовження лідерства: {e}")
+                # Не продовжили вчасно - вважаємо, що оренду вже може тримати інший процес
+                if self.is_leader and time.monotonic() - self._renewed_at > self.ttl_ms / 1000:
+                    self.is_leader = False
+
+    async def start(self):
+        try:
+            await self._tick()
+        except RedisError as e:
+            logger.error(f"Помилка отримання лідерства: {e}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                await self.release(keys=[self.key], args=[self.token])
+            except RedisError as e:
+                logger.error(f"Помилка звільнення лідерства: {e}")
+
+leader = LeaderLease(redis_client)
+
+def run_supervisor(workers: int) -> int:
+    """Запускає workers процесів, що слухають один порт через SO_REUSEPORT, і перезапускає впалі.
+
+    Пауза перед перезапуском подвоюється з кожним падінням у вікні RESPAWN_CRASH_WINDOW (до
+    RESPAWN_BACKOFF_MAX). Після RESPAWN_MAX_CRASHES падінь у вікні супервізор зупиняє решту
+    процесів і повертає 1, щоб платформа перезапустила машину й показала збій."""
+    children = set()
+    stopping = False
+    crashes = deque()
+    failed = False
+
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Файли метрик попереднього запуску не повинні потрапити в суму
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+        for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+            os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, name))
+
+    def spawn_worker(restart: bool = False):
+        global SUPERVISOR_PID
+        pid = os.fork()
+        if pid == 0:
+            SUPERVISOR_PID = os.getppid()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if restart:
+                # Імпорти успадковано від супервізора - холодний старт рахуємо від fork
+                startup.started_at = time.perf_counter()
+            code = 0
+            try:
+                asyncio.run(main())
+            except Exception:
+                logger.exception("Процес-обробник завершився з помилкою")
+                code = 1
+            finally:
+                logging.shutdown()
+            os._exit(code)
+        children.add(pid)
+        logger.info(f"Запущено процес-обробник {pid}")
+
+    def forward_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signum)
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+
+    for _ in range(workers):
+        spawn_worker()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if PROMETHEUS_MULTIPROC_DIR:
+            multiprocess.mark_process_dead(pid)
+        if stopping:
+            continue
+
+        now = time.monotonic()
+        crashes.append(now)
+        while crashes[0] < now - RESPAWN_CRASH_WINDOW:
+            crashes.popleft()
+        if len(crashes) >= RESPAWN_MAX_CRASHES:
+            logger.critical(f"Падінь процесів-обробників за {RESPAWN_CRASH_WINDOW:.0f} с: {len(crashes)}, "
+                            f"зупиняємо супервізор")
+            failed = True
+            forward_signal(signal.SIGTERM, None)
+            continue
+
+        delay = min(2 ** (len(crashes) - 1), RESPAWN_BACKOFF_MAX)
+        logger.warning(f"Процес-обробник {pid} завершився ({status}), перезапуск через {delay:.0f} с")
+        time.sleep(delay)
+        if not stopping:
+            spawn_worker(restart=True)
+
+    return 1 if failed else 0
+
+# ==================== ВЕБХУК ====================
+class QueuedRequestHandler:
+    """Маршрут вебхуку: відповідає Telegram одразу після постановки оновлення в чергу.
+
+    Оновлення обробляє обмежений пул воркерів; оновлення одного користувача завжди потрапляють
+    до того самого воркера, тому обробляються по черзі. Якщо черга воркера повна довше за
+    WEBHOOK_ENQUEUE_TIMEOUT, повертаємо 503, і Telegram надішле оновлення пізніше.
+
+    Воркер обслуговує багатьох користувачів, тож повільний обробник затримав би їх усіх. Тому
+    оновлення, що обробляється довше за stall_timeout, дороблюється окремою задачею, а воркер
+    бере наступне - порядок порушується лише для такого користувача. Глибину черги й вік
+    найстарішого оновлення видно в bot_webhook_queue_depth і bot_webhook_queue_oldest_seconds."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str = None,
+                 workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 stall_timeout: float = WEBHOOK_STALL_TIMEOUT, **data):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret_token = secret_token
+        self.stall_timeout = stall_timeout
+        self.data = data
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.received = [deque() for _ in range(workers)]  # Час надходження оновлень у черзі, по порядку
+        self._workers = []
+        self._detached = set()
+        self.detached = 0
+        self.processing = asyncio.Event()  # До open() оновлення лише накопичуються в черзі
+        self.in_progress = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    @staticmethod
+    def ordering_key(update: dict) -> int:
+        for key, event in update.items():
+            if isinstance(event, dict):
+                source = event.get("from") or event.get("chat")
+                if source:
+                    return source["id"]
+        return update.get("update_id", 0)
+
+    def register(self, app: web.Application, path: str):
+        app.router.add_post(path, self.handle)
+
+    def verify_secret(self, token: str) -> bool:
+        if not self.secret_token:
+            return True
+        return hmac.compare_digest(token, self.secret_token)
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work(shard)) for shard in range(len(self.queues))]
+        self._workers.append(asyncio.create_task(self._report()))
+
+    def open(self):
+        """Дозволяє обробку: викликається зі старту, щойно завантажено те, без чого обробники
+        відповідали б неправильно (зони доставки)"""
+        self.processing.set()
+
+    async def stop(self):
+        tasks = self._workers + list(self._detached)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        WEBHOOK_QUEUE_DEPTH.set(0)
+        WEBHOOK_QUEUE_AGE.set(0)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")):
+            return web.Response(status=401, text="Unauthorized")
+        if DRAINING:
+            # Telegram повторить оновлення, і його прийме інший процес або новий реліз
+            self.rejected += 1
+            WEBHOOK_REJECTED.labels("draining").inc()
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        update = await request.json(loads=self.bot.session.json_loads)
+        shard = self.ordering_key(update) % len(self.queues)
+        queue = self.queues[shard]
+        item = (time.monotonic(), update)
+        self.received[shard].append(item[0])
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(queue.put(item), WEBHOOK_ENQUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.received[shard].remove(item[0])
+                self.rejected += 1
+                WEBHOOK_REJECTED.labels("queue_full").inc()
+                logger.warning("Черга оновлень переповнена, повертаємо 503")
+                return web.Response(status=503)
+        return web.json_response({})
+
+    async def feed_update(self, update: dict):
+        result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+        if isinstance(result, methods.TelegramMethod):
+            # Відповідь обробника через вебхук: оновлення вже підтверджено, тож відправляємо окремим запитом
+            await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+
+    async def _process(self, update: dict):
+        try:
+            await self.feed_update(update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Помилка обробки оновлення {update.get('update_id')}: {e}")
+        finally:
+            self.in_progress -= 1
+
+    async def _work(self, shard: int):
+        queue = self.queues[shard]
+        await self.processing.wait()
+        while True:
+            received, update = await queue.get()
+            if self.received[shard]:
+                self.received[shard].popleft()
+            lag = time.monotonic() - received
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.in_progress += 1
+            task = asyncio.create_task(self._process(update))
+            try:
+                done, _ = await asyncio.wait({task}, timeout=self.stall_timeout)
+                if not done:
+                    self.detached += 1
+                    WEBHOOK_DETACHED.inc()
+                    logger.warning(
+                        f"Оновлення {update.get('update_id')} обробляється довше за {self.stall_timeout:.0f} с, "
+                        f"дороблюємо окремо, щоб не тримати чергу"
+                    )
+                    self._detached.add(task)
+                    task.add_done_callback(self._detached.discard)
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                queue.task_done()
+
+    async def _report(self):
+        while True:
+            now = time.monotonic()
+            WEBHOOK_QUEUE_DEPTH.set(self.queue_depth())
+            WEBHOOK_QUEUE_AGE.set(max((now - shard[0] for shard in self.received if shard), default=0))
+            await asyncio.sleep(1)
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self) -> dict:
+        handled = self.processed + self.failed
+        return {
+            "queue_depth": self.queue_depth(),
+            "in_progress": self.in_progress,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "detached": self.detached,
+            "lag_avg": self.lag_total / handled if handled else 0.0,
+            "lag_max": self.lag_max,
+        }
+
+webhook_handler: QueuedRequestHandler = None
+
+# ==================== СТАН ЗАПУСКУ ====================
+class StartupTimer:
+    """Фази старту процесу: тривалість кожної йде в лог і в bot_startup_phase_seconds,
+    а моменти "listening" і "ready" (від запуску процесу) - в bot_cold_start_seconds"""
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.phases = {}
+        self.milestones = {}
+        self.ready = False
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name: str, elapsed: float):
+        self.phases[name] = elapsed
+        STARTUP_PHASE.labels(name).set(elapsed)
+        logger.info(f"Старт: {name} - {elapsed * 1000:.0f} мс")
+
+    def mark(self, milestone: str) -> float:
+        elapsed = time.perf_counter() - self.started_at
+        self.milestones[milestone] = elapsed
+        COLD_START.labels(milestone).set(elapsed)
+        return elapsed
+
+    def finish(self):
+        elapsed = self.mark("ready")
+        self.ready = True
+        if elapsed > COLD_START_BUDGET:
+            logger.warning(
+                f"Холодний старт {elapsed:.2f} с перевищив бюджет {COLD_START_BUDGET:.2f} с: "
+                + ", ".join(f"{name} {value:.2f} с" for name, value in self.phases.items())
+            )
+        else:
+            logger.info(f"Бот готовий за {elapsed:.2f} с (бюджет {COLD_START_BUDGET:.2f} с)")
+
+    def as_dict(self) -> dict:
+        return {
+            "phases": {name: round(value, 4) for name, value in self.phases.items()},
+            "milestones": {name: round(value, 4) for name, value in self.milestones.items()},
+            "budget": COLD_START_BUDGET,
+        }
+
+startup = StartupTimer(PROCESS_STARTED)
+
+class ReadinessProbe:
+    """Перевірка Redis і Bot API для /readyz; результат кешується на READINESS_CACHE_TTL,
+    щоб часті перевірки балансувальника не перетворювалися на навантаження"""
+
+    def __init__(self, redis: Redis, bot: Bot):
+        self.redis = redis
+        self.bot = bot
+        self._checked_at = 0.0
+        self._result = None
+        self._lock = asyncio.Lock()
+
+    async def _check(self, name: str, coro) -> tuple:
+        try:
+            await asyncio.wait_for(coro, READINESS_TIMEOUT)
+            return name, "ok"
+        except asyncio.TimeoutError:
+            return name, "timeout"
+        except Exception as e:
+            return name, f"{type(e).__name__}: {e}"
+
+    async def check(self) -> dict:
+        async with self._lock:
+            if self._result is None or time.monotonic() - self._checked_at > READINESS_CACHE_TTL:
+                checks = await asyncio.gather(
+                    self._check("redis", self.redis.ping()),
+                    self._check("bot_api", self.bot.get_me()),
+                )
+                self._result = dict(checks)
+                self._checked_at = time.monotonic()
+            return self._result
+
+readiness = ReadinessProbe(redis_client, bot)
+
+async def healthz_handler(request: web.Request) -> web.Response:
+    # Liveness: процес живий і цикл подій відповідає, залежності не перевіряємо
+    return web.json_response({"status": "ok", "uptime": round(time.perf_counter() - startup.started_at, 3)})
+
+async def readyz_handler(request: web.Request) -> web.Response:
+    if DRAINING:
+        return web.json_response({"status": "draining", "startup": startup.as_dict()}, status=503)
+    if not startup.ready:
+        status = "failed" if startup.error else "starting"
+        return web.json_response(
+            {"status": status, "error": startup.error, "startup": startup.as_dict()}, status=503
+        )
+    checks = dict(await readiness.check())
+    if delivery_zones.path:
+        checks["zones"] = "ok" if delivery_zones.index is not None else "not loaded"
+    ready = all(result == "ok" for result in checks.values())
+    return web.json_response(
+        {"status": "ready" if ready else "degraded", "checks": checks, "startup": startup.as_dict()},
+        status=200 if ready else 503,
+    )
+
+async def start_runtime(**workflow_data):
+    """Хуки старту (Redis Streams, лідерство, вебхук) - вже після того, як сервер слухає порт"""
+    try:
+        await dp.emit_startup(**workflow_data)
+    except Exception as e:
+        startup.error = f"{type(e).__name__}: {e}"
+        logger.exception("Помилка під час старту бота")
 
 # ==================== ЗАПУСК БОТА ====================
-async def on_startup(bot: Bot):
-    logger.info("Бот успішно запущений")
-    
+async def register_webhook():
+    webhook_url = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
+    allowed_updates = dp.resolve_used_update_types()
+    info = await bot.get_webhook_info()
+    if info.url == webhook_url and sorted(info.allowed_updates or []) == sorted(allowed_updates):
+        logger.info(f"Webhook вже встановлено на {webhook_url}")
+        return
+
     # Встановлюємо вебхук на Render.com
+    await bot.set_webhook(
+        url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+        drop_pending_updates=info.url != webhook_url
+    )
+    logger.info(f"Webhook установлено на {webhook_url}")
+
+@leader.on_acquire
+async def on_leadership_acquired():
+    # Реєстрацією вебхука та сповіщеннями адміну займається лише лідер
     if BASE_WEBHOOK_URL:
-        webhook_url = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
-        await bot.set_webhook(
-            url=webhook_url,
-            secret_token=WEBHOOK_SECRET,
-            drop_pending_updates=True
-        )
-        logger.info(f"Webhook установлено на {webhook_url}")
-    
-    await bot.send_message(chat_id=ADMIN_ID, text="🟢 Бот запущений")
+        await register_webhook()
+    with outbound_priority(PRIORITY_BULK):
+        await bot.send_message(chat_id=ADMIN_ID, text="🟢 Бот запущений")
+
+async def on_startup(bot: Bot):
+    get_http_session()
+    with startup.phase("zones"):
+        await delivery_zones.check()
+    delivery_zones.start_loop()
+    if webhook_handler is not None:
+        # Оновлення, що прийшли під час старту, чекали в черзі на зони доставки
+        webhook_handler.open()
+    with startup.phase("order_workers"):
+        await order_workers.start()
+    courier_dispatch.start_loop()
+    with startup.phase("leader"):
+        await leader.start()
+    logger.info("Бот успішно запущений")
+    startup.finish()
 
 async def on_shutdown(bot: Bot):
-    logger.info("Бот зупиняється...")
-    
-    if BASE_WEBHOOK_URL:
-        await bot.delete_webhook()
-    
-    await bot.send_message(chat_id=ADMIN_ID, text="🔴 Бот зупиняється")
+    global DRAINING
+    DRAINING = True
+    logger.info(f"Бот зупиняється, чекаємо на незавершену роботу до {DRAIN_TIMEOUT:.0f} с...")
+    started = time.monotonic()
+    deadline = started + DRAIN_TIMEOUT
+
+    # Нових оновлень вебхук уже не приймає; доробляємо чергу, обробники, фонові задачі й відправки
+    if not await wait_drained(deadline):
+        logger.warning(f"Не дочекалися завершення: {drain_status()}")
+    await order_workers.stop(timeout=max(0.0, deadline - time.monotonic()))
+    await courier_dispatch.stop()
+    await delivery_zones.stop()
+
+    # Вебхук не видаляємо: його продовжують обслуговувати інші процеси та машини,
+    # а новий лідер перевірить реєстрацію під час старту
+    if leader.is_leader:
+        try:
+            with outbound_priority(PRIORITY_BULK):
+                await asyncio.wait_for(bot.send_message(chat_id=ADMIN_ID, text="🔴 Бот зупиняється"), 3)
+        except Exception as e:
+            logger.error(f"Не вдалося сповістити адміна про зупинку: {e}")
+    await leader.stop()
+    if webhook_handler is not None:
+        await webhook_handler.stop()
+    await outbound.close()
+    await close_http_session()
     await bot.session.close()
+    with contextlib.suppress(Exception):
+        await (getattr(redis_client, "aclose", None) or redis_client.close)()
+
+    logger.info(
+        f"Завершено за {time.monotonic() - started:.1f} с: вебхук {webhook_handler.stats() if webhook_handler else '-'}, "
+        f"відправлено {outbound.sent}, помилок відправки {outbound.failed}, події {order_workers.stats()}"
+    )
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+def drain_status() -> dict:
+    outbound_stats = outbound.stats()
+    return {
+        "webhook_queue": webhook_handler.queue_depth() if webhook_handler else 0,
+        "updates": update_metrics.in_flight,
+        "background": len(background_tasks),
+        "outbound": outbound_stats["queue_global"] + outbound_stats["queue_chats"],
+        "stream_batches": order_workers.busy,
+    }
 
-async def handle_shutdown(signal, loop):
-    logger.info("Отримано сигнал завершення...")
-    await on_shutdown(bot)
-    loop.stop()
+async def wait_drained(deadline: float) -> bool:
+    """Чекає, доки не залишиться оновлень у черзі й обробці, фонових задач і відправок"""
+    while time.monotonic() < deadline:
+        status = drain_status()
+        if not any(value for name, value in status.items() if name != "stream_batches"):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+shutdown_requested = asyncio.Event()
+
+def request_shutdown(reason: str):
+    """Починає плавне завершення: SIGTERM/SIGINT або кнопка "Зупинити" в адмін-панелі"""
+    if shutdown_requested.is_set():
+        return
+    logger.info(f"Отримано запит на завершення ({reason})")
+    shutdown_requested.set()
+    if not BASE_WEBHOOK_URL:
+        # У режимі polling on_shutdown викличе сам dispatcher після зупинки опитування
+        asyncio.create_task(dp.stop_polling())
 
 async def main():
+    global webhook_handler
+    startup.record("import", time.perf_counter() - startup.started_at)
+
     # Додаємо middleware
-    dp.message.middleware(ProtectionMiddleware())
+    dp.update.outer_middleware(update_metrics)
+    dp.message.outer_middleware(ProfilerMiddleware(profiler))
+    dp.callback_query.outer_middleware(ProfilerMiddleware(profiler))
+    dp.message.middleware(ProtectionMiddleware(redis_client))
+    for observer in (dp.message, dp.edited_message, dp.callback_query, dp.chat_member):
+        observer.middleware(HandlerMetricsMiddleware())
+    dp.message.middleware(FSMWriteBackMiddleware())
+    dp.callback_query.middleware(FSMWriteBackMiddleware())
     
     # Реєструємо обробники подій
     dp.startup.register(on_startup)
@@ -1157,38 +4521,69 @@ async def main():
     
     # Налаштовуємо сервер для вебхуків
     if BASE_WEBHOOK_URL:
-        app = web.Application()
-        webhook_requests_handler = SimpleRequestHandler(
-            dispatcher=dp,
-            bot=bot,
-            secret_token=WEBHOOK_SECRET,
-        )
-        webhook_requests_handler.register(app, path=WEBHOOK_PATH)
-        setup_application(app, dp, bot=bot)
+        with startup.phase("app"):
+            app = web.Application()
+            webhook_handler = QueuedRequestHandler(
+                dispatcher=dp,
+                bot=bot,
+                secret_token=WEBHOOK_SECRET,
+            )
+            webhook_handler.register(app, path=WEBHOOK_PATH)
+            app.router.add_get("/healthz", healthz_handler)
+            app.router.add_get("/readyz", readyz_handler)
+            webhook_handler.start()
         
         # Налаштовуємо обробку сигналів для коректного завершення
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         for sig in (signal.SIGTERM, signal.SIGINT):
-            loop.add_signal_handler(
-                sig, lambda: asyncio.create_task(handle_shutdown(sig, loop))
+            loop.add_signal_handler(sig, request_shutdown, sig.name)
         
-        # Запускаємо сервер
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
-        await site.start()
+        # Спершу відкриваємо порт: вебхуки стають у чергу, а /readyz відповідає 503,
+        # поки хуки старту ходять у Redis і Bot API
+        with startup.phase("listen"):
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(
+                runner,
+                host=WEB_SERVER_HOST,
+                port=WEB_SERVER_PORT,
+                reuse_port=WEB_CONCURRENCY > 1
+            )
+            await site.start()
+            metrics_runner = None
+            if METRICS_PORT:
+                metrics_app = web.Application()
+                metrics_app.router.add_get("/metrics", metrics_handler)
+                metrics_runner = web.AppRunner(metrics_app, access_log=None)
+                await metrics_runner.setup()
+                await web.TCPSite(
+                    metrics_runner,
+                    host=WEB_SERVER_HOST,
+                    port=METRICS_PORT,
+                    reuse_port=WEB_CONCURRENCY > 1
+                ).start()
         
-        logger.info(f"Сервер запущено на {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
+        logger.info(
+            f"Сервер запущено на {WEB_SERVER_HOST}:{WEB_SERVER_PORT} "
+            f"через {startup.mark('listening'):.2f} с після запуску процесу"
+        )
         logger.info(f"Вебхук доступний за адресою: {BASE_WEBHOOK_URL}{WEBHOOK_PATH}")
+        spawn(start_runtime(app=app, dispatcher=dp, bot=bot, **dp.workflow_data))
         
-        # Запускаємо бота у вічному циклі
-        await asyncio.Event().wait()
+        # Працюємо до сигналу завершення, потім доробляємо почате і закриваємо сервер
+        await shutdown_requested.wait()
+        await on_shutdown(bot)
+        await runner.cleanup()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
     else:
         # Локальний режим з polling (для розробки)
         logger.info("Запуск в режимі polling...")
         await bot.delete_webhook(drop_pending_updates=True)
-        await dp.start_polling(bot)
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())  # або запуск твоєї стартової функції
+    if BASE_WEBHOOK_URL and WEB_CONCURRENCY > 1:
+        sys.exit(run_supervisor(WEB_CONCURRENCY))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,440 @@
+"""Навантажувальний тест бота від початку до кінця.
+
+Піднімає локальні замінники api.telegram.org і Nominatim, запускає bot.py у режимі вебхуку
+(TELEGRAM_API_URL вказує на фейковий Bot API) і проводить --users клієнтів через усе оформлення:
+капча, ім'я, телефон, товари з фото, доставка, геолокація, час, оплата, перегляд, відправка,
+а потім адмін приймає замовлення. Оновлення надходять справжнім шляхом - POST на WEBHOOK_PATH.
+
+Потрібен запущений Redis; INFO commandstats рахує команди всього сервера, тож беріть вільний інстанс:
+    python loadtest.py --users 2000 --concurrency 200 --redis-url redis://localhost:6379/15
+
+За замовчуванням ліміти Telegram, Nominatim і захисту від флуду підняті, щоб вимірювати сам бот;
+--real-limits залишає робочі значення (тоді додайте --think, інакше клієнтів почне обмежувати бот).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import secrets
+import signal
+import socket
+import sys
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiohttp import web
+from redis.asyncio import Redis
+
+BOT_TOKEN = "123456789:LOADTEST-token-for-fake-bot-api-0000"
+BOT_ID = 123456789
+ADMIN_ID = 1
+FIRST_USER_ID = 10_000_000
+ERROR_MARKERS = ("❗", "❌", "⛔", "⏸")
+
+# Послідовність кроків: назва, що надіслати, якого повідомлення бота чекати
+STEPS = (
+    "start", "captcha", "name", "phone", "item", "photo", "items_done",
+    "delivery_type", "location", "delivery_time", "payment", "send_order", "admin_notify", "accept",
+)
+
+# Без --real-limits бот не стримує себе: фейковий API не має flood control
+UNTHROTTLED_ENV = {
+    "TG_GLOBAL_RATE": "100000",
+    "TG_CHAT_RATE": "1000",
+    "TG_CHAT_BURST": "1000",
+    "TG_GROUP_RATE": "1000",
+    "GEOCODE_RATE": "1000",
+    "RATE_LIMIT": "1000",
+    "MAX_MESSAGES_PER_MIN": "10000",
+}
+
+class StepError(Exception):
+    pass
+
+# ==================== ФЕЙКОВИЙ BOT API ====================
+class FakeTelegram:
+    """Відповідає на виклики Bot API і роздає надіслані ботом повідомлення по скриньках чатів"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.message_ids = defaultdict(lambda: itertools.count(1))
+        self.calls = Counter()
+        self.admin_orders = {}  # номер замовлення -> Future з повідомленням адміну
+
+    def admin_order(self, order_id: int) -> asyncio.Future:
+        if order_id not in self.admin_orders:
+            self.admin_orders[order_id] = asyncio.get_running_loop().create_future()
+        return self.admin_orders[order_id]
+
+    def message(self, chat_id: int, **content) -> dict:
+        return {
+            "message_id": next(self.message_ids[chat_id]),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Pulse"},
+            **content,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = True
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Pulse", "username": "pulse_loadtest_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "Клієнт"}}
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            result = self.message(chat_id, text=params.get("text", ""))
+            if chat_id == ADMIN_ID:
+                match = re.search(r"НОВЕ ЗАМОВЛЕННЯ #(\d+)", result["text"])
+                if match:
+                    future = self.admin_order(int(match.group(1)))
+                    if not future.done():
+                        future.set_result(result)
+            else:
+                self.inboxes[chat_id].put_nowait(result)
+        elif method == "sendPhoto":
+            result = self.message(int(params["chat_id"]), photo=[fake_photo(params["photo"])])
+        elif method == "sendMediaGroup":
+            chat_id = int(params["chat_id"])
+            result = [self.message(chat_id, photo=[fake_photo(media["media"])]) for media in json.loads(params["media"])]
+        elif method == "editMessageText":
+            result = self.message(int(params.get("chat_id", 0)), text=params.get("text", ""))
+
+        return web.json_response({"ok": True, "result": result})
+
+def fake_photo(file_id: str) -> dict:
+    return {"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 960}
+
+# ==================== ФЕЙКОВИЙ NOMINATIM ====================
+async def nominatim_reverse(request: web.Request) -> web.Response:
+    return web.json_response({"address": {
+        "road": "вулиця Хрещатик",
+        "house_number": str(random.randint(1, 99)),
+        "city": "Київ",
+    }})
+
+# ==================== КЛІЄНТИ ====================
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.error_samples = {}
+        self.webhook_retries = 0
+        self.completed = 0
+        self.updates = 0
+
+    def fail(self, step: str, reason: str):
+        self.errors[step] += 1
+        self.error_samples.setdefault(step, reason)
+
+class Customer:
+    def __init__(self, run: "LoadTest", user_id: int):
+        self.run = run
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": "Клієнт"}
+        self.chat = {"id": user_id, "type": "private", "first_name": "Клієнт"}
+        self.inbox = run.telegram.inboxes[user_id]
+
+    async def post(self, update: dict):
+        """Надсилає оновлення на вебхук; 503 повторює, як це робить Telegram"""
+        update["update_id"] = next(self.run.update_ids)
+        for attempt in range(5):
+            async with self.run.http.post(self.run.webhook_url, json=update, headers=self.run.webhook_headers) as response:
+                if response.status == 200:
+                    self.run.stats.updates += 1
+                    return
+                if response.status != 503:
+                    raise StepError(f"вебхук відповів {response.status}")
+            self.run.stats.webhook_retries += 1
+            await asyncio.sleep(0.5 * (attempt + 1))
+        raise StepError("вебхук перевантажений (503)")
+
+    async def expect(self, marker: str, deadline: float) -> dict:
+        while True:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                raise StepError(f"не дочекалися «{marker}»")
+            try:
+                message = await asyncio.wait_for(self.inbox.get(), timeout)
+            except asyncio.TimeoutError:
+                raise StepError(f"не дочекалися «{marker}»")
+            text = message.get("text", "")
+            if marker in text:
+                return message
+            if text.startswith(ERROR_MARKERS):
+                raise StepError(text.splitlines()[0][:80])
+
+    async def step(self, name: str, update: dict, marker: str) -> dict:
+        if self.run.think:
+            await asyncio.sleep(random.uniform(0, 2 * self.run.think))
+        started = time.perf_counter()
+        try:
+            await self.post(update)
+            reply = await self.expect(marker, started + self.run.step_timeout)
+        except (StepError, aiohttp.ClientError) as e:
+            self.run.stats.fail(name, str(e))
+            raise StepError(name)
+        self.run.stats.latencies[name].append(time.perf_counter() - started)
+        return reply
+
+    def message(self, **content) -> dict:
+        return {"message": {
+            "message_id": random.randint(1, 2 ** 31), "date": int(time.time()),
+            "chat": self.chat, "from": self.user, **content,
+        }}
+
+    def callback(self, message: dict, data: str, user: dict = None) -> dict:
+        return {"callback_query": {
+            "id": secrets.token_hex(8), "from": user or self.user, "chat_instance": "loadtest",
+            "message": message, "data": data,
+        }}
+
+    async def run_flow(self):
+        reply = await self.step("start", self.message(text="/start", entities=[
+            {"type": "bot_command", "offset": 0, "length": 6}
+        ]), "Введіть результат")
+        a, b = map(int, re.search(r"(\d+) \+ (\d+)", reply["text"]).groups())
+        await self.step("captcha", self.message(text=str(a + b)), "Як вас звати")
+        await self.step("name", self.message(text="Олена"), "номер телефону")
+        await self.step("phone", self.message(contact={
+            "phone_number": f"+380{self.user_id % 10 ** 9:09d}", "first_name": "Олена", "user_id": self.user_id
+        }), "Що потрібно доставити")
+        await self.step("item", self.message(text="Пакет з продуктами, 2 кг"), "Товар додано")
+        for n in range(self.run.photos):
+            photo = fake_photo(f"AgACAgIAAxkBAAI-loadtest-{self.user_id}-{n}")
+            await self.step("photo", self.message(photo=[photo]), "Товар додано")
+        prompt = await self.step("items_done", self.message(text="✅ Це все"), "Відправляєте Ви")
+        await self.step("delivery_type", self.callback(prompt, "delivery"), "вказати адресу")
+        prompt = await self.step("location", self.message(location={
+            "latitude": 50.45 + random.uniform(-0.1, 0.1), "longitude": 30.52 + random.uniform(-0.1, 0.1)
+        }), "Оберіть час доставки")
+        prompt = await self.step("delivery_time", self.callback(prompt, "asap"), "Оберіть форму оплати")
+        review = await self.step("payment", self.callback(prompt, "payment_cashless"), "ПЕРЕВІРТЕ ВАШЕ ЗАМОВЛЕННЯ")
+        confirmation = await self.step("send_order", self.callback(review, "send_order"), "оформлено")
+
+        # Сповіщення адміну приходить з фонових обробників потоку замовлень
+        order_id = int(re.search(r"#(\d+)", confirmation["text"]).group(1))
+        started = time.perf_counter()
+        try:
+            admin_message = await asyncio.wait_for(self.run.telegram.admin_order(order_id), self.run.step_timeout)
+        except asyncio.TimeoutError:
+            self.run.stats.fail("admin_notify", f"адмін не отримав замовлення #{order_id}")
+            raise StepError("admin_notify")
+        self.run.stats.latencies["admin_notify"].append(time.perf_counter() - started)
+
+        admin = {"id": ADMIN_ID, "is_bot": False, "first_name": "Адмін"}
+        await self.step("accept", self.callback(admin_message, f"accept_order_{order_id}", user=admin), "прийнято в обробку")
+        self.run.stats.completed += 1
+
+# ==================== ЗАПУСК ====================
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram(latency=args.api_latency / 1000)
+        self.stats = Stats()
+        self.update_ids = itertools.count(1)
+        self.photos = args.photos
+        self.think = args.think
+        self.step_timeout = args.step_timeout
+        self.secret = args.webhook_secret or secrets.token_urlsafe(16)
+        self.webhook_url = (args.bot_url or f"http://127.0.0.1:{args.bot_port}") + args.webhook_path
+        self.webhook_headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        self.http = None
+        self.bot_process = None
+
+    async def start_fakes(self):
+        app = web.Application(client_max_size=16 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.telegram.handle)
+        app.router.add_get("/reverse", nominatim_reverse)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", self.args.api_port).start()
+        return runner
+
+    async def start_bot(self):
+        env = dict(os.environ)
+        if not self.args.real_limits:
+            env.update(UNTHROTTLED_ENV)
+        env.update({
+            "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{self.args.api_port}",
+            "NOMINATIM_URL": f"http://127.0.0.1:{self.args.api_port}",
+            "GEOCODING_API_KEY": "loadtest",
+            "ADMIN_ID": str(ADMIN_ID),
+            "REDIS_URL": self.args.redis_url,
+            "WEBHOOK_URL": f"http://127.0.0.1:{self.args.bot_port}",
+            "WEBHOOK_PATH": self.args.webhook_path,
+            "WEBHOOK_SECRET": self.secret,
+            "WEB_SERVER_HOST": "127.0.0.1",
+            "PORT": str(self.args.bot_port),
+            "WEB_CONCURRENCY": str(self.args.workers),
+        })
+        log = open(self.args.bot_log, "w", encoding="utf-8")
+        self.bot_process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py"),
+            env=env, stdout=log, stderr=asyncio.subprocess.STDOUT
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.bot_process.returncode is not None:
+                raise RuntimeError(f"bot.py завершився з кодом {self.bot_process.returncode}, див. {self.args.bot_log}")
+            with socket.socket() as sock:
+                if sock.connect_ex(("127.0.0.1", self.args.bot_port)) == 0:
+                    return
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"bot.py не відкрив порт {self.args.bot_port} за 30 сек, див. {self.args.bot_log}")
+
+    async def stop_bot(self):
+        if self.bot_process is None or self.bot_process.returncode is not None:
+            return
+        self.bot_process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.bot_process.wait(), 30)
+        except asyncio.TimeoutError:
+            self.bot_process.kill()
+
+    async def customer(self, semaphore: asyncio.Semaphore, user_id: int):
+        async with semaphore:
+            try:
+                await Customer(self, user_id).run_flow()
+            except StepError:
+                pass
+
+    async def run(self) -> dict:
+        redis = Redis.from_url(self.args.redis_url)
+        fakes = await self.start_fakes()
+        try:
+            if not self.args.bot_url:
+                await self.start_bot()
+            connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+            async with aiohttp.ClientSession(connector=connector) as self.http:
+                commands_before = await command_stats(redis)
+                semaphore = asyncio.Semaphore(self.args.concurrency)
+                started = time.perf_counter()
+                tasks = []
+                for n in range(self.args.users):
+                    tasks.append(asyncio.create_task(self.customer(semaphore, FIRST_USER_ID + n)))
+                    if self.args.ramp:
+                        await asyncio.sleep(self.args.ramp / self.args.users)
+                await asyncio.gather(*tasks)
+                elapsed = time.perf_counter() - started
+                commands_after = await command_stats(redis)
+        finally:
+            await self.stop_bot()
+            await fakes.cleanup()
+            await redis.aclose() if hasattr(redis, "aclose") else await redis.close()
+        return self.report(elapsed, commands_before, commands_after)
+
+    def report(self, elapsed: float, commands_before: dict, commands_after: dict) -> dict:
+        stats = self.stats
+        redis_calls = {
+            name: calls - commands_before.get(name, 0)
+            for name, calls in commands_after.items() if calls > commands_before.get(name, 0)
+        }
+        completed = max(stats.completed, 1)
+        steps = {}
+        for step in STEPS:
+            latencies = sorted(stats.latencies.get(step, []))
+            steps[step] = {
+                "count": len(latencies),
+                "errors": stats.errors.get(step, 0),
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+            }
+        return {
+            "users": self.args.users,
+            "completed": stats.completed,
+            "failed": self.args.users - stats.completed,
+            "elapsed": elapsed,
+            "orders_per_sec": stats.completed / elapsed if elapsed else 0.0,
+            "updates_per_sec": stats.updates / elapsed if elapsed else 0.0,
+            "webhook_retries": stats.webhook_retries,
+            "steps": steps,
+            "error_samples": stats.error_samples,
+            "redis_ops_per_order": sum(redis_calls.values()) / completed,
+            "redis_commands_per_order": {
+                name: calls / completed
+                for name, calls in sorted(redis_calls.items(), key=lambda item: item[1], reverse=True)
+            },
+            "api_calls_per_order": {
+                name: calls / completed for name, calls in self.telegram.calls.most_common()
+            },
+        }
+
+async def command_stats(redis: Redis) -> dict:
+    """Кількість викликів кожної команди з INFO commandstats"""
+    try:
+        info = await redis.info("commandstats")
+    except Exception as e:
+        print(f"INFO commandstats недоступний: {e}", file=sys.stderr)
+        return {}
+    return {name.split("_", 1)[1].upper(): values["calls"] for name, values in info.items()}
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def print_report(result: dict):
+    print(f"\nКлієнтів: {result['users']}, завершили: {result['completed']}, з помилкою: {result['failed']}")
+    print(f"Час: {result['elapsed']:.1f} с, замовлень/с: {result['orders_per_sec']:.1f}, "
+          f"оновлень/с: {result['updates_per_sec']:.1f}, повторів після 503: {result['webhook_retries']}")
+    print(f"\n{'крок':<15}{'к-сть':>8}{'помилки':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for step, row in result["steps"].items():
+        print(f"{step:<15}{row['count']:>8}{row['errors']:>9}"
+              f"{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}{row['p99'] * 1000:>10.1f}")
+    for step, reason in result["error_samples"].items():
+        print(f"  {step}: {reason}")
+    print(f"\nRedis: {result['redis_ops_per_order']:.1f} команд на замовлення")
+    for name, calls in list(result["redis_commands_per_order"].items())[:10]:
+        print(f"  {name:<16}{calls:>8.1f}")
+    print("Bot API на замовлення:")
+    for name, calls in result["api_calls_per_order"].items():
+        print(f"  {name:<20}{calls:>8.1f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Навантажувальний тест бота з фейковими Bot API і Nominatim")
+    parser.add_argument("--users", type=int, default=1000, help="скільки клієнтів оформлюють замовлення")
+    parser.add_argument("--concurrency", type=int, default=100, help="скільки клієнтів активні одночасно")
+    parser.add_argument("--ramp", type=float, default=0, help="за скільки секунд запустити всіх клієнтів")
+    parser.add_argument("--think", type=float, default=0, help="середня пауза клієнта між кроками, сек")
+    parser.add_argument("--photos", type=int, default=2, help="фото на замовлення")
+    parser.add_argument("--step-timeout", type=float, default=30)
+    parser.add_argument("--api-latency", type=float, default=0, help="затримка фейкового Bot API, мс")
+    parser.add_argument("--api-port", type=int, default=18080)
+    parser.add_argument("--bot-port", type=int, default=18443)
+    parser.add_argument("--bot-url", help="вже запущений бот (тоді його оточення налаштовуєте самі)")
+    parser.add_argument("--webhook-path", default="/webhook")
+    parser.add_argument("--webhook-secret", help="WEBHOOK_SECRET уже запущеного бота")
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY для бота")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--real-limits", action="store_true", help="не піднімати ліміти Telegram/Nominatim/флуду")
+    parser.add_argument("--bot-log", default="loadtest_bot.log")
+    parser.add_argument("--json", help="зберегти результат у файл")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = asyncio.run(LoadTest(args).run())
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0 if result["completed"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
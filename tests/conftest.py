@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:TEST-token-not-used-for-any-requests-000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """Виконує сценарій з окремим FakeRedis, на який переключено сховища модуля bot"""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # Lua-скрипти у fakeredis
+    import bot
+
+    def runner(scenario):
+        async def main():
+            redis = fakeredis.aioredis.FakeRedis()
+            monkeypatch.setattr(bot, "live_stats", bot.LiveStats(redis, prefix="test:stats"))
+            monkeypatch.setattr(bot, "orders", bot.OrderStore(redis))
+            try:
+                return await scenario(redis)
+            finally:
+                await redis.aclose()
+
+        return asyncio.run(main())
+
+    return runner
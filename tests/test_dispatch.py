@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import bot  # noqa: E402
+
+# Кур'єри навколо точки замовлення (широта, довгота)
+ORDER_POINT = (50.4501, 30.5234)
+NEAR = {101: (50.4502, 30.5236), 102: (50.4520, 30.5260), 103: (50.4540, 30.5290)}
+
+
+async def setup(redis, couriers=NEAR):
+    dispatch = bot.CourierDispatch(redis, wave_size=10)
+    for courier_id, (lat, lon) in couriers.items():
+        await dispatch.register(courier_id)
+        await dispatch.start_shift(courier_id)
+        assert await dispatch.locate(courier_id, lat, lon) == 1
+    order = await bot.orders.create(bot.Order(
+        id=0, user_id=555, created_at=time.time(), delivery_address="Хрещатик, 1",
+        delivery_lat=ORDER_POINT[0], delivery_lon=ORDER_POINT[1]
+    ))
+    return dispatch, order
+
+
+async def offer(dispatch, order, radius_km=1.0, size=10, min_seen=None):
+    found = await dispatch.offer(
+        keys=[dispatch.geo_key, dispatch.seen_key, dispatch.busy_key, dispatch.offers_key(order.id)],
+        args=[order.delivery_lon, order.delivery_lat, radius_km, size,
+              time.time() - 60 if min_seen is None else min_seen, 3600]
+    )
+    return [int(found[i]) for i in range(0, len(found), 2)]
+
+
+def test_offer_nearest_first_without_repeats(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        assert await offer(dispatch, order, size=2) == [101, 102]
+        # Наступна хвиля не пропонує тим самим кур'єрам
+        assert await offer(dispatch, order, size=2) == [103]
+        assert await offer(dispatch, order) == []
+
+    run(scenario)
+
+
+def test_offer_skips_busy_and_stale(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await redis.hset(dispatch.busy_key, 101, 42)
+        await redis.zadd(dispatch.seen_key, {102: time.time() - 3600})
+        assert await offer(dispatch, order) == [103]
+
+    run(scenario)
+
+
+def test_concurrent_claims_single_winner(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await offer(dispatch, order)
+        results = await asyncio.gather(*(dispatch.claim(order.id, courier_id) for courier_id in NEAR))
+        assert sorted(results) == [0, 0, 1]
+        winner = list(NEAR)[results.index(1)]
+        claimed = await bot.orders.get(order.id)
+        assert claimed.status == bot.ORDER_ACCEPTED
+        assert claimed.courier_id == winner
+        assert await redis.hgetall(dispatch.busy_key) == {str(winner).encode(): str(order.id).encode()}
+
+    run(scenario)
+
+
+def test_claim_after_admin_accept(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await offer(dispatch, order)
+        assert await bot.orders.set_status(order.id, bot.ORDER_NEW, bot.ORDER_ACCEPTED)
+        assert await dispatch.claim(order.id, 101) == 0
+        assert await redis.hlen(dispatch.busy_key) == 0
+
+    run(scenario)
+
+
+def test_admin_accept_after_claim(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await offer(dispatch, order)
+        results = await asyncio.gather(
+            dispatch.claim(order.id, 101),
+            bot.orders.set_status(order.id, bot.ORDER_NEW, bot.ORDER_ACCEPTED)
+        )
+        # Рівно один з двох бере замовлення
+        assert sorted([results[0] == 1, results[1]]) == [False, True]
+
+    run(scenario)
+
+
+def test_claim_rejects_busy_and_not_offered(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        assert await dispatch.claim(order.id, 101) == -1
+        await offer(dispatch, order)
+        await redis.hset(dispatch.busy_key, 102, 42)
+        assert await dispatch.claim(order.id, 102) == -2
+        assert await dispatch.claim(order.id, 999) == -1
+        assert (await bot.orders.get(order.id)).status == bot.ORDER_NEW
+
+    run(scenario)
+
+
+def test_claim_removes_order_from_due_queue(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await dispatch.start(order)
+        await offer(dispatch, order)
+        assert await dispatch.claim(order.id, 101) == 1
+        assert await redis.zscore(dispatch.due_key, order.id) is None
+
+    run(scenario)
+
+
+def test_start_is_idempotent(run):
+    async def scenario(redis):
+        dispatch, order = await setup(redis)
+        await dispatch.start(order)
+        queued_at = await redis.zscore(dispatch.due_key, order.id)
+        await dispatch.start(order)
+        assert await redis.zcard(dispatch.due_key) == 1
+        assert await redis.zscore(dispatch.due_key, order.id) == queued_at
+
+    run(scenario)
+
+
+def test_escalate_keeps_order_queued_when_send_fails(run, monkeypatch):
+    async def failing_send(order):
+        raise RuntimeError("Telegram недоступний")
+
+    async def scenario(redis):
+        dispatch, order = await setup(redis, couriers={})
+        await dispatch.start(order)
+        with pytest.raises(RuntimeError):
+            await dispatch.escalate(order)
+        assert await redis.zscore(dispatch.due_key, order.id) is not None
+
+        sent = []
+
+        async def send(order):
+            sent.append(order.id)
+
+        monkeypatch.setattr(bot, "send_order_to_admin", send)
+        await dispatch.escalate(order)
+        assert sent == [order.id]
+        assert await redis.zscore(dispatch.due_key, order.id) is None
+
+    monkeypatch.setattr(bot, "send_order_to_admin", failing_send)
+    run(scenario)
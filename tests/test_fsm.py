@@ -0,0 +1,103 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import bot  # noqa: E402
+
+KEY = bot.StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+async def setup(redis, data):
+    storage = bot.CompactRedisStorage(redis, stats_prefix="test:stats")
+    await storage.write(KEY, state=bot.OrderForm.delivery_time.state, data=data)
+    return storage
+
+
+def test_late_field_survives_buffered_snapshot(run):
+    async def scenario(redis):
+        storage = await setup(redis, {"name": "Олена", "delivery_address": "Координати"})
+        handler = bot.BufferedFSMContext(storage, KEY)
+        await handler.get_data()
+
+        # Пізня адреса від геокодера приходить, поки обробник тримає знімок
+        assert await bot.merge_fsm_data(storage, KEY, {"delivery_address": "Хрещатик, 1"},
+                                        expect={"delivery_address": "Координати"})
+        await handler.update_data(delivery_time="18:00")
+        await handler.set_state(bot.OrderForm.payment)
+        await handler.flush()
+
+        assert await storage.get_data(KEY) == {
+            "name": "Олена", "delivery_address": "Хрещатик, 1", "delivery_time": "18:00"
+        }
+        assert await storage.get_state(KEY) == bot.OrderForm.payment.state
+
+    run(scenario)
+
+
+def test_late_field_is_not_written_after_customer_changed_it(run):
+    async def scenario(redis):
+        storage = await setup(redis, {"delivery_address": "Координати"})
+        handler = bot.BufferedFSMContext(storage, KEY)
+        await handler.update_data(delivery_address="вул. Січових Стрільців, 5")
+        await handler.flush()
+
+        assert not await bot.merge_fsm_data(storage, KEY, {"delivery_address": "Хрещатик, 1"},
+                                            expect={"delivery_address": "Координати"})
+        assert (await storage.get_data(KEY))["delivery_address"] == "вул. Січових Стрільців, 5"
+
+    run(scenario)
+
+
+def test_concurrent_buffered_contexts_merge_changed_fields(run):
+    async def scenario(redis):
+        storage = await setup(redis, {"name": "Олена", "promo_code": "SPRING", "payment": "—"})
+        first = bot.BufferedFSMContext(storage, KEY)
+        second = bot.BufferedFSMContext(storage, KEY)
+        data = await first.get_data()
+        await second.get_data()
+
+        data.pop("promo_code")
+        await first.set_data(data)
+        await second.update_data(payment="Готівка")
+        await second.flush()
+        await first.flush()
+
+        assert await storage.get_data(KEY) == {"name": "Олена", "payment": "Готівка"}
+
+    run(scenario)
+
+
+def test_unchanged_snapshot_is_written_in_one_call(run):
+    async def scenario(redis):
+        storage = await setup(redis, {"name": "Олена"})
+        calls = []
+        real_write = storage.write
+
+        async def counting_write(*args, **kwargs):
+            calls.append(kwargs.get("version"))
+            return await real_write(*args, **kwargs)
+
+        storage.write = counting_write
+        handler = bot.BufferedFSMContext(storage, KEY)
+        await handler.update_data(phone="+380501234567")
+        await handler.flush()
+
+        assert len(calls) == 1
+        assert await storage.get_data(KEY) == {"name": "Олена", "phone": "+380501234567"}
+
+    run(scenario)
+
+
+def test_clear_replaces_whole_session(run):
+    async def scenario(redis):
+        storage = await setup(redis, {"name": "Олена"})
+        handler = bot.BufferedFSMContext(storage, KEY)
+        await handler.get_data()
+        await bot.merge_fsm_data(storage, KEY, {"delivery_address": "Хрещатик, 1"})
+        await handler.clear()
+        await handler.flush()
+
+        assert await storage.get_data(KEY) == {}
+        assert await storage.get_state(KEY) is None
+
+    run(scenario)
@@ -0,0 +1,232 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("fakeredis")
+
+import bot  # noqa: E402
+
+
+class FakeMessage:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+class FakeState:
+    def __init__(self, data):
+        self.data = dict(data)
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+
+async def used(store, code, user_id=None):
+    if user_id is None:
+        return int(await store.redis.hget(store.key(code), "used"))
+    return int(await store.redis.hget(store.users_key(code), user_id) or 0)
+
+
+def test_total_limit_under_concurrent_redeem(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        await store.add("SPRING", bot.PROMO_PERCENT, 20, max_uses=5, per_user=1)
+        results = await asyncio.gather(*(store.redeem("SPRING", user_id) for user_id in range(1, 51)))
+        redeemed = [promo for promo, error in results if promo is not None]
+        assert len(redeemed) == 5
+        assert {error for promo, error in results if promo is None} == {bot.PROMO_ERRORS[-4]}
+        assert await used(store, "SPRING") == 5
+
+    run(scenario)
+
+
+def test_per_user_limit(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        await store.add("TWICE", bot.PROMO_FIXED, 30, per_user=2)
+        results = await asyncio.gather(*(store.redeem("TWICE", 7) for _ in range(5)))
+        assert sum(promo is not None for promo, _ in results) == 2
+        promo, error = await store.check("TWICE", 7)
+        assert promo is None and error == bot.PROMO_ERRORS[-5]
+        # Інший клієнт свій ліміт ще має
+        promo, _ = await store.redeem("TWICE", 8)
+        assert promo.label == "-30 грн"
+
+    run(scenario)
+
+
+def test_validity_window(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        now = time.time()
+        await store.add("LATER", bot.PROMO_PERCENT, 10, starts_at=now + 3600)
+        await store.add("OLD", bot.PROMO_PERCENT, 10, expires_at=now - 1)
+        await store.add("NOW", bot.PROMO_PERCENT, 10, starts_at=now - 60, expires_at=now + 3600)
+        assert await store.redeem("LATER", 1) == (None, bot.PROMO_ERRORS[-2])
+        assert await store.redeem("OLD", 1) == (None, bot.PROMO_ERRORS[-3])
+        promo, error = await store.redeem("NOW", 1)
+        assert error is None and promo.apply(80.0) == 8.0
+        assert await used(store, "LATER") == 0
+        assert await used(store, "OLD") == 0
+
+    run(scenario)
+
+
+def test_check_does_not_redeem(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        await store.add("ONCE", bot.PROMO_FIXED, 50, max_uses=1)
+        for _ in range(3):
+            promo, _ = await store.check("ONCE", 1)
+            assert promo is not None
+        assert await used(store, "ONCE") == 0
+
+    run(scenario)
+
+
+def test_release_after_failed_order_create(run, monkeypatch):
+    async def failing_create(order):
+        raise bot.RedisError("Redis недоступний")
+
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        monkeypatch.setattr(bot, "promos", store)
+        monkeypatch.setattr(bot.orders, "create", failing_create)
+        await store.add("ONCE", bot.PROMO_FIXED, 50, max_uses=1, per_user=1)
+
+        message = FakeMessage()
+        state = FakeState({"item_text": "Хліб", "delivery_fee": 60.0, "promo_code": "ONCE"})
+        assert await bot.submit_order(message, state, 42) is None
+        assert message.answers == ["❌ Не вдалося оформити замовлення. Спробуйте ще раз."]
+        assert await used(store, "ONCE") == 0
+        assert await used(store, "ONCE", 42) == 0
+        # Використання повернуто - код знову можна погасити
+        promo, error = await store.redeem("ONCE", 42)
+        assert error is None
+
+    run(scenario)
+
+
+def test_bloom_filter_rejects_unknown_codes(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        for number in range(200):
+            await store.add(f"CODE{number}", bot.PROMO_PERCENT, 10)
+        await store.refresh()
+
+        calls = []
+        real_script = store.redeem_script
+
+        async def counting_script(**kwargs):
+            calls.append(kwargs["keys"][0])
+            return await real_script(**kwargs)
+
+        store.redeem_script = counting_script
+        promo, error = await store.check("CODE7", 1)
+        assert error is None
+        assert calls == [store.key("CODE7")]
+
+        calls.clear()
+        for number in range(1000):
+            promo, error = await store.check(f"MISSING{number}", 1)
+            assert promo is None and error == bot.PROMO_ERRORS[-1]
+        # До Redis доходять лише хибнопозитивні спрацювання фільтра
+        assert len(calls) <= 10
+
+    run(scenario)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = bot.BloomFilter(1000)
+    codes = [f"CODE{number}" for number in range(1000)]
+    for code in codes:
+        bloom.add(code)
+    assert all(code in bloom for code in codes)
+    false_positives = sum(f"OTHER{number}" in bloom for number in range(10000))
+    assert false_positives < 100
+
+
+def test_reprice_recomputes_discount(run, monkeypatch):
+    def zones(fee):
+        return bot.ZoneIndex.from_geojson({
+            "type": "Feature",
+            "properties": {"name": "Центр", "fee": fee, "fee_per_km": 0, "hub": [30.5, 50.45]},
+            "geometry": {"type": "Polygon", "coordinates": [
+                [[30.4, 50.4], [30.6, 50.4], [30.6, 50.5], [30.4, 50.5], [30.4, 50.4]]
+            ]},
+        })
+
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        monkeypatch.setattr(bot, "promos", store)
+        monkeypatch.setattr(bot, "redis_client", redis)
+        delivery_zones = bot.DeliveryZones(None)
+        monkeypatch.setattr(bot, "delivery_zones", delivery_zones)
+        await store.add("HALF", bot.PROMO_PERCENT, 50)
+        await store.add("MINUS40", bot.PROMO_FIXED, 40)
+
+        created = {}
+        for code in ("HALF", "MINUS40"):
+            state = FakeState({
+                "item_text": "Хліб", "delivery_lat": 50.45, "delivery_lon": 30.5,
+                "delivery_zone": "Центр", "delivery_distance": 0.0, "delivery_fee": 60.0, "promo_code": code,
+            })
+            created[code] = await bot.submit_order(FakeMessage(), state, 42)
+        assert created["HALF"].discount_amount == 30.0
+
+        delivery_zones.index = zones(30)
+        assert await bot.reprice_open_orders() == (2, 0)
+        half = await bot.orders.get(created["HALF"].id)
+        fixed = await bot.orders.get(created["MINUS40"].id)
+        assert (half.delivery_fee, half.discount_amount) == (30.0, 15.0)
+        assert (fixed.delivery_fee, fixed.discount_amount) == (30.0, 30.0)
+        assert "<s>30</s> 0 грн" in bot.render_order(fixed, bot.ORDER_VIEW_ADMIN)
+
+    run(scenario)
+
+
+def test_concurrent_checks_refresh_bloom_once(run):
+    async def scenario(redis):
+        store = bot.PromoStore(redis)
+        await store.add("SPRING", bot.PROMO_PERCENT, 20)
+        refreshes = []
+        real_refresh = store.refresh
+
+        async def counting_refresh():
+            refreshes.append(1)
+            await real_refresh()
+
+        store.refresh = counting_refresh
+        results = await asyncio.gather(*(store.check("SPRING", user_id) for user_id in range(20)))
+        assert refreshes == [1]
+        assert all(error is None for _, error in results)
+
+    run(scenario)
+
+
+def test_promo_step_answers_when_redis_fails(run, monkeypatch):
+    class BrokenPromos:
+        async def check(self, code, user_id):
+            raise bot.RedisError("Redis недоступний")
+
+    class Message(FakeMessage):
+        text = "SPRING"
+        from_user = type("User", (), {"id": 42})()
+
+    async def scenario(redis):
+        monkeypatch.setattr(bot, "promos", BrokenPromos())
+        message = Message()
+        state = FakeState({"promo_code": None})
+        await bot.process_promo_code(message, state)
+        assert message.answers == [
+            "❌ Не вдалося перевірити промокод. Спробуйте пізніше або натисніть «Без промокоду»."
+        ]
+        assert state.data == {"promo_code": None}
+
+    run(scenario)
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import pytest
+
+bot = pytest.importorskip("bot")
+
+
+def square(name, lon1, lat1, lon2, lat2, fee=50, holes=()):
+    rings = [[[lon1, lat1], [lon2, lat1], [lon2, lat2], [lon1, lat2], [lon1, lat1]]]
+    for hole in holes:
+        hx1, hy1, hx2, hy2 = hole
+        rings.append([[hx1, hy1], [hx2, hy1], [hx2, hy2], [hx1, hy2], [hx1, hy1]])
+    return {
+        "type": "Feature",
+        "properties": {"name": name, "fee": fee, "fee_per_km": 10, "hub": [lon1, lat1]},
+        "geometry": {"type": "Polygon", "coordinates": rings},
+    }
+
+
+# Центр з "діркою" та більша зона під ним: у файлі центр раніше, тому перемагає там, де перекриваються
+ZONES = {
+    "type": "FeatureCollection",
+    "features": [
+        square("Центр", 30.4, 50.4, 30.6, 50.5, holes=[(30.48, 50.44, 30.52, 50.46)]),
+        square("Місто", 30.3, 50.3, 30.7, 50.6, fee=80),
+    ],
+}
+
+
+def brute(index, lat, lon):
+    for zone in index.zones:
+        if zone.contains(lon, lat):
+            return zone.quote(lat, lon)
+    return None
+
+
+def test_lookup_matches_brute_force():
+    index = bot.ZoneIndex.from_geojson(ZONES)
+    rng = random.Random(1)
+    points = [(50.25 + rng.random() * 0.4, 30.25 + rng.random() * 0.5) for _ in range(5000)]
+    assert [index.lookup(*point) for point in points] == [brute(index, *point) for point in points]
+
+
+def test_lookup_respects_holes_and_order():
+    index = bot.ZoneIndex.from_geojson(ZONES)
+    assert index.lookup(50.42, 30.45).zone == "Центр"
+    assert index.lookup(50.45, 30.50).zone == "Місто"  # дірка центру
+    assert index.lookup(50.55, 30.65).zone == "Місто"
+    assert index.lookup(51.0, 30.5) is None
+
+
+def test_lookup_many_matches_lookup():
+    index = bot.ZoneIndex.from_geojson(ZONES)
+    rng = random.Random(2)
+    # Щільні скупчення, щоб у клітинках були групи точок по обидва боки меж
+    points = [
+        (lat + rng.uniform(-0.005, 0.005), lon + rng.uniform(-0.005, 0.005))
+        for lat, lon in [(50.44, 30.48), (50.4, 30.4), (50.45, 30.5), (50.6, 30.7), (50.5, 30.55)]
+        for _ in range(300)
+    ]
+    assert index.lookup_many(points) == [index.lookup(*point) for point in points]
+
+
+def test_check_reloads_changed_file_and_keeps_index_on_error(tmp_path):
+    path = tmp_path / "zones.json"
+    path.write_text(json.dumps(ZONES), encoding="utf-8")
+    zones = bot.DeliveryZones(str(path))
+    reloads = []
+    zones.on_reload(lambda: reloads.append(1))
+
+    async def scenario():
+        await zones.check()
+        fee = zones.lookup(50.42, 30.45).fee
+        assert reloads == []
+
+        changed = json.loads(json.dumps(ZONES))
+        changed["features"][0]["properties"]["fee"] = 70
+        path.write_text(json.dumps(changed), encoding="utf-8")
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        await zones.check()
+        assert zones.lookup(50.42, 30.45).fee == fee + 20
+        assert reloads == [1]
+
+        path.write_text("{зіпсовано", encoding="utf-8")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        await zones.check()
+        assert zones.lookup(50.42, 30.45).fee == fee + 20
+        assert reloads == [1]
+
+    asyncio.run(scenario())